@@ -8,7 +8,7 @@ import hashlib
 import logging
 import re
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from xml.etree import ElementTree as ET
 
 from cryptography import x509
@@ -32,6 +32,21 @@ DOC_TIPO_CONSUMIDOR_FINAL = 99
 DOC_TIPO_CUIT = 80
 
 
+class AfipRechazo(RuntimeError):
+    """AFIP respondió y rechazó el comprobante (o el pedido), o el comprobante no se
+    puede armar. A diferencia de un error de conexión no dice nada de si el servicio
+    está caído."""
+
+
+class AfipNoDisponible(RuntimeError):
+    """No se pudo hablar con AFIP o no aceptó las credenciales (conexión, WSAA, token o
+    firma). Es el único error que cuenta para el circuito de server.py."""
+
+
+# Errores de WSFE por token, firma o CUIT no autorizado: son de credenciales, no del pedido
+_WSFE_ERRORES_AUTH = {600, 601, 602}
+
+
 # ─── Helpers de cifrado para almacenamiento seguro de la clave privada ─────────
 
 def _make_fernet(secret_key: str) -> Fernet:
@@ -154,7 +169,7 @@ class AfipService:
         try:
             response = await asyncio.to_thread(_do_login)
         except Exception as e:
-            raise RuntimeError(f"Error comunicando con WSAA: {e}")
+            raise AfipNoDisponible(f"Error comunicando con WSAA: {e}")
 
         return self._parse_ta(response)
 
@@ -208,46 +223,16 @@ class AfipService:
         except Exception as e:
             return {"ok": False, "error": str(e)}
 
-    async def solicitar_cae(
+    def _detalle(
         self,
         sale: dict,
         afip_cfg: dict,
-        token: str,
-        sign: str,
         tipo_cbte: int,
+        fecha_cbte: str,
         cuit_receptor: Optional[str] = None,
         cbtes_asoc: Optional[list] = None,
     ) -> dict:
-        """
-        Solicita CAE para una venta via FECAESolicitar.
-        Retorna dict con cae, cae_vencimiento, nro_comprobante.
-        tipo_cbte: 1=Factura A, 6=Factura B, 11=Factura C
-        """
-        try:
-            import zeep
-        except ImportError:
-            raise RuntimeError("La librería 'zeep' no está instalada.")
-
-        _, wsfe_url = self._get_urls(afip_cfg["ambiente"])
-        cuit_emisor = int(afip_cfg["cuit"].replace("-", ""))
-        auth = {"Token": token, "Sign": sign, "Cuit": cuit_emisor}
-
-        # ── Obtener próximo número de comprobante ──────────────────────────────
-        def _get_ultimo():
-            client = zeep.Client(wsfe_url)
-            result = client.service.FECompUltimoAutorizado(
-                Auth=auth,
-                PtoVta=afip_cfg["punto_venta"],
-                CbteTipo=tipo_cbte,
-            )
-            if result.Errors:
-                msgs = [f"{e.Code}: {e.Msg}" for e in result.Errors.Err]
-                raise RuntimeError(f"WSFE FECompUltimoAutorizado error: {'; '.join(msgs)}")
-            return result.CbteNro
-
-        ultimo_nro = await asyncio.to_thread(_get_ultimo)
-        nro_cbte = ultimo_nro + 1
-
+        """Arma el FECAEDetRequest de un comprobante, sin número (lo pone quien arma el lote)."""
         # ── Receptor ──────────────────────────────────────────────────────────
         # CondicionIVAReceptorId obligatorio desde RG 5616
         # 1=Resp.Inscripto  5=Consumidor Final  6=Monotributista
@@ -255,7 +240,7 @@ class AfipService:
         TIPOS_CON_CUIT = {1, 3}
         if tipo_cbte in TIPOS_CON_CUIT:
             if not cuit_receptor:
-                raise RuntimeError(
+                raise AfipRechazo(
                     "Comprobante clase A requiere CUIT del receptor. "
                     "La venta original no tiene CUIT registrado."
                 )
@@ -267,8 +252,6 @@ class AfipService:
             doc_nro = 0
             cond_iva_receptor = 5   # Consumidor Final
 
-        fecha_cbte = datetime.now(timezone.utc).strftime("%Y%m%d")
-
         # ── Importes ──────────────────────────────────────────────────────────
         # imp_neto e imp_iva se calculan DESDE el total final para que la ecuación
         # ImpTotal = ImpNeto + ImpIVA + ImpTrib cuadre aunque haya descuentos/recargos.
@@ -301,35 +284,131 @@ class AfipService:
         if tipo_cbte != 11 and imp_iva > 0:
             iva_array = {"AlicIva": [{"Id": alicuota_id, "BaseImp": imp_neto, "Importe": imp_iva}]}
 
-        concepto = afip_cfg.get("concepto_default", 1)
+        return {
+            "Concepto":    afip_cfg.get("concepto_default", 1),
+            "DocTipo":     doc_tipo,
+            "DocNro":      doc_nro,
+            "CbteFch":     fecha_cbte,
+            "ImpTotal":    imp_total,
+            "ImpTotConc":  0.0,
+            "ImpNeto":     imp_neto,
+            "ImpOpEx":     0.0,
+            "ImpIVA":      imp_iva,
+            "ImpTrib":     imp_trib,
+            "MonId":                  "PES",
+            "MonCotiz":               1.0,
+            "CondicionIVAReceptorId": cond_iva_receptor,
+            **({"Iva": iva_array} if iva_array else {}),
+            **({"CbtesAsoc": {"CbteAsoc": cbtes_asoc}} if cbtes_asoc else {}),
+        }
+
+    async def _wsfe(self, operacion: str, llamada):
+        """Corre una llamada SOAP a WSFE en un thread. Lo que falla por conexión o
+        credenciales es AfipNoDisponible; un pedido inválido o rechazado, AfipRechazo."""
+        import zeep
+
+        try:
+            result = await asyncio.to_thread(llamada)
+        except (zeep.exceptions.ValidationError, TypeError, ValueError) as e:
+            raise AfipRechazo(f"{operacion}: el pedido no es válido: {e}")
+        except Exception as e:
+            raise AfipNoDisponible(f"Error en {operacion}: {e}")
+        if result.Errors:
+            msgs = "; ".join(f"{e.Code}: {e.Msg}" for e in result.Errors.Err)
+            if any(int(e.Code) in _WSFE_ERRORES_AUTH for e in result.Errors.Err):
+                raise AfipNoDisponible(f"WSFE {operacion}: {msgs}")
+            raise AfipRechazo(f"WSFE {operacion}: {msgs}")
+        return result
+
+    async def solicitar_cae(
+        self,
+        sale: dict,
+        afip_cfg: dict,
+        token: str,
+        sign: str,
+        tipo_cbte: int,
+        cuit_receptor: Optional[str] = None,
+        cbtes_asoc: Optional[list] = None,
+    ) -> dict:
+        """
+        Solicita CAE para una venta via FECAESolicitar.
+        Retorna dict con cae, cae_vencimiento, nro_comprobante.
+        tipo_cbte: 1=Factura A, 6=Factura B, 11=Factura C
+        """
+        [resultado] = await self.solicitar_cae_lote(
+            [{"sale": sale, "cuit_receptor": cuit_receptor, "cbtes_asoc": cbtes_asoc}],
+            afip_cfg, token, sign, tipo_cbte,
+        )
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+    async def solicitar_cae_lote(
+        self,
+        comprobantes: List[dict],
+        afip_cfg: dict,
+        token: str,
+        sign: str,
+        tipo_cbte: int,
+    ) -> list:
+        """
+        Solicita CAE para varios comprobantes del mismo tipo y punto de venta en un solo
+        FECAESolicitar (un FECompUltimoAutorizado para todo el lote, números correlativos).
+        Cada comprobante es {"sale", "cuit_receptor", "cbtes_asoc"}. Retorna una lista
+        alineada con la entrada: el dict del CAE, o AfipRechazo si AFIP lo rechazó o no
+        se pudo armar (si AFIP rechaza el pedido entero, todos llevan ese rechazo).
+        Si no se pudo hablar con AFIP (conexión, autenticación) lanza AfipNoDisponible.
+        """
+        try:
+            import zeep
+        except ImportError:
+            raise RuntimeError("La librería 'zeep' no está instalada.")
+
+        _, wsfe_url = self._get_urls(afip_cfg["ambiente"])
+        cuit_emisor = int(afip_cfg["cuit"].replace("-", ""))
+        auth = {"Token": token, "Sign": sign, "Cuit": cuit_emisor}
+        fecha_cbte = datetime.now(timezone.utc).strftime("%Y%m%d")
+
+        resultados: list = [None] * len(comprobantes)
+        detalles, posiciones = [], []
+        for i, cbte in enumerate(comprobantes):
+            try:
+                detalles.append(self._detalle(
+                    cbte["sale"], afip_cfg, tipo_cbte, fecha_cbte,
+                    cuit_receptor=cbte.get("cuit_receptor"), cbtes_asoc=cbte.get("cbtes_asoc"),
+                ))
+                posiciones.append(i)
+            except AfipRechazo as e:
+                resultados[i] = e
+            except (KeyError, TypeError, ValueError) as e:
+                resultados[i] = AfipRechazo(f"No se pudo armar el comprobante: {e!r}")
+        if not detalles:
+            return resultados
+
+        # ── Obtener próximo número de comprobante ──────────────────────────────
+        def _get_ultimo():
+            client = zeep.Client(wsfe_url)
+            return client.service.FECompUltimoAutorizado(
+                Auth=auth,
+                PtoVta=afip_cfg["punto_venta"],
+                CbteTipo=tipo_cbte,
+            )
+
+        try:
+            ultimo_nro = (await self._wsfe("FECompUltimoAutorizado", _get_ultimo)).CbteNro
+        except AfipRechazo as e:
+            # AFIP rechazó el pedido entero: cada comprobante lleva ese rechazo
+            return [r if r is not None else e for r in resultados]
+        for n, detalle in enumerate(detalles, start=1):
+            detalle["CbteDesde"] = detalle["CbteHasta"] = ultimo_nro + n
 
         fe_cae_req = {
             "FeCabReq": {
-                "CantReg": 1,
+                "CantReg": len(detalles),
                 "PtoVta": afip_cfg["punto_venta"],
                 "CbteTipo": tipo_cbte,
             },
-            "FeDetReq": {
-                "FECAEDetRequest": [{
-                    "Concepto":    concepto,
-                    "DocTipo":     doc_tipo,
-                    "DocNro":      doc_nro,
-                    "CbteDesde":   nro_cbte,
-                    "CbteHasta":   nro_cbte,
-                    "CbteFch":     fecha_cbte,
-                    "ImpTotal":    imp_total,
-                    "ImpTotConc":  0.0,
-                    "ImpNeto":     imp_neto,
-                    "ImpOpEx":     0.0,
-                    "ImpIVA":      imp_iva,
-                    "ImpTrib":     imp_trib,
-                    "MonId":                  "PES",
-                    "MonCotiz":               1.0,
-                    "CondicionIVAReceptorId": cond_iva_receptor,
-                    **({"Iva": iva_array} if iva_array else {}),
-                    **({"CbtesAsoc": {"CbteAsoc": cbtes_asoc}} if cbtes_asoc else {}),
-                }]
-            },
+            "FeDetReq": {"FECAEDetRequest": detalles},
         }
 
         # ── Solicitar CAE ──────────────────────────────────────────────────────
@@ -338,31 +417,30 @@ class AfipService:
             return client.service.FECAESolicitar(Auth=auth, FeCAEReq=fe_cae_req)
 
         try:
-            result = await asyncio.to_thread(_do_cae)
-        except Exception as e:
-            raise RuntimeError(f"Error en FECAESolicitar: {e}")
-
-        if result.Errors:
-            msgs = [f"{e.Code}: {e.Msg}" for e in result.Errors.Err]
-            raise RuntimeError(f"WSFE error: {'; '.join(msgs)}")
-
-        det = result.FeDetResp.FECAEDetResponse[0]
-
-        if det.Resultado == "R":
-            obs = []
-            if det.Observaciones:
-                obs = [f"{o.Code}: {o.Msg}" for o in det.Observaciones.Obs]
-            raise RuntimeError(f"AFIP rechazó el comprobante: {'; '.join(obs)}")
-
-        if not det.CAE:
-            raise RuntimeError("AFIP no devolvió CAE. Resultado: " + str(det.Resultado))
-
-        return {
-            "cae":              det.CAE,
-            "cae_vencimiento":  det.CAEFchVto,   # "AAAAMMDD"
-            "nro_comprobante":  nro_cbte,
-            "tipo_comprobante": tipo_cbte,
-        }
+            result = await self._wsfe("FECAESolicitar", _do_cae)
+        except AfipRechazo as e:
+            # AFIP rechazó el pedido entero: cada comprobante lleva ese rechazo
+            return [r if r is not None else e for r in resultados]
+
+        for i, det in zip(posiciones, result.FeDetResp.FECAEDetResponse):
+            if det.Resultado == "R":
+                obs = []
+                if det.Observaciones:
+                    obs = [f"{o.Code}: {o.Msg}" for o in det.Observaciones.Obs]
+                resultados[i] = AfipRechazo(f"AFIP rechazó el comprobante: {'; '.join(obs)}")
+            elif not det.CAE:
+                resultados[i] = AfipRechazo("AFIP no devolvió CAE. Resultado: " + str(det.Resultado))
+            else:
+                resultados[i] = {
+                    "cae":              det.CAE,
+                    "cae_vencimiento":  det.CAEFchVto,   # "AAAAMMDD"
+                    "nro_comprobante":  det.CbteDesde,
+                    "tipo_comprobante": tipo_cbte,
+                }
+        for i in posiciones:
+            if resultados[i] is None:
+                resultados[i] = AfipRechazo("AFIP no devolvió respuesta para el comprobante.")
+        return resultados
 
     # ── WS_SR_PADRON_A4 ───────────────────────────────────────────────────────
 
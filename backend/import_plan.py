@@ -0,0 +1,249 @@
+"""
+Plan de importación de productos: la planilla contra el catálogo actual, en bloque.
+
+Las listas de proveedores se vuelven a subir enteras y casi todas las filas vienen
+iguales. En vez de reescribir cada producto, se cruza la planilla con el catálogo de
+la empresa por código de barras con operaciones vectorizadas de pandas y cada fila
+queda clasificada:
+
+- nuevo:          el código no existe (o viene vacío y se genera un INT-...)
+- cambio_precio:  cambia el precio del producto o el de alguna sucursal
+- cambio_costo:   cambia el costo / margen de alguna sucursal
+- modificado:     cambian otros datos (nombre, tipo, clase, categoría, stock, mínimo)
+- sin_cambios:    la importación no escribiría nada
+- duplicado:      el código se repite más abajo en el lote y esa fila manda
+- invalido:       la fila no se puede importar (precio, stock o costo no numéricos)
+
+La planilla se planifica por lotes a medida que se lee (nunca entera en memoria).
+normalizar es la única lectura de los valores de cada fila: import_products escribe
+lo que devuelve, así que el plan y la importación no pueden diferir.
+"""
+
+import json
+from typing import Dict, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+NUEVO = "nuevo"
+CAMBIO_PRECIO = "cambio_precio"
+CAMBIO_COSTO = "cambio_costo"
+MODIFICADO = "modificado"
+SIN_CAMBIOS = "sin_cambios"
+DUPLICADO = "duplicado"
+INVALIDO = "invalido"
+ESTADOS = [NUEVO, CAMBIO_PRECIO, CAMBIO_COSTO, MODIFICADO, SIN_CAMBIOS, DUPLICADO, INVALIDO]
+
+# Filas que import_products puede saltear sin cambiar el resultado final
+OMITIBLES = {SIN_CAMBIOS, DUPLICADO}
+
+_TOL = 1e-6
+
+
+def _columna(hoja: pd.DataFrame, nombre: str) -> pd.Series:
+    if nombre in hoja.columns:
+        return hoja[nombre]
+    return pd.Series([None] * len(hoja), index=hoja.index, dtype=object)
+
+
+def _texto(s: pd.Series) -> pd.Series:
+    # Igual que str(valor).strip(): None -> "None", NaN -> "nan"
+    return s.astype(str).str.strip()
+
+
+def _vacio(s: pd.Series) -> pd.Series:
+    return s.isna() | _texto(s).isin(["", "nan"])
+
+
+def _numero(s: pd.Series, default: Optional[float]):
+    """(valores, inválidos): vacío -> default; no numérico o infinito -> inválido."""
+    vacio = _vacio(s)
+    num = pd.to_numeric(_texto(s), errors="coerce").astype(float)
+    invalido = ~vacio & ~np.isfinite(num.fillna(np.inf))
+    valores = num.where(~vacio, np.nan if default is None else default)
+    return valores, invalido
+
+
+def _bool(mascara: pd.Series) -> np.ndarray:
+    return mascara.to_numpy(dtype=bool, na_value=False)
+
+
+def _distinto(a: pd.Series, b: pd.Series) -> pd.Series:
+    a = pd.to_numeric(a, errors="coerce").astype(float)
+    b = pd.to_numeric(b, errors="coerce").astype(float)
+    return ~((a - b).abs() <= _TOL) & ~(a.isna() & b.isna())
+
+
+def normalizar(hoja: pd.DataFrame, categorias: Dict[str, str], redondeo: float) -> pd.DataFrame:
+    """Valores de cada fila tal como se importan.
+
+    hoja:       una fila por fila de la planilla, columna "linea" + columnas del archivo
+    categorias: nombre de categoría en minúsculas -> id
+
+    Devuelve linea, codigo_barras (None si viene vacío), nombre, tipo, kind, stock,
+    stock_minimo, precio (redondeado), costo, margen, categoria, categoria_id y error
+    ("" si la fila se puede importar).
+    """
+    hoja = hoja.reset_index(drop=True)
+    plan = pd.DataFrame({"linea": hoja["linea"].astype(int)})
+
+    raw_cb = _columna(hoja, "codigo_barras")
+    cb_vacio = _vacio(raw_cb)
+    cb_texto = _texto(raw_cb)
+    cb_num = pd.to_numeric(cb_texto, errors="coerce").astype(float)
+    cb_entero = cb_num.notna() & np.isfinite(cb_num.fillna(np.inf)) & (cb_num.abs() < 9e18)
+    codigo = cb_texto.copy()
+    codigo[cb_entero] = cb_num[cb_entero].astype("int64").astype(str)
+    codigo[cb_vacio] = None
+    plan["codigo_barras"] = codigo
+
+    plan["nombre"] = _texto(_columna(hoja, "nombre"))
+    tipo = _texto(_columna(hoja, "tipo"))
+    plan["tipo"] = tipo.where(tipo.isin(["codigo_barras", "por_peso"]), "codigo_barras")
+    plan["kind"] = np.where(_texto(_columna(hoja, "clase")).str.lower() == "combo", "combo", "normal")
+
+    stock, stock_inv = _numero(_columna(hoja, "stock"), 0)
+    stock_minimo, minimo_inv = _numero(_columna(hoja, "stock_minimo"), 10)
+    plan["stock"] = np.trunc(stock)
+    plan["stock_minimo"] = np.trunc(stock_minimo)
+
+    precio = pd.to_numeric(_texto(_columna(hoja, "precio")), errors="coerce").astype(float)
+    precio_inv = ~np.isfinite(precio.fillna(np.inf))
+    if redondeo:
+        plan["precio"] = np.ceil(precio / redondeo) * redondeo
+    else:
+        plan["precio"] = precio.round(2)
+
+    costo, costo_inv = _numero(_columna(hoja, "precio_costo"), None)
+    plan["costo"] = costo
+    con_margen = costo.notna() & (costo != 0)
+    plan["margen"] = ((plan["precio"] - costo) / costo * 100).round(2).where(con_margen)
+
+    categoria = _texto(_columna(hoja, "categoria"))
+    plan["categoria"] = categoria
+    plan["categoria_id"] = categoria.str.lower().map(categorias)
+
+    plan["error"] = np.select(
+        [precio_inv, stock_inv, minimo_inv, costo_inv],
+        ["precio inválido", "stock inválido", "stock_minimo inválido", "precio_costo inválido"],
+        default="",
+    )
+    return plan
+
+
+def planificar(
+    hoja: pd.DataFrame,
+    catalogo: pd.DataFrame,
+    sucursales: pd.DataFrame,
+    categorias: Dict[str, str],
+    redondeo: float,
+) -> pd.DataFrame:
+    """Clasifica cada fila de la planilla (las columnas de normalizar más estado,
+    product_id, precio_actual y costo_actual).
+
+    catalogo:   productos de la empresa (id, codigo_barras, nombre, tipo, kind, precio,
+                categoria_id, stock, stock_minimo)
+    sucursales: agregado de branch_products por product_id (n_bp, precio_min/max,
+                costo_min/max, sin_costo, margen_min/max, sin_margen)
+    """
+    plan = normalizar(hoja, categorias, redondeo)
+    invalido = plan["error"] != ""
+
+    # Entre filas válidas con el mismo código manda la última (como en la importación)
+    validas_cb = ~invalido & plan["codigo_barras"].notna()
+    duplicado = validas_cb & plan["codigo_barras"].where(validas_cb).duplicated(keep="last")
+
+    # --- Cruce con el catálogo ---
+    cat = catalogo.merge(sucursales, how="left", left_on="id", right_on="product_id")
+    cat = cat.drop_duplicates("codigo_barras").set_index("codigo_barras")
+    actual = cat.reindex(plan["codigo_barras"].where(plan["codigo_barras"].notna(), "")).reset_index(drop=True)
+    existe = actual["id"].notna()
+    plan["product_id"] = actual["id"]
+    plan["precio_actual"] = actual["precio"]
+    plan["costo_actual"] = actual["costo_max"]
+
+    con_bp = pd.to_numeric(actual["n_bp"], errors="coerce").fillna(0) > 0
+    cambia_precio = _distinto(plan["precio"], actual["precio"]) | (
+        con_bp & (_distinto(plan["precio"], actual["precio_min"]) | _distinto(plan["precio"], actual["precio_max"]))
+    )
+    cambia_costo = con_bp & plan["costo"].notna() & (
+        (pd.to_numeric(actual["sin_costo"], errors="coerce").fillna(0) > 0)
+        | _distinto(plan["costo"], actual["costo_min"])
+        | _distinto(plan["costo"], actual["costo_max"])
+        | (plan["margen"].notna() & (
+            (pd.to_numeric(actual["sin_margen"], errors="coerce").fillna(0) > 0)
+            | _distinto(plan["margen"], actual["margen_min"])
+            | _distinto(plan["margen"], actual["margen_max"])
+        ))
+    )
+    cambia_otros = (
+        (plan["nombre"] != actual["nombre"].fillna("").astype(str))
+        | (plan["tipo"] != actual["tipo"].fillna("codigo_barras").astype(str))
+        | (plan["kind"] != actual["kind"].fillna("normal").astype(str))
+        | (plan["categoria_id"].fillna("") != actual["categoria_id"].fillna("").astype(str))
+        | plan["categoria_id"].isna()
+        | _distinto(plan["stock"], pd.to_numeric(actual["stock"], errors="coerce").fillna(0))
+        | _distinto(plan["stock_minimo"], pd.to_numeric(actual["stock_minimo"], errors="coerce").fillna(0))
+    )
+
+    plan["estado"] = np.select(
+        [_bool(m) for m in (invalido, duplicado, ~existe, cambia_precio, cambia_costo, cambia_otros)],
+        [INVALIDO, DUPLICADO, NUEVO, CAMBIO_PRECIO, CAMBIO_COSTO, MODIFICADO],
+        default=SIN_CAMBIOS,
+    )
+    return plan
+
+
+def resumen(plan: pd.DataFrame) -> Dict[str, int]:
+    conteo = plan["estado"].value_counts()
+    return {estado: int(conteo.get(estado, 0)) for estado in ESTADOS}
+
+
+_VISIBLES = [
+    "linea", "estado", "codigo_barras", "nombre", "categoria", "precio_actual", "precio",
+    "costo_actual", "costo", "error",
+]
+
+
+class Acumulado:
+    """Resumen y filas para mostrar de una planilla planificada por lotes.
+
+    planificar solo ve duplicados dentro de su lote: un código que reaparece en un lote
+    posterior deja como duplicada a su fila anterior (manda la última, como al
+    importar), así que su cuenta pasa de su estado a DUPLICADO. Se muestran hasta
+    `limite` filas que no sean SIN_CAMBIOS."""
+
+    def __init__(self, limite: int):
+        self.limite = limite
+        self.total = 0
+        self.resumen = dict.fromkeys(ESTADOS, 0)
+        self.filas: list = []
+        self._ultimo: Dict[str, tuple] = {}  # codigo_barras -> (estado, fila mostrada o None)
+
+    def agregar(self, plan: pd.DataFrame) -> None:
+        self.total += len(plan)
+        for estado, cantidad in resumen(plan).items():
+            self.resumen[estado] += cantidad
+        # to_json deja los NaN como null
+        for fila in json.loads(plan[_VISIBLES].to_json(orient="records")):
+            codigo = fila["codigo_barras"]
+            vigente = codigo and fila["estado"] not in (DUPLICADO, INVALIDO)
+            if vigente:
+                previo = self._ultimo.get(codigo)
+                if previo:
+                    self.resumen[previo[0]] -= 1
+                    self.resumen[DUPLICADO] += 1
+                    if previo[1] is not None:
+                        previo[1]["estado"] = DUPLICADO
+            mostrada = None
+            if fila["estado"] != SIN_CAMBIOS and len(self.filas) < self.limite:
+                mostrada = fila
+                self.filas.append(fila)
+            if vigente:
+                self._ultimo[codigo] = (fila["estado"], mostrada)
+
+
+def omitible(fila: dict, tocados: Set[str]) -> bool:
+    """Si import_products puede saltear la fila. El plan compara contra el catálogo del
+    principio: un código ya escrito en un lote anterior (tocados) se escribe igual."""
+    return fila.get("estado") in OMITIBLES and fila["codigo_barras"] not in tocados
@@ -0,0 +1,365 @@
+"""
+Índices de MongoDB: la lista de los que la app necesita y la reconciliación contra la base.
+
+Reemplaza a create_indexes.js. Al arrancar, el server crea los que faltan y avisa en el
+log si algún índice existente difiere de lo declarado (opciones distintas) o sobra.
+Esas diferencias no se corrigen solas, porque rehacer un índice en una colección grande
+es una operación pesada: se corrigen a mano con el CLI. La excepción son los índices
+únicos (restricciones, no solo velocidad): si el existente no es el declarado y los datos
+no tienen duplicados, se rehace al arrancar (construyendo el nuevo antes de borrar el
+viejo, ver reconciliar); si hay duplicados, queda como error con
+ejemplos de las claves repetidas para limpiarlas.
+
+    python indexes.py                      # reporta diferencias, no toca nada
+    python indexes.py --aplicar            # crea los faltantes
+    python indexes.py --aplicar --corregir # además rehace los que tienen otras opciones
+    python indexes.py --borrar-sobrantes   # borra los que no están declarados
+
+Ningún endpoint crea ni borra índices: si hace falta uno nuevo, se agrega acá.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# (colección, claves, opciones). Las opciones van tal cual a create_index.
+INDICES: List[Tuple[str, List[Tuple[str, int]], dict]] = [
+    # ── Productos ──
+    ("products", [("empresa_id", 1), ("activo", 1)], {}),
+    # Código de barras único por empresa; los productos sin código no entran al índice
+    ("products", [("empresa_id", 1), ("codigo_barras", 1)],
+     {"unique": True, "partialFilterExpression": {"codigo_barras": {"$type": "string"}}}),
+    ("products", [("empresa_id", 1), ("kind", 1)], {}),
+    ("products", [("empresa_id", 1), ("categoria_id", 1)], {}),
+    ("products", [("empresa_id", 1), ("control_stock", 1)], {}),
+    ("products", [("id", 1)], {"unique": True}),
+    # Paginación por cursor (orden nombre + id)
+    ("products", [("empresa_id", 1), ("activo", 1), ("nombre", 1), ("id", 1)], {}),
+
+    # ── Productos por sucursal ──
+    ("branch_products", [("product_id", 1), ("branch_id", 1), ("empresa_id", 1)], {"unique": True}),
+    ("branch_products", [("branch_id", 1), ("empresa_id", 1), ("activo", 1)], {}),
+    ("branch_products", [("empresa_id", 1)], {}),
+    # Alertas de stock: solo indexa las filas con bajo_stock (ver _bp_stock_update en server.py)
+    ("branch_products", [("empresa_id", 1), ("activo", 1), ("branch_id", 1), ("created_at", 1), ("id", 1)],
+     {"partialFilterExpression": {"bajo_stock": True}, "name": "bajo_stock_parcial"}),
+    # Paginación por cursor del POS (orden de alta)
+    ("branch_products", [("branch_id", 1), ("empresa_id", 1), ("activo", 1), ("created_at", 1), ("id", 1)], {}),
+
+    # ── Ventas ──
+    ("sales", [("empresa_id", 1), ("fecha", -1)], {}),
+    ("sales", [("empresa_id", 1), ("branch_id", 1), ("fecha", -1)], {}),
+    ("sales", [("empresa_id", 1), ("cajero_id", 1), ("fecha", -1)], {}),
+    ("sales", [("empresa_id", 1), ("session_id", 1), ("fecha", 1), ("id", 1)], {}),
+    ("sales", [("empresa_id", 1), ("afip_estado", 1)], {}),
+    # Backlog AFIP: empresas con pendientes y su recorrido por antigüedad
+    ("sales", [("afip_estado", 1), ("empresa_id", 1), ("fecha", 1), ("id", 1)], {}),
+    # Historial del cliente (cursor fecha + id)
+    ("sales", [("empresa_id", 1), ("cliente_id", 1), ("fecha", -1), ("id", -1)], {}),
+    ("sales", [("id", 1)], {"unique": True}),
+    # Barridos por fecha de todas las empresas (contadores del dashboard, ventas_diarias)
+    ("sales", [("fecha", 1)], {}),
+
+    # ── Devoluciones ──
+    ("sale_returns", [("sale_id", 1), ("empresa_id", 1)], {}),
+    ("sale_returns", [("empresa_id", 1)], {}),
+    ("sale_returns", [("empresa_id", 1), ("fecha", -1)], {}),
+    ("credit_notes", [("sale_id", 1), ("empresa_id", 1)], {}),
+    ("credit_notes", [("empresa_id", 1), ("fecha", -1)], {}),
+    ("credit_notes", [("afip_estado", 1), ("empresa_id", 1), ("fecha", 1)], {}),
+
+    # ── Contadores ──
+    ("dashboard_counters", [("empresa_id", 1), ("dia", 1), ("branch_id", 1)], {"unique": True}),
+    ("onboarding_counts", [("empresa_id", 1)], {"unique": True}),
+    ("count_cache", [("coll", 1), ("empresa_id", 1)], {"unique": True}),
+    ("numeradores", [("empresa_id", 1), ("serie", 1)], {"unique": True}),
+    ("cierres_z", [("empresa_id", 1), ("branch_id", 1), ("desde", 1)], {"unique": True}),
+    ("cierres_z", [("empresa_id", 1), ("dia", 1)], {}),
+    ("cierres_z", [("empresa_id", 1), ("desde", -1), ("id", -1)], {}),
+    ("cliente_resumen", [("empresa_id", 1), ("cliente_id", 1)], {"unique": True}),
+
+    # ── Reposición (ver _acumular_ventas_diarias / _recalcular_reposicion en server.py) ──
+    ("ventas_diarias", [("empresa_id", 1), ("branch_id", 1), ("product_id", 1), ("dia", 1)], {"unique": True}),
+    ("ventas_diarias", [("empresa_id", 1), ("dia", 1)], {}),
+    ("ventas_diarias", [("dia", 1)], {}),
+    ("reposicion", [("id", 1)], {"unique": True}),
+    ("reposicion", [("empresa_id", 1), ("dias_cobertura", 1), ("id", 1)], {}),
+    ("reposicion", [("empresa_id", 1), ("branch_id", 1), ("dias_cobertura", 1), ("id", 1)], {}),
+    ("reposicion", [("empresa_id", 1), ("corrida", 1)], {}),
+
+    # ── Usuarios ──
+    ("users", [("email", 1)], {"unique": True}),
+    ("users", [("empresa_id", 1)], {}),
+    ("users", [("empresa_id", 1), ("rol", 1)], {}),
+    ("users", [("empresa_id", 1), ("branch_id", 1)], {}),
+    ("users", [("id", 1)], {"unique": True}),
+
+    # ── Sesiones y movimientos de caja ──
+    ("cash_sessions", [("empresa_id", 1), ("user_id", 1), ("status", 1)], {}),
+    ("cash_sessions", [("empresa_id", 1), ("branch_id", 1), ("status", 1)], {}),
+    ("cash_sessions", [("empresa_id", 1), ("fecha_apertura", -1), ("id", -1)], {}),
+    ("cash_sessions", [("id", 1)], {"unique": True}),
+    ("cash_movements", [("session_id", 1), ("empresa_id", 1), ("fecha", 1), ("id", 1)], {}),
+
+    # ── Clientes ──
+    ("customers", [("empresa_id", 1), ("nombre", 1), ("id", 1)], {}),
+    # Duplicados por documento (check-documento): exacto y cruce DNI <-> CUIT/CUIL
+    ("customers", [("empresa_id", 1), ("tipo_documento", 1), ("documento_digitos", 1)], {}),
+    ("customers", [("empresa_id", 1), ("documento_dni", 1), ("tipo_documento", 1)], {}),
+
+    # ── Notificaciones ──
+    ("notificaciones", [("empresa_id", 1), ("leida", 1)], {}),
+    # Una alerta por (empresa, tipo, vencimiento): el upsert de las alertas se apoya en esto
+    ("notificaciones", [("empresa_id", 1), ("tipo", 1), ("periodo_ref", 1)],
+     {"unique": True, "partialFilterExpression": {"periodo_ref": {"$gt": ""}}}),
+    ("tareas_corridas", [("tarea", 1), ("inicio", -1)], {}),
+    # Historial de corridas de tareas de fondo: se borra solo a los 90 días
+    ("tareas_corridas", [("inicio", 1)], {"expireAfterSeconds": 90 * 24 * 60 * 60}),
+
+    # ── Suscripciones y pagos ──
+    ("suscripciones", [("empresa_id", 1)], {"unique": True}),
+    ("suscripciones", [("status", 1)], {}),
+    ("suscripciones", [("mp_preapproval_id", 1)], {}),
+    ("pagos_suscripcion", [("empresa_id", 1), ("estado", 1)], {}),
+    ("pagos_suscripcion", [("mp_payment_id", 1)], {}),
+    ("pagos_suscripcion", [("mp_preference_id", 1)], {}),
+    ("pagos_suscripcion", [("mp_preapproval_id", 1)], {}),
+    ("pagos_suscripcion", [("estado", 1)], {}),
+
+    # ── Sucursales y categorías ──
+    ("branches", [("empresa_id", 1), ("activo", 1)], {}),
+    ("branches", [("id", 1)], {"unique": True}),
+    ("categories", [("empresa_id", 1)], {}),
+    ("categories", [("empresa_id", 1), ("nombre", 1)], {"unique": True}),
+    ("categories", [("id", 1)], {"unique": True}),
+
+    # ── Compras / Proveedores ──
+    ("compras", [("empresa_id", 1), ("fecha", -1)], {}),
+    ("compras", [("empresa_id", 1), ("proveedor_id", 1)], {}),
+    ("compras", [("id", 1)], {"unique": True}),
+    ("proveedores", [("empresa_id", 1)], {}),
+    ("proveedores", [("id", 1)], {"unique": True}),
+
+    # ── Configuración ──
+    ("configuration", [("empresa_id", 1)], {"unique": True}),
+    ("system_config", [("key", 1)], {"unique": True}),
+    ("afip_config", [("empresa_id", 1), ("activo", 1)], {}),
+    ("afip_config", [("empresa_id", 1)], {"unique": True}),
+
+    # ── Empresas ──
+    ("empresas", [("id", 1)], {"unique": True}),
+    ("empresas", [("created_at", -1), ("id", -1)], {}),
+    ("empresas", [("activo", 1), ("email_verificado", 1)], {}),
+
+    # ── OTPs / resets (TTL: MongoDB borra los documentos expirados automáticamente) ──
+    ("email_otps", [("email", 1)], {}),
+    ("email_otps", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("password_resets", [("email", 1)], {}),
+    ("password_resets", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+]
+
+# Opciones que cuentan para decidir si un índice existente es "el mismo"
+_OPCIONES = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def nombre_indice(claves: List[Tuple[str, int]], opciones: Optional[dict] = None) -> str:
+    if opciones and opciones.get("name"):
+        return opciones["name"]
+    return "_".join(f"{campo}_{direccion}" for campo, direccion in claves)
+
+
+def _claves(info: dict) -> List[Tuple[str, int]]:
+    # mongosh guarda las direcciones como double (1.0); se comparan como enteros
+    return [(campo, int(direccion)) for campo, direccion in info["key"]]
+
+
+def _opciones(info: dict) -> dict:
+    opciones = {k: info[k] for k in _OPCIONES if k in info}
+    if not opciones.get("unique"):
+        opciones.pop("unique", None)
+    if not opciones.get("sparse"):
+        opciones.pop("sparse", None)
+    return opciones
+
+
+async def revisar(db) -> Dict[str, list]:
+    """Compara los índices declarados con los de la base, sin tocar nada."""
+    drift = {"faltantes": [], "distintos": [], "sobrantes": []}
+    por_coleccion: Dict[str, list] = {}
+    for coleccion, claves, opciones in INDICES:
+        por_coleccion.setdefault(coleccion, []).append((claves, opciones))
+
+    for coleccion, declarados in por_coleccion.items():
+        try:
+            existentes = await db[coleccion].index_information()
+        except OperationFailure:
+            existentes = {}  # la colección todavía no existe
+        usados = {"_id_"}
+        for claves, opciones in declarados:
+            nombre = nombre_indice(claves, opciones)
+            info = existentes.get(nombre)
+            if info is None:
+                # Mismas claves con otro nombre: es el mismo índice declarado distinto
+                nombre_real = next((n for n, i in existentes.items() if n not in usados and _claves(i) == claves), None)
+                info = existentes.get(nombre_real) if nombre_real else None
+                if info is not None:
+                    nombre = nombre_real
+            esperado = {k: v for k, v in opciones.items() if k != "name"}
+            item = {"coleccion": coleccion, "nombre": nombre, "claves": claves, "opciones": esperado}
+            if info is None:
+                drift["faltantes"].append(item)
+                continue
+            usados.add(nombre)
+            actual = _opciones(info)
+            if _claves(info) != claves or actual != esperado or nombre != nombre_indice(claves, opciones):
+                drift["distintos"].append({**item, "actual": {"nombre": nombre, "claves": _claves(info), "opciones": actual}})
+        for nombre, info in existentes.items():
+            if nombre not in usados:
+                drift["sobrantes"].append({"coleccion": coleccion, "nombre": nombre, "claves": _claves(info), "opciones": _opciones(info)})
+    return drift
+
+
+async def duplicados(db, item: dict, limite: int = 5) -> list:
+    """Claves repetidas que impedirían crear el índice único de `item` (hasta `limite`)."""
+    pipeline = []
+    if item["opciones"].get("partialFilterExpression"):
+        pipeline.append({"$match": item["opciones"]["partialFilterExpression"]})
+    pipeline += [
+        {"$group": {"_id": {campo: f"${campo}" for campo, _ in item["claves"]}, "cantidad": {"$sum": 1}}},
+        {"$match": {"cantidad": {"$gt": 1}}},
+        {"$limit": limite},
+    ]
+    return await db[item["coleccion"]].aggregate(pipeline, allowDiskUse=True).to_list(limite)
+
+
+async def reconciliar(
+    db, crear: bool = True, corregir: bool = False, borrar_sobrantes: bool = False, migrar_unicos: bool = False,
+) -> Dict[str, list]:
+    """Lleva la base a lo declarado según lo pedido y devuelve el drift que quedó.
+    Con migrar_unicos rehace, si los datos lo permiten, los distintos que declaran unique."""
+    drift = await revisar(db)
+    errores = []
+
+    async def _crear(item):
+        opciones = {**item["opciones"], "name": item["nombre"]}
+        await db[item["coleccion"]].create_index(item["claves"], **opciones)
+
+    async def _rehacer(item):
+        # Primero se construye el reemplazo con un nombre temporal y un filtro parcial
+        # equivalente (mismos docs, pero distinto, así convive con el viejo y después con
+        # el definitivo). El viejo se borra recién cuando el temporal ya garantiza la
+        # unicidad, y el temporal cuando ya está el definitivo: nunca queda un hueco. Si
+        # entró un duplicado, falla la construcción del temporal y el viejo sigue igual.
+        actual = item["actual"]
+        nombre = nombre_indice(item["claves"], item["opciones"])
+        if not item["opciones"].get("unique") and not actual["opciones"].get("unique"):
+            # Sin unicidad en juego alcanza con borrar y crear (solo se pierde velocidad)
+            await db[item["coleccion"]].drop_index(actual["nombre"])
+            await _crear({**item, "nombre": nombre})
+            return
+        filtro = item["opciones"].get("partialFilterExpression") or {}
+        temporal = {
+            "coleccion": item["coleccion"],
+            "nombre": f"{nombre}_migracion",
+            "claves": item["claves"],
+            "opciones": {
+                **{k: v for k, v in item["opciones"].items() if k != "sparse"},
+                "partialFilterExpression": {**filtro, "_id": {"$exists": True}},
+            },
+        }
+        await _crear(temporal)
+        await db[item["coleccion"]].drop_index(actual["nombre"])
+        await _crear({**item, "nombre": nombre})
+        await db[item["coleccion"]].drop_index(temporal["nombre"])
+
+    if crear:
+        for item in drift["faltantes"]:
+            try:
+                await _crear(item)
+                logger.info(f"Índice creado: {item['coleccion']}.{item['nombre']}")
+            except OperationFailure as e:
+                error = str(e)
+                if e.code == 11000:
+                    ejemplos = ", ".join(str(r["_id"]) for r in await duplicados(db, item))
+                    error = f"hay claves duplicadas, no se puede hacer único (por ejemplo {ejemplos})"
+                errores.append({**item, "error": error})
+    if migrar_unicos and not corregir:
+        for item in drift["distintos"]:
+            if not item["opciones"].get("unique"):
+                continue
+            try:
+                repetidos = await duplicados(db, item)
+                if repetidos:
+                    ejemplos = ", ".join(str(r["_id"]) for r in repetidos)
+                    errores.append({**item, "error": f"hay claves duplicadas, no se puede hacer único (por ejemplo {ejemplos})"})
+                    continue
+                await _rehacer(item)
+                logger.info(f"Índice migrado: {item['coleccion']}.{item['nombre']}")
+            except OperationFailure as e:
+                errores.append({**item, "error": str(e)})
+    if corregir:
+        for item in drift["distintos"]:
+            try:
+                await _rehacer(item)
+                logger.info(f"Índice rehecho: {item['coleccion']}.{item['nombre']}")
+            except OperationFailure as e:
+                errores.append({**item, "error": str(e)})
+    if borrar_sobrantes:
+        for item in drift["sobrantes"]:
+            try:
+                await db[item["coleccion"]].drop_index(item["nombre"])
+                logger.info(f"Índice borrado: {item['coleccion']}.{item['nombre']}")
+            except OperationFailure as e:
+                errores.append({**item, "error": str(e)})
+
+    drift = await revisar(db)
+    drift["errores"] = errores
+    return drift
+
+
+def _imprimir(drift: Dict[str, list]) -> None:
+    titulos = {"faltantes": "Faltan", "distintos": "Con otras opciones", "sobrantes": "No declarados", "errores": "Errores"}
+    for clave, titulo in titulos.items():
+        items = drift.get(clave) or []
+        print(f"{titulo}: {len(items)}")
+        for item in items:
+            detalle = f"  - {item['coleccion']}.{item['nombre']}  {dict(item['claves'])}  {item['opciones']}"
+            if "actual" in item:
+                detalle += f"  (hoy: {item['actual']['nombre']} {item['actual']['opciones']})"
+            if "error" in item:
+                detalle += f"  ERROR: {item['error']}"
+            print(detalle)
+
+
+async def _main(args) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    try:
+        if args.aplicar or args.corregir or args.borrar_sobrantes:
+            drift = await reconciliar(db, crear=args.aplicar, corregir=args.corregir, borrar_sobrantes=args.borrar_sobrantes)
+        else:
+            drift = await revisar(db)
+    finally:
+        client.close()
+    _imprimir(drift)
+    pendientes = drift["faltantes"] or drift["distintos"] or drift.get("errores")
+    return 1 if pendientes else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Revisa y reconcilia los índices de MongoDB")
+    parser.add_argument("--aplicar", action="store_true", help="crea los índices faltantes")
+    parser.add_argument("--corregir", action="store_true", help="rehace los índices con opciones distintas")
+    parser.add_argument("--borrar-sobrantes", action="store_true", help="borra los índices no declarados")
+    raise SystemExit(asyncio.run(_main(parser.parse_args())))
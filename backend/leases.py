@@ -0,0 +1,50 @@
+"""
+Leases en MongoDB: que una tarea de fondo corra en un solo proceso a la vez.
+
+Cada worker de uvicorn ejecuta startup_tasks, así que todas las tareas periódicas
+arrancan una vez por proceso. Las que no deben repetirse toman antes un lease: un
+documento de la colección leases con el dueño y hasta cuándo vale. Lo obtiene quien lo
+encuentra vencido (o quien ya lo tenía, que así lo renueva); los demás siguen de largo.
+Si el dueño se cae sin soltarlo, el lease vence solo al cumplirse el ttl.
+
+El dueño es un token por corrida (nuevo_duenio), no el proceso: dos corridas del mismo
+worker son dueños distintos y se excluyen igual que dos workers.
+
+La toma es un único update con upsert filtrado por "vencido o mío". Si el documento
+existe y es de otro, el filtro no matchea, el upsert intenta insertar el mismo _id y Mongo
+responde DuplicateKeyError: eso significa que no se obtuvo.
+"""
+
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+# Identifica a este proceso; va como prefijo de los dueños para saber de dónde vienen
+INSTANCIA = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def nuevo_duenio() -> str:
+    """Token de dueño para una corrida (o un holder de larga vida, como el líder)."""
+    return f"{INSTANCIA}:{uuid.uuid4().hex[:12]}"
+
+
+async def tomar(db, nombre: str, ttl: timedelta, duenio: str) -> bool:
+    """Toma (o renueva) el lease por ttl. Devuelve False si lo tiene otro dueño."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.leases.update_one(
+            {"_id": nombre, "$or": [{"hasta": {"$lte": now}}, {"duenio": duenio}]},
+            {"$set": {"duenio": duenio, "hasta": now + ttl, "renovado": now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def soltar(db, nombre: str, duenio: str) -> None:
+    """Libera el lease si sigue siendo de este dueño."""
+    await db.leases.delete_one({"_id": nombre, "duenio": duenio})
@@ -0,0 +1,179 @@
+"""
+Eventos en tiempo real por empresa (ventas, devoluciones, cajas, alertas de stock).
+
+Un solo change stream de MongoDB por proceso (mientras haya alguna conexión abierta),
+repartido (fan-out) por empresa_id a las conexiones SSE de cada empresa. Así el
+dashboard se actualiza al instante sin volver a pedir /dashboard/stats cada tantos
+minutos, y la carga sobre Mongo no crece con la cantidad de empresas conectadas: cada
+escritura hace a lo sumo un updateLookup, y los updates que no tocan campos del evento
+se descartan por updateDescription antes de llegar a eso.
+
+Los change streams requieren replica set: en local usar scripts/mongo-replset.sh.
+Si el servidor es standalone, el hub lo detecta y avisa con un evento "no_disponible"
+para que el front siga con su polling de siempre.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Colecciones que se escuchan y los campos que viajan en cada evento
+# (se proyectan en el pipeline para no mandar items/payloads AFIP por la red).
+_CAMPOS = {
+    "sales": ["id", "branch_id", "total", "numero_factura", "metodo_pago", "fecha", "estado"],
+    "sale_returns": ["id", "sale_id", "branch_id", "total", "numero_devolucion", "fecha"],
+    "cash_sessions": ["id", "branch_id", "user_id", "status", "monto_ventas", "monto_retiros", "fecha_apertura", "fecha_cierre"],
+    "branch_products": ["id", "product_id", "branch_id", "stock", "stock_minimo", "activo", "bajo_stock"],
+}
+
+# Campos cuyo cambio dispara un evento en un update (los demás updates no se miran)
+_CAMPOS_UPDATE = {
+    "sales": ["total", "estado", "metodo_pago"],
+    "sale_returns": ["total"],
+    "cash_sessions": ["status", "monto_ventas", "monto_retiros", "fecha_cierre"],
+    "branch_products": ["stock", "stock_minimo", "activo", "bajo_stock"],
+}
+
+_TIPO_EVENTO = {
+    "sales": "venta",
+    "sale_returns": "devolucion",
+    "cash_sessions": "caja",
+    "branch_products": "alerta_stock",
+}
+
+# Código de error de Mongo cuando se pide un change stream a un servidor standalone
+_CHANGE_STREAM_NO_SOPORTADO = 40573
+
+
+def _serializar(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    return valor
+
+
+def _armar_evento(change: dict) -> Optional[dict]:
+    coll = change.get("ns", {}).get("coll")
+    doc = change.get("fullDocument")
+    if coll not in _TIPO_EVENTO or not doc:
+        return None
+    if coll == "branch_products":
+        # Solo interesan las filas en alerta: el flag bajo_stock que mantiene server.py
+        # (ya excluye combos y productos sin control de stock), igual que /dashboard/stats
+        if not doc.get("activo", True) or not doc.get("bajo_stock"):
+            return None
+    return {
+        "tipo": _TIPO_EVENTO[coll],
+        "operacion": change.get("operationType"),
+        "datos": {k: _serializar(doc.get(k)) for k in _CAMPOS[coll] if k in doc},
+    }
+
+
+class RealtimeHub:
+    """Reparte los eventos de cada empresa a todas sus conexiones abiertas."""
+
+    def __init__(self, db, queue_size: int = 100):
+        self._db = db
+        self._queue_size = queue_size
+        self._subs: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def conexiones(self, empresa_id: str) -> int:
+        return len(self._subs.get(empresa_id, ()))
+
+    def subscribe(self, empresa_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subs.setdefault(empresa_id, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+        return queue
+
+    def unsubscribe(self, empresa_id: str, queue: asyncio.Queue) -> None:
+        subs = self._subs.get(empresa_id)
+        if subs is None:
+            return
+        subs.discard(queue)
+        if not subs:
+            del self._subs[empresa_id]
+        if not self._subs and self._task is not None:
+            # Última conexión del proceso: se corta el change stream
+            self._task.cancel()
+            self._task = None
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        self._subs.clear()
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _publicar(self, empresa_id: str, evento: dict) -> None:
+        for queue in list(self._subs.get(empresa_id, ())):
+            if queue.full():
+                # Cliente lento: se descarta el evento más viejo en vez de frenar al resto
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(evento)
+
+    def _publicar_todos(self, evento: dict) -> None:
+        for empresa_id in list(self._subs):
+            self._publicar(empresa_id, evento)
+
+    @staticmethod
+    def _pipeline() -> list:
+        # El $match no mira fullDocument: solo colección, operación y, en los updates,
+        # qué campos cambiaron. La empresa se resuelve en Python al repartir.
+        updates = [
+            {"ns.coll": coll, "operationType": "update",
+             "$or": [{f"updateDescription.updatedFields.{campo}": {"$exists": True}} for campo in campos]}
+            for coll, campos in _CAMPOS_UPDATE.items()
+        ]
+        proyeccion = {"operationType": 1, "ns": 1, "fullDocument.empresa_id": 1}
+        for campo in sorted({c for campos in _CAMPOS.values() for c in campos}):
+            proyeccion[f"fullDocument.{campo}"] = 1
+        return [
+            {"$match": {"$or": [
+                {"ns.coll": {"$in": list(_CAMPOS)}, "operationType": {"$in": ["insert", "replace"]}},
+                *updates,
+            ]}},
+            {"$project": proyeccion},
+        ]
+
+    async def _watch(self) -> None:
+        resume_token = None
+        espera = 1
+        while self._subs:
+            try:
+                async with self._db.watch(
+                    self._pipeline(),
+                    full_document="updateLookup",
+                    resume_after=resume_token,
+                ) as stream:
+                    espera = 1
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        empresa_id = (change.get("fullDocument") or {}).get("empresa_id")
+                        if empresa_id not in self._subs:
+                            continue
+                        evento = _armar_evento(change)
+                        if evento is not None:
+                            self._publicar(empresa_id, evento)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == _CHANGE_STREAM_NO_SOPORTADO:
+                    logger.warning("Change streams no disponibles (MongoDB sin replica set)")
+                    self._publicar_todos({"tipo": "no_disponible", "operacion": None, "datos": {}})
+                    return
+                logger.error(f"Change stream del dashboard cortado: {e}")
+                resume_token = None
+            except PyMongoError as e:
+                logger.error(f"Change stream del dashboard cortado: {e}")
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30)
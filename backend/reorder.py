@@ -0,0 +1,114 @@
+"""
+Sugerencias de reposición por velocidad de venta, para todo el catálogo de una vez.
+
+Las alertas de stock comparan stock contra un stock_minimo fijo: con los productos que
+rotan rápido avisan tarde y con los lentos avisan de más. Acá la demanda diaria de cada
+(sucursal, producto) sale de las ventas diarias (colección ventas_diarias, que arma
+server.py a partir de las ventas) con un promedio ponderado exponencial: la venta de
+ayer pesa más que la de hace un mes, con una vida media de VIDA_MEDIA_DIAS. Con esa
+demanda:
+
+- dias_cobertura: cuántos días alcanza el stock actual (COBERTURA_MAX si no hay demanda)
+- sugerido:       unidades a pedir para cubrir la entrega más los días de cobertura
+                  objetivo, sin quedar debajo del stock_minimo
+- urgente:        el stock se termina antes de que llegue un pedido hecho hoy
+
+Los combos no tienen stock propio: lo que venden se reparte entre sus componentes
+según combo_items. Las devoluciones no se descuentan (la demanda es bruta).
+
+Todo es pandas vectorizado; server.py trae los datos y escribe el resultado.
+"""
+
+from datetime import date, timedelta
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+DIAS_HISTORIA = 56
+VIDA_MEDIA_DIAS = 7.0
+DIAS_ENTREGA = 7
+DIAS_COBERTURA = 14
+# Días de cobertura que se informan cuando el producto no tiene ventas en la historia
+COBERTURA_MAX = 9999.0
+
+
+def expandir_combos(ventas: pd.DataFrame, combos: pd.DataFrame) -> pd.DataFrame:
+    """Suma a cada componente lo que vendieron los combos que lo incluyen.
+
+    ventas: branch_id, product_id, dia, cantidad
+    combos: combo_id, product_id (componente), cantidad (por combo)
+    """
+    if ventas.empty or combos.empty:
+        return ventas
+    de_combos = ventas.merge(combos, left_on="product_id", right_on="combo_id", suffixes=("_combo", ""))
+    if de_combos.empty:
+        return ventas
+    de_combos["cantidad"] = de_combos["cantidad_combo"] * de_combos["cantidad"]
+    componentes = de_combos[["branch_id", "product_id", "dia", "cantidad"]]
+    return pd.concat([ventas, componentes], ignore_index=True)
+
+
+def demanda_diaria(
+    ventas: pd.DataFrame,
+    hoy: date,
+    dias: int = DIAS_HISTORIA,
+    vida_media: float = VIDA_MEDIA_DIAS,
+) -> pd.DataFrame:
+    """Demanda diaria ponderada por (branch_id, product_id).
+
+    Se usan los `dias` días completos anteriores a `hoy`; un día sin ventas cuenta como
+    cero, por eso el divisor es la suma de todos los pesos y no solo la de los días con
+    ventas."""
+    columnas = ["branch_id", "product_id", "demanda_diaria", "vendidos"]
+    if ventas.empty:
+        return pd.DataFrame(columns=columnas)
+    alfa = 1 - 0.5 ** (1 / vida_media)
+    pesos_total = ((1 - alfa) ** np.arange(dias)).sum()
+
+    ayer = pd.Timestamp(hoy - timedelta(days=1))
+    edad = (ayer - pd.to_datetime(ventas["dia"])).dt.days
+    en_ventana = (edad >= 0) & (edad < dias)
+    v = ventas.loc[en_ventana, ["branch_id", "product_id", "cantidad"]].copy()
+    v["ponderada"] = v["cantidad"].astype(float) * (1 - alfa) ** edad[en_ventana]
+    grupos = v.groupby(["branch_id", "product_id"], as_index=False).agg(
+        ponderada=("ponderada", "sum"), vendidos=("cantidad", "sum")
+    )
+    grupos["demanda_diaria"] = grupos["ponderada"] / pesos_total
+    return grupos[columnas]
+
+
+def sugerir(
+    stock: pd.DataFrame,
+    demanda: pd.DataFrame,
+    dias_entrega: Optional[int] = None,
+    dias_cobertura: Optional[int] = None,
+) -> pd.DataFrame:
+    """Cruza el stock de cada branch_product con su demanda.
+
+    stock:   id, branch_id, product_id, stock, stock_minimo, costo
+    demanda: salida de demanda_diaria
+    """
+    dias_entrega = DIAS_ENTREGA if dias_entrega is None else dias_entrega
+    dias_cobertura = DIAS_COBERTURA if dias_cobertura is None else dias_cobertura
+
+    plan = stock.merge(demanda, how="left", on=["branch_id", "product_id"])
+    plan["demanda_diaria"] = pd.to_numeric(plan["demanda_diaria"], errors="coerce").fillna(0.0)
+    plan["vendidos"] = pd.to_numeric(plan["vendidos"], errors="coerce").fillna(0.0)
+    existencias = pd.to_numeric(plan["stock"], errors="coerce").fillna(0.0)
+    minimo = pd.to_numeric(plan["stock_minimo"], errors="coerce").fillna(0.0)
+    demanda_d = plan["demanda_diaria"].to_numpy()
+
+    con_demanda = demanda_d > 0
+    cobertura = np.divide(
+        np.maximum(existencias.to_numpy(), 0), demanda_d,
+        out=np.full(len(plan), COBERTURA_MAX), where=con_demanda,
+    )
+    plan["dias_cobertura"] = np.minimum(cobertura, COBERTURA_MAX).round(1)
+
+    objetivo = np.maximum(np.ceil(demanda_d * (dias_entrega + dias_cobertura)), minimo.to_numpy())
+    plan["sugerido"] = np.maximum(objetivo - existencias.to_numpy(), 0).astype(int)
+    plan["punto_pedido"] = np.ceil(demanda_d * dias_entrega + minimo.to_numpy()).astype(int)
+    plan["urgente"] = con_demanda & (plan["dias_cobertura"].to_numpy() < dias_entrega)
+    plan["demanda_diaria"] = plan["demanda_diaria"].round(3)
+    return plan
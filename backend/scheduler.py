@@ -0,0 +1,356 @@
+"""
+Tareas programadas de fondo, repartidas entre todos los workers y nodos.
+
+Antes cada tarea periódica era un create_task con un sleep en startup_tasks: corría en
+todos los workers, el horario se corría con cada reinicio y no quedaba registro. Ahora
+server.py registra cada tarea en el Scheduler con su agenda (cron de cinco campos en
+hora argentina, o un intervalo fijo) y el estado vive en la colección jobs, un doc por
+tarea:
+
+- proxima:   cuándo le toca. Es lo único que decide si se corre, así que el horario no
+             depende de cuándo arrancó cada proceso.
+- intentos:  fallos seguidos. Se reintenta con backoff exponencial (sin pasar de la
+             próxima corrida normal) hasta agotar los reintentos de la tarea.
+- ejecuciones, fallos, ultima_corrida: métricas para el panel owner.
+
+Todos los procesos corren el mismo loop, pero solo el que tiene el lease "scheduler" (el
+líder) reclama tareas vencidas. Reclamar es un find_one_and_update que corre proxima un
+ttl hacia adelante: la ocurrencia la toma un solo proceso, y si ese proceso se cae a
+mitad de camino la tarea vuelve a vencer y la toma otro (no se pierde). La corrida en
+sí pasa por correr_tarea, que además toma el lease de la tarea con un dueño propio de
+esa corrida: una corrida manual y una programada de la misma tarea nunca se pisan, ni
+siquiera en el mismo proceso. Mientras la tarea sigue viva, el latido renueva el lease y
+el reclamo (proxima), así una corrida larga no vuelve a vencer ni la reclaman de nuevo.
+Cada corrida queda en tareas_corridas.
+"""
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Set
+
+from pymongo import ReturnDocument
+
+import leases
+
+logger = logging.getLogger(__name__)
+
+# Lo que dura el lease de una tarea en curso; se renueva mientras la tarea sigue viva
+TAREA_LEASE_TTL = timedelta(minutes=10)
+LIDER_LEASE_TTL = timedelta(seconds=60)
+VUELTA_SEG = 15
+
+
+class CronError(ValueError):
+    pass
+
+
+class Cron:
+    """Agenda estilo cron: "minuto hora día-del-mes mes día-de-semana".
+
+    Cada campo acepta *, valores sueltos, listas (1,15), rangos (1-5) y pasos (*/15,
+    8-20/2). El día de semana va de 0 (domingo) a 6; 7 también es domingo. Como en cron,
+    si se restringen día del mes y día de semana alcanza con que coincida uno de los dos.
+    """
+
+    _RANGOS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expresion: str):
+        campos = expresion.split()
+        if len(campos) != 5:
+            raise CronError(f"Se esperaban 5 campos en '{expresion}'")
+        self.expresion = expresion
+        self._minutos, self._horas, self._dias, self._meses, dow = (
+            self._parsear(campo, *rango) for campo, rango in zip(campos, self._RANGOS)
+        )
+        self._dows = {d % 7 for d in dow}
+        self._dias_libres = campos[2] == "*"
+        self._dows_libres = campos[4] == "*"
+
+    @staticmethod
+    def _parsear(campo: str, minimo: int, maximo: int) -> Set[int]:
+        valores: Set[int] = set()
+        for parte in campo.split(","):
+            rango, _, paso = parte.partition("/")
+            try:
+                paso = int(paso) if paso else 1
+                if rango == "*":
+                    desde, hasta = minimo, maximo
+                elif "-" in rango:
+                    desde, hasta = (int(x) for x in rango.split("-", 1))
+                else:
+                    desde = hasta = int(rango)
+            except ValueError:
+                raise CronError(f"Campo inválido: '{campo}'")
+            if paso < 1 or desde < minimo or hasta > maximo or desde > hasta:
+                raise CronError(f"Campo fuera de rango: '{campo}'")
+            valores.update(range(desde, hasta + 1, paso))
+        return valores
+
+    def _dia_ok(self, t: datetime) -> bool:
+        dia = t.day in self._dias
+        dow = (t.isoweekday() % 7) in self._dows
+        if self._dias_libres or self._dows_libres:
+            return dia and dow
+        return dia or dow
+
+    def siguiente(self, desde: datetime) -> datetime:
+        """Primer minuto que cumple la agenda, estrictamente después de `desde` (en su zona)."""
+        t = desde.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limite = t + timedelta(days=366 * 5)
+        while t < limite:
+            if t.month not in self._meses:
+                anio, mes = (t.year + 1, 1) if t.month == 12 else (t.year, t.month + 1)
+                t = t.replace(year=anio, month=mes, day=1, hour=0, minute=0)
+            elif not self._dia_ok(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self._horas:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self._minutos:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise CronError(f"'{self.expresion}' no tiene ninguna fecha posible")
+
+
+class Intervalo:
+    """Agenda de período fijo, para las tareas cuyo período viene de configuración."""
+
+    def __init__(self, cada: timedelta):
+        self.expresion = f"cada {int(cada.total_seconds())}s"
+        self._cada = cada
+
+    def siguiente(self, desde: datetime) -> datetime:
+        return desde + self._cada
+
+
+async def correr_tarea(
+    db,
+    nombre: str,
+    funcion: Callable,
+    origen: str,
+    intento: int = 1,
+    al_latir: Optional[Callable] = None,
+) -> Optional[dict]:
+    """Corre funcion() bajo el lease `nombre` y registra la corrida en tareas_corridas.
+    Devuelve la corrida, o None si la tarea ya está corriendo (en otro proceso o en este).
+    Si la tarea falla, la corrida queda con estado "error" y la excepción se propaga.
+    al_latir se llama en cada renovación del lease, para extender otros reclamos."""
+    duenio = leases.nuevo_duenio()
+    if not await leases.tomar(db, nombre, TAREA_LEASE_TTL, duenio):
+        return None
+
+    async def renovar():
+        while True:
+            await asyncio.sleep(TAREA_LEASE_TTL.total_seconds() / 3)
+            try:
+                if not await leases.tomar(db, nombre, TAREA_LEASE_TTL, duenio):
+                    logger.warning(f"Tarea {nombre}: se perdió el lease mientras corría")
+                if al_latir:
+                    await al_latir()
+            except Exception as e:
+                logger.warning(f"Tarea {nombre}: no se pudo renovar el lease: {e}")
+
+    latido = asyncio.create_task(renovar())
+    try:
+        inicio = datetime.now(timezone.utc)
+        corrida = {
+            "id": str(uuid.uuid4()),
+            "tarea": nombre,
+            "origen": origen,
+            "intento": intento,
+            "instancia": leases.INSTANCIA,
+            "inicio": inicio,
+        }
+        error = None
+        try:
+            corrida["metricas"] = await funcion() or {}
+            corrida["estado"] = "ok"
+        except Exception as e:
+            error = e
+            corrida.update(estado="error", error=str(e))
+        fin = datetime.now(timezone.utc)
+        corrida.update(fin=fin, duracion_ms=int((fin - inicio).total_seconds() * 1000))
+        await db.tareas_corridas.insert_one(corrida)
+        corrida.pop("_id", None)
+        if error:
+            raise error
+        return corrida
+    finally:
+        latido.cancel()
+        await leases.soltar(db, nombre, duenio)
+
+
+class _Tarea:
+    def __init__(self, nombre: str, funcion: Callable, agenda, reintentos: int, backoff: timedelta):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.agenda = agenda
+        self.reintentos = reintentos
+        self.backoff = backoff
+
+
+class Scheduler:
+    """Corre las tareas registradas según su agenda, una vez por ocurrencia entre todos los procesos."""
+
+    def __init__(self, db, tz: timezone = timezone.utc):
+        self._db = db
+        self._tz = tz
+        self._tareas: Dict[str, _Tarea] = {}
+        self._corriendo: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.Task] = None
+        # Dueño del lease de líder mientras viva este scheduler
+        self._duenio = leases.nuevo_duenio()
+
+    def registrar(
+        self,
+        nombre: str,
+        funcion: Callable,
+        cron: Optional[str] = None,
+        cada: Optional[timedelta] = None,
+        reintentos: int = 3,
+        backoff: timedelta = timedelta(minutes=1),
+    ) -> None:
+        """Registra una tarea con agenda cron (en la zona del scheduler) o cada un intervalo."""
+        if (cron is None) == (cada is None):
+            raise ValueError("Indicar cron o cada, uno de los dos")
+        agenda = Cron(cron) if cron else Intervalo(cada)
+        self._tareas[nombre] = _Tarea(nombre, funcion, agenda, reintentos, backoff)
+
+    def tareas(self) -> Dict[str, str]:
+        return {nombre: t.agenda.expresion for nombre, t in self._tareas.items()}
+
+    def _siguiente(self, tarea: _Tarea, desde: datetime) -> datetime:
+        return tarea.agenda.siguiente(desde.astimezone(self._tz)).astimezone(timezone.utc)
+
+    def iniciar(self) -> None:
+        if self._loop is None or self._loop.done():
+            self._loop = asyncio.create_task(self._correr())
+
+    async def detener(self) -> None:
+        tareas = [t for t in (self._loop, *self._corriendo) if t is not None]
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        await leases.soltar(self._db, "scheduler", self._duenio)
+
+    async def disparar(self, nombre: str) -> bool:
+        """Adelanta la próxima corrida de la tarea a ahora. False si no está registrada."""
+        if nombre not in self._tareas:
+            return False
+        await self._db.jobs.update_one(
+            {"_id": nombre}, {"$set": {"proxima": datetime.now(timezone.utc), "intentos": 0}}
+        )
+        return True
+
+    async def _sincronizar(self) -> None:
+        """Crea el doc de cada tarea registrada; si cambió la agenda, recalcula la próxima."""
+        now = datetime.now(timezone.utc)
+        for tarea in self._tareas.values():
+            doc = await self._db.jobs.find_one({"_id": tarea.nombre}, {"agenda": 1})
+            if doc is None:
+                await self._db.jobs.update_one(
+                    {"_id": tarea.nombre},
+                    {"$setOnInsert": {
+                        "agenda": tarea.agenda.expresion,
+                        "proxima": self._siguiente(tarea, now),
+                        "intentos": 0,
+                        "ejecuciones": 0,
+                        "fallos": 0,
+                    }},
+                    upsert=True,
+                )
+            elif doc.get("agenda") != tarea.agenda.expresion:
+                await self._db.jobs.update_one(
+                    {"_id": tarea.nombre},
+                    {"$set": {"agenda": tarea.agenda.expresion, "proxima": self._siguiente(tarea, now)}},
+                )
+
+    async def _correr(self) -> None:
+        while True:
+            try:
+                await self._sincronizar()
+                break
+            except Exception as e:
+                logger.error(f"Scheduler: no se pudieron registrar las tareas: {e}")
+                await asyncio.sleep(VUELTA_SEG)
+        while True:
+            try:
+                if await leases.tomar(self._db, "scheduler", LIDER_LEASE_TTL, self._duenio):
+                    await self._reclamar_vencidas()
+            except Exception as e:
+                logger.error(f"Scheduler: error en la vuelta: {e}")
+            await asyncio.sleep(VUELTA_SEG)
+
+    async def _reclamar_vencidas(self) -> None:
+        now = datetime.now(timezone.utc)
+        async for doc in self._db.jobs.find(
+            {"_id": {"$in": list(self._tareas)}, "proxima": {"$lte": now}}, {"_id": 1}
+        ):
+            # La ocurrencia se reclama corriendo proxima hacia adelante: si el proceso se
+            # cae, vuelve a vencer sola y otro la retoma. Mientras corre, el latido la
+            # sigue corriendo hacia adelante
+            reclamo = str(uuid.uuid4())
+            reclamada = await self._db.jobs.find_one_and_update(
+                {"_id": doc["_id"], "proxima": {"$lte": now}},
+                {"$set": {"proxima": now + TAREA_LEASE_TTL, "instancia": leases.INSTANCIA, "reclamo": reclamo}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if reclamada is None:
+                continue
+            t = asyncio.create_task(self._ejecutar(self._tareas[doc["_id"]], reclamada.get("intentos", 0), reclamo))
+            self._corriendo.add(t)
+            t.add_done_callback(self._corriendo.discard)
+
+    async def _ejecutar(self, tarea: _Tarea, intentos: int, reclamo: str) -> None:
+        filtro = {"_id": tarea.nombre, "reclamo": reclamo}
+
+        async def extender_reclamo():
+            await self._db.jobs.update_one(
+                filtro, {"$set": {"proxima": datetime.now(timezone.utc) + TAREA_LEASE_TTL}}
+            )
+
+        try:
+            corrida = await correr_tarea(
+                self._db, tarea.nombre, tarea.funcion, "programada", intentos + 1, al_latir=extender_reclamo
+            )
+        except Exception as e:
+            corrida = None
+            error = e
+        else:
+            error = None
+            if corrida is None:
+                # Corriendo en otro lado (una corrida manual): queda reclamada y se vuelve a
+                # mirar cuando vence el reclamo
+                return
+        now = datetime.now(timezone.utc)
+        siguiente = self._siguiente(tarea, now)
+        # Solo cierra la ocurrencia si el reclamo sigue siendo de esta corrida
+        if error is None:
+            await self._db.jobs.update_one(filtro, {
+                "$set": {
+                    "proxima": siguiente,
+                    "intentos": 0,
+                    "ultima_corrida": {k: corrida[k] for k in ("id", "estado", "inicio", "duracion_ms", "metricas")},
+                },
+                "$unset": {"reclamo": ""},
+                "$inc": {"ejecuciones": 1},
+            })
+            return
+        intentos += 1
+        if intentos <= tarea.reintentos:
+            proxima = min(now + tarea.backoff * 2 ** (intentos - 1), siguiente)
+            logger.warning(f"Tarea {tarea.nombre} falló (intento {intentos}), se reintenta {proxima.isoformat()}: {error}")
+        else:
+            proxima, intentos = siguiente, 0
+            logger.error(f"Tarea {tarea.nombre} falló y agotó los reintentos: {error}")
+        await self._db.jobs.update_one(filtro, {
+            "$set": {
+                "proxima": proxima,
+                "intentos": intentos,
+                "ultima_corrida": {"estado": "error", "inicio": now, "error": str(error)},
+            },
+            "$unset": {"reclamo": ""},
+            "$inc": {"ejecuciones": 1, "fallos": 1},
+        })
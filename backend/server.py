@@ -1,20 +1,25 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Query, Request, Body
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Query, Request, Body
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, ReturnDocument, UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import io
 import csv
 import re
 import json
+import pickle
 import gc
 import ctypes
 import logging
+import tempfile
 from pathlib import Path
 from pydantic import BaseModel, Field, root_validator
-from typing import List, Optional
+from typing import Callable, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 import calendar
@@ -22,16 +27,27 @@ import jwt
 from passlib.hash import bcrypt
 from enum import Enum
 import base64
+import hashlib
 import pandas as pd
-from openpyxl import Workbook
 import mercadopago
 import httpx
 import asyncio
+import itertools
 import random
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from afip import AfipService, encrypt_private_key, decrypt_private_key, extract_p12
+from afip import AfipNoDisponible, AfipRechazo, AfipService, encrypt_private_key, decrypt_private_key, extract_p12
+from realtime import RealtimeHub
+from spreadsheets import (
+    ArchivoMuyGrande, Planilla, PlanillaError, abrir_planilla, escribir_xlsx, guardar_temporal, xlsx_a_csv,
+)
+from workers import FilePool, LimiteExcedido, TrabajoError
+import import_plan
+import indexes
+import leases
+import reorder
+import scheduler
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -61,6 +77,13 @@ SMTP_USER = os.environ.get('SMTP_USER', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
 EMAIL_FROM = os.environ.get('EMAIL_FROM', 'PULS <noreply@example.com>')
 
+# Procesos aparte para leer/generar planillas XLSX (ver workers.py)
+FILE_WORKERS = int(os.environ.get('FILE_WORKERS', '2'))
+FILE_WORKER_MEMORY_MB = int(os.environ.get('FILE_WORKER_MEMORY_MB', '256'))
+# Cada cuánto se recalculan las sugerencias de reposición (ventas_diarias + reorder.py)
+REORDER_REFRESH_MINUTES = int(os.environ.get('REORDER_REFRESH_MINUTES', '60'))
+file_pool = FilePool(max_workers=FILE_WORKERS, memoria_mb=FILE_WORKER_MEMORY_MB)
+
 async def get_precio_suscripcion() -> float:
     doc = await db.system_config.find_one({"key": "suscripcion_precio"})
     return float(doc["value"]) if doc else SUSCRIPCION_PRECIO
@@ -179,15 +202,36 @@ def _aplicar_renovacion(suscripcion: dict, meses: int, now: datetime):
 DIAS_ALERTA = [10, 5]
 GRACE_DAYS = 15  # Días de gracia para suscripciones pagas vencidas
 
-async def generar_alertas_vencimiento() -> int:
-    """Genera notificaciones para suscripciones próximas a vencer. Retorna cantidad generadas."""
+# --- Alertas de vencimiento ---
+# Una consulta trae solo las candidatas (trial o activa que vencen dentro del umbral más
+# largo) y un único bulk_write hace upsert por (empresa_id, tipo, periodo_ref) con
+# $setOnInsert: la notificación que ya existe no se toca, así que repetir la corrida no
+# duplica nada. El índice único sobre esa terna lo garantiza también ante carreras.
+# Corre una vez por día desde el scheduler (ver "Tareas programadas").
+
+
+async def generar_alertas_vencimiento() -> dict:
+    """Genera notificaciones para suscripciones próximas a vencer.
+    Retorna {"candidatas", "generadas"}."""
     now = datetime.now(timezone.utc)
     dias_alerta = await get_dias_alerta()
-    suscripciones = await db.suscripciones.find(
-        {"status": {"$in": [SuscripcionStatus.TRIAL, SuscripcionStatus.ACTIVA]}}
-    ).to_list(None)
-    generadas = 0
-    for sus in suscripciones:
+    if not dias_alerta:
+        return {"candidatas": 0, "generadas": 0}
+    limite = now + timedelta(days=max(dias_alerta) + 1)
+    cursor = db.suscripciones.find(
+        {
+            "status": {"$in": [SuscripcionStatus.TRIAL, SuscripcionStatus.ACTIVA]},
+            # Las suscripciones viejas guardan la fecha como string: se filtran acá abajo
+            "$or": [
+                {"fecha_vencimiento": {"$lte": limite}},
+                {"fecha_vencimiento": {"$type": "string"}},
+            ],
+        },
+        {"_id": 0, "empresa_id": 1, "status": 1, "plan_nombre": 1, "fecha_vencimiento": 1},
+    ).batch_size(1000)
+    candidatas = 0
+    ops = []
+    async for sus in cursor:
         vencimiento = sus.get("fecha_vencimiento")
         if isinstance(vencimiento, str):
             vencimiento = datetime.fromisoformat(vencimiento)
@@ -196,37 +240,39 @@ async def generar_alertas_vencimiento() -> int:
         if not vencimiento:
             continue
         dias_restantes = (vencimiento - now).days
-        empresa_id = sus["empresa_id"]
-        periodo_ref = vencimiento.date().isoformat()
-        plan_nombre = sus.get("plan_nombre", "Plan")
-        status_label = "trial" if sus.get("status") == SuscripcionStatus.TRIAL else "suscripción"
         # Usar solo el threshold más urgente que aplique
         applicable = sorted([t for t in dias_alerta if dias_restantes <= t])
         if not applicable:
             continue
+        candidatas += 1
         threshold = applicable[0]  # el más chico = más urgente
-        tipo = f"plan_por_vencer_{threshold}"
-        existing = await db.notificaciones.find_one({
-            "empresa_id": empresa_id,
-            "tipo": tipo,
-            "periodo_ref": periodo_ref,
-        })
-        if not existing:
-            dias_str = f"Quedan {max(0, dias_restantes)} días" if dias_restantes >= 0 else "Ya venció"
-            notif = Notificacion(
-                empresa_id=empresa_id,
-                tipo=tipo,
-                titulo=f"Tu {status_label} vence pronto",
-                mensaje=(
-                    f"Tu {plan_nombre} vence el {vencimiento.strftime('%d/%m/%Y')}. "
-                    f"{dias_str}. Renovalo para continuar usando el sistema."
-                ),
-                dias_restantes=max(0, dias_restantes),
-                periodo_ref=periodo_ref,
-            )
-            await db.notificaciones.insert_one(notif.dict())
-            generadas += 1
-    return generadas
+        plan_nombre = sus.get("plan_nombre", "Plan")
+        status_label = "trial" if sus.get("status") == SuscripcionStatus.TRIAL else "suscripción"
+        dias_str = f"Quedan {max(0, dias_restantes)} días" if dias_restantes >= 0 else "Ya venció"
+        notif = Notificacion(
+            empresa_id=sus["empresa_id"],
+            tipo=f"plan_por_vencer_{threshold}",
+            titulo=f"Tu {status_label} vence pronto",
+            mensaje=(
+                f"Tu {plan_nombre} vence el {vencimiento.strftime('%d/%m/%Y')}. "
+                f"{dias_str}. Renovalo para continuar usando el sistema."
+            ),
+            dias_restantes=max(0, dias_restantes),
+            periodo_ref=vencimiento.date().isoformat(),
+        ).dict()
+        clave = {k: notif.pop(k) for k in ("empresa_id", "tipo", "periodo_ref")}
+        ops.append(UpdateOne(clave, {"$setOnInsert": notif}, upsert=True))
+    if not ops:
+        return {"candidatas": 0, "generadas": 0}
+    try:
+        result = await db.notificaciones.bulk_write(ops, ordered=False)
+        generadas = result.upserted_count
+    except BulkWriteError as e:
+        # Duplicados: otra corrida insertó la misma alerta entre el filtro y el insert
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        generadas = e.details.get("nUpserted", 0)
+    return {"candidatas": candidatas, "generadas": generadas}
 
 # Owner (system admin) credentials
 OWNER_USERNAME = os.environ.get('OWNER_USERNAME', 'owner')
@@ -472,46 +518,69 @@ def _trim_memory() -> None:
 
 
 # --- Export helpers ---
-# Antes cada endpoint de export armaba un pd.DataFrame en memoria (duplica el dataset:
-# lista de dicts + DataFrame + buffer de escritura) solo para volcar filas planas a
-# CSV/XLSX. Estos helpers escriben directo desde la lista de dicts, sin pasar por pandas.
-def _rows_to_export_response(rows: List[dict], filename_base: str, format: str = "csv", sheet_name: str = "Datos") -> StreamingResponse:
+# Los exports recorren el cursor de Mongo en lotes y nunca juntan el dataset entero:
+# CSV sale por StreamingResponse a medida que se leen los lotes (el encabezado sale
+# enseguida); XLSX no se puede emitir por partes (el zip cierra con el índice), así que
+# los lotes se vuelcan a un temporal en disco y un proceso aparte arma el archivo desde
+# ahí (spreadsheets.escribir_xlsx). En ambos casos la memoria es la de un lote.
+_EXPORT_BATCH = 1000
+
+async def _lotes_cursor(cursor, armar_filas, batch: int = _EXPORT_BATCH):
+    """Recorre `cursor` de a `batch` documentos y entrega `await armar_filas(lote)`
+    (una lista de filas, cada fila una lista de valores) por cada lote."""
+    lote = []
+    async for doc in cursor.batch_size(batch):
+        lote.append(doc)
+        if len(lote) >= batch:
+            yield await armar_filas(lote)
+            lote = []
+    if lote:
+        yield await armar_filas(lote)
+
+def _csv_bytes(filas: List[list], bom: bool = False) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(filas)
+    return buf.getvalue().encode("utf-8-sig" if bom else "utf-8")
+
+async def _export_response(columns: List[str], lotes, filename_base: str, format: str = "csv", sheet_name: str = "Datos"):
     if format not in ("csv", "xlsx"):
         format = "csv"
 
-    columns = list(rows[0].keys()) if rows else []
-
-    if format == "xlsx":
-        wb = Workbook(write_only=True)
-        ws = wb.create_sheet(sheet_name)
-        ws.append(columns)
-        for row in rows:
-            ws.append([row.get(c) for c in columns])
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        del wb, rows
-        _trim_memory()
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename_base}.xlsx"},
-        )
-    else:
-        buf = io.StringIO()
-        writer = csv.writer(buf)
-        writer.writerow(columns)
-        for row in rows:
-            writer.writerow([row.get(c) for c in columns])
-        csv_bytes = buf.getvalue().encode("utf-8-sig")
-        del buf, rows
-        _trim_memory()
+    if format == "csv":
+        async def generar():
+            yield _csv_bytes([columns], bom=True)
+            async for filas in lotes:
+                yield _csv_bytes(filas)
+
         return StreamingResponse(
-            io.BytesIO(csv_bytes),
+            generar(),
             media_type="text/csv",
             headers={"Content-Disposition": f"attachment; filename={filename_base}.csv"},
         )
 
+    fd, lotes_path = tempfile.mkstemp(prefix="export_", suffix=".pkl")
+    fd_xlsx, path = tempfile.mkstemp(prefix="export_", suffix=".xlsx")
+    os.close(fd_xlsx)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for filas in lotes:
+                pickle.dump(filas, f, protocol=pickle.HIGHEST_PROTOCOL)
+        await file_pool.run(escribir_xlsx, columns, lotes_path, sheet_name, path)
+    except BaseException as e:
+        os.unlink(path)
+        if isinstance(e, TrabajoError):
+            logger.error(f"Export {filename_base}.xlsx falló: {e}")
+            raise HTTPException(status_code=500, detail="No se pudo generar el archivo XLSX")
+        raise
+    finally:
+        os.unlink(lotes_path)
+    return FileResponse(
+        path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=f"{filename_base}.xlsx",
+        background=BackgroundTask(os.unlink, path),
+    )
+
 
 # --- Reportes helpers ---
 def _validar_rango_fechas(desde_local: datetime, hasta_local: datetime, max_dias: int = 92) -> None:
@@ -525,6 +594,617 @@ def _validar_rango_fechas(desde_local: datetime, hasta_local: datetime, max_dias
         )
 
 
+# --- Dashboard counters ---
+# /dashboard/stats se pide en cada carga del home. Antes traía todas las ventas del día
+# y sus devoluciones para sumarlas en Python; ahora cada venta/devolución hace un $inc
+# sobre un doc chico por (empresa, sucursal, día local AR) y el dashboard solo lee esos
+# docs. Las devoluciones se imputan al día de la venta original, igual que antes
+# (el neto de "hoy" es ventas de hoy menos lo devuelto de esas ventas).
+AR_TZ = timezone(timedelta(hours=-3))
+
+def _dia_local(fecha) -> str:
+    if isinstance(fecha, str):
+        fecha = datetime.fromisoformat(fecha)
+    if not fecha.tzinfo:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha.astimezone(AR_TZ).strftime("%Y-%m-%d")
+
+async def _inc_dashboard_counter(
+    empresa_id: str,
+    branch_id: Optional[str],
+    fecha,
+    ventas: float = 0.0,
+    tickets: int = 0,
+    devoluciones: float = 0.0,
+    cantidad_devoluciones: int = 0,
+) -> None:
+    await db.dashboard_counters.update_one(
+        {"empresa_id": empresa_id, "branch_id": branch_id or "global", "dia": _dia_local(fecha)},
+        {
+            "$inc": {
+                "total_ventas": ventas,
+                "tickets": tickets,
+                "total_devoluciones": devoluciones,
+                "cantidad_devoluciones": cantidad_devoluciones,
+            },
+            "$set": {"updated_at": datetime.now(timezone.utc)},
+        },
+        upsert=True,
+    )
+
+async def _contadores_del_dia(dia: str) -> list:
+    """Contadores de un día calculados desde las ventas y sus devoluciones: [(filtro, valores)]."""
+    desde = datetime.strptime(dia, "%Y-%m-%d").replace(tzinfo=AR_TZ).astimezone(timezone.utc)
+    hasta = desde + timedelta(days=1)
+    ventas = await db.sales.aggregate([
+        {"$match": {"fecha": {"$gte": desde, "$lt": hasta}}},
+        {"$group": {
+            "_id": {"empresa_id": "$empresa_id", "branch_id": {"$ifNull": ["$branch_id", "global"]}},
+            "total_ventas": {"$sum": "$total"},
+            "tickets": {"$sum": 1},
+            "sale_ids": {"$push": "$id"},
+        }},
+    ]).to_list(None)
+    contadores = []
+    for grupo in ventas:
+        devs = await db.sale_returns.aggregate([
+            {"$match": {"empresa_id": grupo["_id"]["empresa_id"], "sale_id": {"$in": grupo["sale_ids"]}}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}, "cantidad": {"$sum": 1}}},
+        ]).to_list(1)
+        contadores.append((
+            {"empresa_id": grupo["_id"]["empresa_id"], "branch_id": grupo["_id"]["branch_id"], "dia": dia},
+            {
+                "total_ventas": grupo["total_ventas"],
+                "tickets": grupo["tickets"],
+                "total_devoluciones": devs[0]["total"] if devs else 0.0,
+                "cantidad_devoluciones": devs[0]["cantidad"] if devs else 0,
+            },
+        ))
+    return contadores
+
+async def _rebuild_dashboard_counters(dia: str) -> int:
+    """Siembra los contadores de un día a partir de las ventas existentes. Solo crea los
+    docs que faltan ($setOnInsert), así no pisa lo que ya vienen sumando las ventas nuevas."""
+    sembrados = 0
+    for filtro, valores in await _contadores_del_dia(dia):
+        try:
+            res = await db.dashboard_counters.update_one(
+                filtro,
+                {"$setOnInsert": {**valores, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            continue  # lo creó un $inc en el medio
+        if res.upserted_id is not None:
+            sembrados += 1
+    return sembrados
+
+async def _recalcular_dashboard_counters(dia: str) -> int:
+    """Recalcula y reemplaza los contadores de un día ya cerrado. Cada doc se pisa con $set
+    y queda marcado con la generación de esta corrida; al final se borran los del día que
+    no tocó (sucursales sin ventas). Los del día en curso no se tocan: ahí un $inc
+    concurrente se perdería entre el aggregate y el $set."""
+    generacion = str(uuid.uuid4())
+    contadores = await _contadores_del_dia(dia)
+    for filtro, valores in contadores:
+        await db.dashboard_counters.update_one(
+            filtro,
+            {"$set": {**valores, "generacion": generacion, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+    await db.dashboard_counters.delete_many({"dia": dia, "generacion": {"$ne": generacion}})
+    return len(contadores)
+
+# La siembra del día en que se activan los contadores corre una sola vez (marca en
+# contadores_estado) y antes de atender requests: si una venta hiciera su $inc antes, el
+# $setOnInsert ya no entraría y el día quedaría sin las ventas anteriores. Un worker
+# siembra con un lease y los demás esperan a que termine antes de arrancar.
+_SIEMBRA_ESPERA_MAX = timedelta(minutes=2)
+
+async def _sembrar_dashboard_counters() -> None:
+    marca = {"_id": "dashboard_counters"}
+    if await db.contadores_estado.find_one(marca):
+        return
+    duenio = leases.nuevo_duenio()
+    limite = datetime.now(timezone.utc) + _SIEMBRA_ESPERA_MAX
+    while not await leases.tomar(db, "siembra_dashboard_counters", timedelta(minutes=5), duenio):
+        if await db.contadores_estado.find_one(marca):
+            return
+        if datetime.now(timezone.utc) > limite:
+            logger.warning("La siembra de contadores del dashboard sigue en otro worker; se arranca igual")
+            return
+        await asyncio.sleep(1)
+    try:
+        if not await db.contadores_estado.find_one(marca):
+            sembrados = await _rebuild_dashboard_counters(_dia_local(datetime.now(timezone.utc)))
+            await db.contadores_estado.update_one(
+                marca, {"$set": {"sembrado": datetime.now(timezone.utc), "docs": sembrados}}, upsert=True
+            )
+    finally:
+        await leases.soltar(db, "siembra_dashboard_counters", duenio)
+
+# Conteos del checklist de onboarding (sucursales, categorías, productos). Cambian poco,
+# así que se cachean en un doc por empresa y se invalidan en cada alta/baja. Invalidar
+# sube la versión del doc y el recálculo solo se guarda si la versión sigue siendo la
+# que leyó antes de contar: si una escritura invalida en el medio, esos conteos (que
+# pueden no incluirla) no pisan la invalidación.
+async def _get_onboarding_counts(empresa_id: str) -> dict:
+    try:
+        cached = await db.onboarding_counts.find_one_and_update(
+            {"empresa_id": empresa_id},
+            {"$setOnInsert": {"version": 0, "valido": False}},
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Lo creó otro request a la par
+        cached = await db.onboarding_counts.find_one({"empresa_id": empresa_id}, {"_id": 0})
+    if cached.get("valido"):
+        return cached
+    counts = {
+        "empresa_id": empresa_id,
+        "sucursales": await db.branches.count_documents({"empresa_id": empresa_id, "activo": True}),
+        "categorias": await db.categories.count_documents({"empresa_id": empresa_id}),
+        "productos": await db.products.count_documents({"empresa_id": empresa_id, "activo": True}),
+    }
+    await db.onboarding_counts.update_one(
+        # version None también matchea los docs de antes, que no la tienen
+        {"empresa_id": empresa_id, "version": cached.get("version")},
+        {"$set": {**counts, "valido": True}},
+    )
+    return counts
+
+async def _invalidar_onboarding_counts(empresa_id: str) -> None:
+    await db.onboarding_counts.update_one(
+        {"empresa_id": empresa_id}, {"$inc": {"version": 1}, "$set": {"valido": False}}
+    )
+
+
+# --- Numeración correlativa ---
+# DEV-/NC- salían de un count_documents de toda la empresa en cada devolución. Ahora
+# cada serie es un contador por empresa que se incrementa con un find_one_and_update
+# atómico; la primera vez arranca desde lo que ya había en la colección.
+async def _siguiente_numero(empresa_id: str, serie: str, coll: str) -> int:
+    while True:
+        doc = await db.numeradores.find_one_and_update(
+            {"empresa_id": empresa_id, "serie": serie},
+            {"$inc": {"valor": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc:
+            return doc["valor"]
+        base = await db[coll].count_documents({"empresa_id": empresa_id})
+        try:
+            await db.numeradores.insert_one({"empresa_id": empresa_id, "serie": serie, "valor": base})
+        except DuplicateKeyError:
+            pass
+
+
+# --- Resumen de compras por cliente ---
+# El historial del cliente traía hasta 500 ventas completas para sumarlas en el front.
+# cliente_resumen tiene un doc por (empresa, cliente) con los acumulados, que cada venta,
+# edición y devolución ajusta con un $inc. Los docs se arman completos la primera vez que
+# se piden (_armar_resumen_cliente, desde las ventas del cliente por índice); hasta
+# entonces los $inc no hacen nada (filtran por completo=True), así no quedan docs a medias.
+# Para armarlo primero se deja un doc provisorio (completo=False) con un corte: los
+# movimientos con fecha desde el corte se le suman con $inc como a uno completo, y la
+# agregación solo lee los anteriores. Al terminar, la agregación se suma al provisorio y
+# queda completo; una venta que entra mientras tanto se cuenta por un lado o por el otro.
+_TOP_PRODUCTOS_CLIENTE = 5
+
+def _monto_item(item: dict) -> float:
+    if item.get("subtotal") is not None:
+        return float(item["subtotal"])
+    return float(item.get("cantidad") or 0) * float(item.get("precio_unitario") or 0)
+
+async def _inc_resumen_cliente(
+    empresa_id: str,
+    cliente_id: Optional[str],
+    items: list,
+    total: float = 0.0,
+    tickets: int = 0,
+    devoluciones: float = 0.0,
+    fecha=None,
+    signo: int = 1,
+) -> None:
+    """Suma (signo=1) o resta (signo=-1) una venta/devolución al resumen del cliente.
+    `items` son dicts de SaleItem; `fecha` es la de la venta (o la de la devolución)."""
+    if not cliente_id:
+        return
+    inc = {"total_gastado": total, "tickets": tickets, "devoluciones": devoluciones}
+    set_fields = {"updated_at": datetime.now(timezone.utc)}
+    for item in items:
+        pid = item["producto_id"]
+        inc[f"productos.{pid}.cantidad"] = inc.get(f"productos.{pid}.cantidad", 0) + signo * float(item.get("cantidad") or 0)
+        inc[f"productos.{pid}.monto"] = inc.get(f"productos.{pid}.monto", 0) + signo * _monto_item(item)
+        if item.get("nombre"):
+            set_fields[f"productos.{pid}.nombre"] = item["nombre"]
+    update = {"$inc": inc, "$set": set_fields}
+    if fecha is not None and signo > 0:
+        update["$max"] = {"ultima_compra": fecha}
+    filtro = {"empresa_id": empresa_id, "cliente_id": cliente_id, "completo": True}
+    if isinstance(fecha, datetime):
+        # Un resumen a medio armar solo toma lo posterior a su corte
+        del filtro["completo"]
+        filtro["$or"] = [{"completo": True}, {"corte": {"$lte": fecha}}]
+    await db.cliente_resumen.update_one(filtro, update)
+
+async def _armar_resumen_cliente(empresa_id: str, cliente_id: str) -> dict:
+    """Calcula el resumen desde las ventas del cliente y lo guarda (si nadie lo armó antes)."""
+    clave = {"empresa_id": empresa_id, "cliente_id": cliente_id}
+    provisorio = {
+        **clave,
+        "completo": False,
+        "corte": datetime.now(timezone.utc),
+        "total_gastado": 0.0,
+        "tickets": 0,
+        "devoluciones": 0.0,
+        "ultima_compra": None,
+        "productos": {},
+    }
+    try:
+        await db.cliente_resumen.update_one(clave, {"$setOnInsert": provisorio}, upsert=True)
+    except DuplicateKeyError:
+        pass
+    actual = await db.cliente_resumen.find_one(clave, {"_id": 0})
+    if actual is None or actual.get("completo"):
+        return actual or provisorio
+    # Si otro request ya dejó el provisorio se usa su corte: arman lo mismo y suma uno solo
+    corte = actual["corte"]
+    antes_del_corte = {"$or": [{"fecha": {"$lt": corte}}, {"fecha": {"$not": {"$type": "date"}}}]}
+
+    monto_item = {"$ifNull": ["$items.subtotal", {"$multiply": ["$items.cantidad", "$items.precio_unitario"]}]}
+    res = await db.sales.aggregate([
+        {"$match": {**clave, **antes_del_corte}},
+        {"$facet": {
+            "totales": [{"$group": {
+                "_id": None,
+                "total_gastado": {"$sum": "$total"},
+                "tickets": {"$sum": 1},
+                "ultima_compra": {"$max": "$fecha"},
+                "sale_ids": {"$push": "$id"},
+            }}],
+            "productos": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": "$items.producto_id",
+                    "nombre": {"$last": "$items.nombre"},
+                    "cantidad": {"$sum": "$items.cantidad"},
+                    "monto": {"$sum": monto_item},
+                }},
+            ],
+        }},
+    ], allowDiskUse=True).to_list(1)
+    totales = res[0]["totales"][0] if res and res[0]["totales"] else {}
+    productos = {
+        p["_id"]: {"nombre": p.get("nombre"), "cantidad": p["cantidad"], "monto": p["monto"]}
+        for p in (res[0]["productos"] if res else [])
+    }
+    devoluciones = 0.0
+    if totales.get("sale_ids"):
+        async for ret in db.sale_returns.find(
+            {"empresa_id": empresa_id, "sale_id": {"$in": totales["sale_ids"]}, **antes_del_corte},
+            {"_id": 0, "total": 1, "items": 1},
+        ):
+            devoluciones += ret.get("total", 0)
+            for item in ret.get("items", []):
+                p = productos.setdefault(item["producto_id"], {"nombre": item.get("nombre"), "cantidad": 0, "monto": 0})
+                p["cantidad"] -= float(item.get("cantidad") or 0)
+                p["monto"] -= _monto_item(item)
+
+    inc = {
+        "total_gastado": totales.get("total_gastado", 0.0) - devoluciones,
+        "tickets": totales.get("tickets", 0),
+        "devoluciones": devoluciones,
+    }
+    set_fields = {"completo": True, "updated_at": datetime.now(timezone.utc)}
+    for pid, p in productos.items():
+        inc[f"productos.{pid}.cantidad"] = p["cantidad"]
+        inc[f"productos.{pid}.monto"] = p["monto"]
+        if p.get("nombre"):
+            set_fields[f"productos.{pid}.nombre"] = p["nombre"]
+    update = {"$inc": inc, "$set": set_fields}
+    if totales.get("ultima_compra"):
+        update["$max"] = {"ultima_compra": totales["ultima_compra"]}
+    await db.cliente_resumen.update_one({**clave, "completo": False}, update)
+    return await db.cliente_resumen.find_one(clave, {"_id": 0}) or provisorio
+
+# --- Bajo stock materializado ---
+# Las alertas de stock usaban $expr {$lte: [$stock, $stock_minimo]} (no usa índices) más
+# un $nin con todos los combos y productos sin control de stock. Ahora cada
+# branch_product lleva copia de control_stock/kind del producto y un flag bajo_stock
+# que se recalcula en el mismo update que toca stock o stock_minimo (update con
+# pipeline, atómico). Las alertas son un scan del índice parcial {bajo_stock: true}.
+_BAJO_STOCK_STAGE = {"$set": {"bajo_stock": {"$and": [
+    {"$ne": ["$control_stock", False]},
+    {"$ne": ["$kind", "combo"]},
+    {"$lte": [{"$ifNull": ["$stock", 0]}, {"$ifNull": ["$stock_minimo", 0]}]},
+]}}}
+
+def _es_bajo_stock(bp: dict) -> bool:
+    return (
+        bp.get("control_stock", True) is not False
+        and bp.get("kind", "normal") != "combo"
+        and (bp.get("stock") or 0) <= (bp.get("stock_minimo") or 0)
+    )
+
+def _bp_flags(product: dict) -> dict:
+    """Campos del producto que se denormalizan en cada branch_product."""
+    kind = product.get("kind") or "normal"
+    kind = getattr(kind, "value", kind)
+    return {
+        "kind": kind,
+        "control_stock": False if kind == "combo" else product.get("control_stock", True) is not False,
+    }
+
+def _bp_stock_update(inc: int = 0, set_fields: Optional[dict] = None) -> list:
+    """Update (pipeline) de branch_products que suma `inc` al stock y/o setea campos,
+    recalculando bajo_stock en la misma operación."""
+    etapa = {k: {"$literal": v} for k, v in (set_fields or {}).items()}
+    if inc:
+        etapa["stock"] = {"$add": [{"$ifNull": ["$stock", 0]}, inc]}
+    return ([{"$set": etapa}] if etapa else []) + [_BAJO_STOCK_STAGE]
+
+async def _sync_bp_product_flags(empresa_id: str, products: List[dict]) -> None:
+    """Propaga control_stock/kind de los productos a sus branch_products."""
+    grupos: dict = {}
+    for p in products:
+        flags = _bp_flags(p)
+        grupos.setdefault((flags["control_stock"], flags["kind"]), []).append(p["id"])
+    for (control_stock, kind), ids in grupos.items():
+        await db.branch_products.update_many(
+            {"empresa_id": empresa_id, "product_id": {"$in": ids}},
+            _bp_stock_update(set_fields={"control_stock": control_stock, "kind": kind}),
+        )
+
+async def migrar_bajo_stock() -> int:
+    """Backfill para branch_products previos al flag. Idempotente: solo toca los docs
+    sin bajo_stock. Retorna cuántos se actualizaron."""
+    if not await db.branch_products.find_one({"bajo_stock": {"$exists": False}}, {"_id": 1}):
+        return 0
+    especiales = await db.products.find(
+        {"$or": [{"kind": "combo"}, {"control_stock": False}]},
+        {"id": 1, "empresa_id": 1, "kind": 1, "control_stock": 1}
+    ).to_list(None)
+    por_empresa: dict = {}
+    for p in especiales:
+        por_empresa.setdefault(p["empresa_id"], []).append(p)
+    for empresa_id, prods in por_empresa.items():
+        await _sync_bp_product_flags(empresa_id, prods)
+    res = await db.branch_products.update_many(
+        {"bajo_stock": {"$exists": False}},
+        [
+            {"$set": {
+                "control_stock": {"$ifNull": ["$control_stock", True]},
+                "kind": {"$ifNull": ["$kind", "normal"]},
+            }},
+            _BAJO_STOCK_STAGE,
+        ],
+    )
+    return res.modified_count
+
+async def migrar_documentos_clientes() -> int:
+    """Backfill de documento_digitos/documento_dni para clientes previos. Idempotente:
+    solo toca los que no tienen el campo. Retorna cuántos se actualizaron."""
+    actualizados = 0
+    cursor = db.customers.find(
+        {"documento_digitos": {"$exists": False}},
+        {"_id": 0, "id": 1, "tipo_documento": 1, "documento": 1},
+    ).batch_size(_LOADER_CHUNK)
+    ops = []
+    async for c in cursor:
+        ops.append(UpdateOne({"id": c["id"]}, {"$set": _documento_claves(c.get("tipo_documento"), c.get("documento"))}))
+        if len(ops) >= _LOADER_CHUNK:
+            actualizados += (await db.customers.bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        actualizados += (await db.customers.bulk_write(ops, ordered=False)).modified_count
+    return actualizados
+
+
+# --- Batch loader ---
+# Varios listados armaban cada fila con find_one del producto, la sucursal, el usuario o
+# la suscripción (N+1). BatchLoader es un "DataLoader" por request: junta los ids que
+# faltan, los resuelve con un $in por colección y memoiza, así enriquecer N filas cuesta
+# una cantidad fija de queries. Se crea uno por request (no compartir entre empresas).
+_LOADER_CHUNK = 1000
+
+class BatchLoader:
+    def __init__(self, empresa_id: Optional[str] = None):
+        self.empresa_id = empresa_id
+        self._cache: dict = {}
+
+    def _query(self, key: str, valores: list, extra: Optional[dict]) -> dict:
+        query = {key: {"$in": valores}}
+        if self.empresa_id:
+            query["empresa_id"] = self.empresa_id
+        if extra:
+            query.update(extra)
+        return query
+
+    async def load_many(
+        self,
+        coll: str,
+        ids,
+        key: str = "id",
+        projection: Optional[dict] = None,
+        extra: Optional[dict] = None,
+    ) -> dict:
+        """Devuelve {id: doc | None}. Si hay varios docs con la misma clave queda el primero."""
+        cache_key = (coll, key, repr(sorted((projection or {}).items())), repr(sorted((extra or {}).items())))
+        cache = self._cache.setdefault(cache_key, {})
+        pedidos = [i for i in dict.fromkeys(ids) if i is not None]
+        faltantes = [i for i in pedidos if i not in cache]
+        for n in range(0, len(faltantes), _LOADER_CHUNK):
+            chunk = faltantes[n:n + _LOADER_CHUNK]
+            async for doc in db[coll].find(self._query(key, chunk, extra), projection):
+                cache.setdefault(doc.get(key), doc)
+            for i in chunk:
+                cache.setdefault(i, None)
+        return {i: cache[i] for i in pedidos}
+
+    async def load(self, coll: str, id_, key: str = "id", projection: Optional[dict] = None, extra: Optional[dict] = None):
+        return (await self.load_many(coll, [id_], key, projection, extra)).get(id_)
+
+    async def count_many(self, coll: str, ids, key: str, extra: Optional[dict] = None) -> dict:
+        """Cuenta docs por clave con un solo $group. Devuelve {id: cantidad} (0 si no hay)."""
+        pedidos = [i for i in dict.fromkeys(ids) if i is not None]
+        counts = {i: 0 for i in pedidos}
+        for n in range(0, len(pedidos), _LOADER_CHUNK):
+            chunk = pedidos[n:n + _LOADER_CHUNK]
+            async for row in db[coll].aggregate([
+                {"$match": self._query(key, chunk, extra)},
+                {"$group": {"_id": f"${key}", "n": {"$sum": 1}}},
+            ]):
+                counts[row["_id"]] = row["n"]
+        return counts
+
+
+# --- Keyset pagination ---
+# skip((page-1)*per_page) obliga a Mongo a recorrer todo lo anterior al offset: la
+# página 200 de un catálogo de 50k productos cuesta 200 veces la página 1. Los listados
+# aceptan además un `cursor` opaco (valor de la clave de orden + id de la última fila)
+# y devuelven `next_cursor`; con cursor, la página arranca directo en el índice.
+# `page` sigue funcionando igual para la UI con numeración.
+def _cursor_valor(v):
+    if isinstance(v, datetime):
+        return {"$dt": v.isoformat()}
+    return v
+
+def _encode_cursor(doc: dict, sort: list) -> str:
+    valores = [_cursor_valor(doc.get(campo)) for campo, _ in sort]
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode()
+
+def _decode_cursor(cursor: str, sort: list) -> list:
+    """Valores del cursor; solo escalares o {"$dt": iso}, así no se cuelan operadores."""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(valores, list) or len(valores) != len(sort):
+            raise ValueError
+        decodificados = []
+        for v in valores:
+            if isinstance(v, dict):
+                if list(v) != ["$dt"] or not isinstance(v["$dt"], str):
+                    raise ValueError
+                v = datetime.fromisoformat(v["$dt"])
+            elif isinstance(v, list):
+                raise ValueError
+            decodificados.append(v)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+    return decodificados
+
+def _keyset_query(query: dict, sort: list, cursor: Optional[str]) -> dict:
+    """Agrega a `query` la condición "después de la fila del cursor" para un orden
+    [(campo, dir), ("id", dir)]. Contempla nulls (Mongo los ordena primero)."""
+    if not cursor:
+        return query
+    (campo, direccion), (campo_id, dir_id) = sort
+    valor, valor_id = _decode_cursor(cursor, sort)
+    op, op_id = ("$gt" if direccion == 1 else "$lt"), ("$gt" if dir_id == 1 else "$lt")
+    empate = {campo: valor, campo_id: {op_id: valor_id}}
+    if valor is None:
+        siguiente = {"$or": [{campo: {"$ne": None}}, empate]} if direccion == 1 else empate
+    else:
+        opciones = [{campo: {op: valor}}, empate]
+        if direccion == -1:
+            opciones.append({campo: None})
+        siguiente = {"$or": opciones}
+    return {"$and": [query, siguiente]} if query else siguiente
+
+def _next_cursor(items: list, sort: list, per_page: int) -> Optional[str]:
+    if len(items) < per_page or not items:
+        return None
+    return _encode_cursor(items[-1], sort)
+
+
+# --- Count strategies ---
+# Cada listado paginado hacía un count_documents con el mismo filtro/regex que la página
+# (y get_branch_products corría el $lookup entero dos veces). Cada endpoint declara
+# cómo obtiene el total:
+#   FACET     -> página + total en un solo aggregate ($facet). Para vistas con búsqueda,
+#                donde el count igual tiene que recorrer todo lo que matchea.
+#   CACHED    -> total cacheado por (colección, empresa, filtro); cualquier escritura de
+#                esa colección/empresa lo invalida (_invalidar_counts).
+#   EXACT     -> count_documents de siempre; para filtros que el índice cubre.
+#   ESTIMATED -> estimated_document_count (metadata); solo para vistas sin filtro.
+class CountStrategy(str, Enum):
+    FACET = "facet"
+    CACHED = "cached"
+    EXACT = "exact"
+    ESTIMATED = "estimated"
+
+def _filtro_hash(query: dict) -> str:
+    return hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+
+async def _invalidar_counts(coll: str, empresa_id: str) -> None:
+    await db.count_cache.update_one(
+        {"coll": coll, "empresa_id": empresa_id},
+        {"$inc": {"v": 1}, "$set": {"counts": {}}},
+        upsert=True,
+    )
+
+async def _contar(coll: str, query: dict, estrategia: CountStrategy, empresa_id: Optional[str] = None) -> int:
+    if estrategia == CountStrategy.ESTIMATED:
+        return await db[coll].estimated_document_count()
+    if estrategia != CountStrategy.CACHED or not empresa_id:
+        return await db[coll].count_documents(query)
+    clave = _filtro_hash(query)
+    cache = await db.count_cache.find_one({"coll": coll, "empresa_id": empresa_id}) or {}
+    total = (cache.get("counts") or {}).get(clave)
+    if total is not None:
+        return total
+    total = await db[coll].count_documents(query)
+    # Se guarda solo si nadie invalidó mientras contábamos (v no cambió)
+    try:
+        await db.count_cache.update_one(
+            {"coll": coll, "empresa_id": empresa_id, "v": cache.get("v", 0)},
+            {"$set": {f"counts.{clave}": total}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        pass
+    return total
+
+async def _pagina_facet(coll: str, pipeline: list, pagina: list) -> tuple:
+    """Corre `pipeline` una sola vez y devuelve (items de `pagina`, total)."""
+    res = await db[coll].aggregate(
+        pipeline + [{"$facet": {"items": pagina, "total": [{"$count": "n"}]}}],
+        allowDiskUse=True,
+    ).to_list(1)
+    if not res:
+        return [], 0
+    total = res[0]["total"][0]["n"] if res[0]["total"] else 0
+    return res[0]["items"], total
+
+async def _paginar_find(
+    coll: str,
+    query: dict,
+    sort: list,
+    page: int,
+    per_page: int,
+    cursor: Optional[str],
+    count: CountStrategy,
+    empresa_id: Optional[str] = None,
+) -> tuple:
+    """Página de un find con orden `sort` (keyset si viene cursor) y su total según `count`."""
+    if count == CountStrategy.FACET:
+        pagina = [{"$match": _keyset_query({}, sort, cursor)}, {"$sort": dict(sort)}]
+        if not cursor:
+            pagina.append({"$skip": (page - 1) * per_page})
+        pagina.append({"$limit": per_page})
+        return await _pagina_facet(coll, [{"$match": query}], pagina)
+    find = db[coll].find(_keyset_query(query, sort, cursor)).sort(sort)
+    if not cursor:
+        find = find.skip((page - 1) * per_page)
+    items, total = await asyncio.gather(
+        find.limit(per_page).to_list(per_page),
+        _contar(coll, query, count, empresa_id),
+    )
+    return items, total
+
+
 # --- Empresa models ---
 class Empresa(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -637,6 +1317,13 @@ class CashSession(BaseModel):
     monto_inicial: float
     monto_ventas: float = 0.0
     monto_retiros: float = 0.0
+    # Acumulados que mantienen las ventas, devoluciones y retiros (ver _inc_sesion_caja)
+    cantidad_ventas: int = 0
+    ingresos_efectivo: float = 0.0
+    ingresos_tarjeta: float = 0.0
+    ingresos_transferencia: float = 0.0
+    monto_devoluciones: float = 0.0
+    totales_por_medio: bool = False             # False en sesiones abiertas antes de los acumulados
     monto_final: Optional[float] = None
     monto_esperado: Optional[float] = None
     diferencia: Optional[float] = None
@@ -654,6 +1341,10 @@ class CashSessionClose(BaseModel):
     monto_final: float
     observaciones: Optional[str] = None
 
+class CashWithdrawalCreate(BaseModel):
+    monto: float = Field(gt=0)
+    descripcion: Optional[str] = None
+
 class CashSessionHistory(BaseModel):
     id: str
     empresa_id: str
@@ -693,8 +1384,17 @@ class BranchProduct(BaseModel):
     margen: Optional[float] = None
     costo: Optional[float] = None
     activo: bool = True
+    # Copia de product.control_stock/kind + flag materializado (ver _bp_stock_update)
+    control_stock: bool = True
+    kind: str = "normal"
+    bajo_stock: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    @root_validator(skip_on_failure=True)
+    def calc_bajo_stock(cls, values):
+        values['bajo_stock'] = _es_bajo_stock(values)
+        return values
+
 class BranchProductCreate(BaseModel):
     product_id: str
     branch_id: Optional[str] = None
@@ -1082,6 +1782,8 @@ class SaleReturn(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     empresa_id: str
     sale_id: str
+    # Sucursal de la venta original (las devoluciones viejas no la tienen)
+    branch_id: Optional[str] = None
     cajero_id: str
     items: List[SaleItem]
     total: float
@@ -1105,7 +1807,7 @@ class CreditNote(BaseModel):
     # Campos AFIP (3=NC-A, 8=NC-B, 13=NC-C)
     cae: Optional[str] = None
     cae_vencimiento: Optional[str] = None
-    afip_estado: str = "no_aplica"
+    afip_estado: str = "no_aplica"              # no_aplica | pendiente | autorizado | contingencia | error
     tipo_comprobante_nc: Optional[int] = None
     nro_comprobante_afip: Optional[int] = None
     afip_error: Optional[str] = None
@@ -1148,6 +1850,8 @@ class CompraItem(BaseModel):
     nuevo_precio: Optional[float] = None
     nuevo_margen: Optional[float] = None
     costo_anterior: Optional[float] = None
+    # Qué pasó con la línea al recibirla en la sucursal (ver _Recepcion)
+    resultado: Optional[str] = None
 
 class Compra(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -1217,9 +1921,13 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def _usuario_del_token(token: str, uso: Optional[str] = None) -> User:
+    """Valida el JWT y devuelve el usuario. `uso` distingue los tokens de propósito único
+    (como el ticket del stream del dashboard) de los de sesión, que no lo llevan."""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("uso") != uso:
+            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
         user_id: str = payload.get("sub")
         empresa_id: str = payload.get("empresa_id")
         active_branch_id: Optional[str] = payload.get("active_branch_id")
@@ -1239,6 +1947,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await _usuario_del_token(credentials.credentials)
+
 def require_role(required_roles: List[UserRole]):
     def role_checker(user: User = Depends(get_current_user)):
         if user.rol not in required_roles:
@@ -1246,6 +1957,47 @@ def require_role(required_roles: List[UserRole]):
         return user
     return role_checker
 
+# --- Branch provisioning ---
+# Alta en bloque de los branch_products que faltan: una consulta para los pares
+# (producto, sucursal) que ya existen y insert_many sin orden por tandas.
+_PROVISION_CHUNK = 1000
+
+async def _aprovisionar_branch_products(
+    empresa_id: str,
+    productos: List[dict],
+    branch_ids: List[str],
+    armar: Callable[[dict, str], BranchProduct],
+    progreso: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """Crea un branch_product por cada (producto, sucursal) que todavía no lo tenga.
+
+    `armar(producto, branch_id)` arma el documento nuevo. Devuelve cuántos se crearon."""
+    if not productos or not branch_ids:
+        return 0
+    filtro = {"empresa_id": empresa_id, "branch_id": {"$in": branch_ids}}
+    if len(productos) <= _PROVISION_CHUNK:
+        # Con el catálogo entero alcanza filtrar por sucursal; un $in de 10k ids no suma
+        filtro["product_id"] = {"$in": [p["id"] for p in productos]}
+    existentes = set()
+    async for bp in db.branch_products.find(filtro, {"_id": 0, "product_id": 1, "branch_id": 1}):
+        existentes.add((bp["product_id"], bp["branch_id"]))
+    faltantes = [(p, b) for b in branch_ids for p in productos if (p["id"], b) not in existentes]
+
+    creados = 0
+    for inicio in range(0, len(faltantes), _PROVISION_CHUNK):
+        docs = [armar(p, b).dict() for p, b in faltantes[inicio:inicio + _PROVISION_CHUNK]]
+        try:
+            res = await db.branch_products.insert_many(docs, ordered=False)
+            creados += len(res.inserted_ids)
+        except BulkWriteError as e:
+            # Duplicados: otro request creó el mismo par entre la consulta y el insert
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+            creados += e.details.get("nInserted", 0)
+        if progreso:
+            progreso(min(inicio + _PROVISION_CHUNK, len(faltantes)), len(faltantes))
+    return creados
+
 # Branch routes
 @api_router.post("/branches", response_model=Branch)
 async def create_branch(branch_data: BranchCreate, user: User = Depends(require_role([UserRole.ADMIN]))):
@@ -1260,6 +2012,7 @@ async def create_branch(branch_data: BranchCreate, user: User = Depends(require_
         raise HTTPException(status_code=400, detail=f"Tu plan permite hasta {limite_sucursales} sucursal(es). Actualizá tu plan para agregar más.")
     branch = Branch(**branch_data.dict(), empresa_id=user.empresa_id)
     await db.branches.insert_one(branch.dict())
+    await _invalidar_onboarding_counts(user.empresa_id)
 
     # Build a price/margin reference map from the first existing branch (if any)
     first_branch = await db.branches.find_one(
@@ -1269,45 +2022,49 @@ async def create_branch(branch_data: BranchCreate, user: User = Depends(require_
     ref_map: dict = {}
     if first_branch:
         ref_bps = await db.branch_products.find(
-            {"branch_id": first_branch["id"], "empresa_id": user.empresa_id}
-        ).to_list(10000)
+            {"branch_id": first_branch["id"], "empresa_id": user.empresa_id},
+            {"_id": 0, "product_id": 1, "precio": 1, "precio_por_peso": 1, "costo": 1, "margen": 1}
+        ).to_list(None)
         ref_map = {bp["product_id"]: bp for bp in ref_bps}
 
     # Auto-sync: create branch_products for all existing active products of this empresa
-    products = await db.products.find({"empresa_id": user.empresa_id, "activo": True}).to_list(10000)
-    for product in products:
-        existing = await db.branch_products.find_one({
-            "product_id": product["id"],
-            "branch_id": branch.id,
-            "empresa_id": user.empresa_id
-        })
-        if not existing:
-            ref = ref_map.get(product["id"])
-            base_precio = ref["precio"] if ref else product["precio"]
-            base_precio_por_peso = ref.get("precio_por_peso") if ref else product.get("precio_por_peso")
-            base_costo = ref.get("costo") if ref else None
-            ajuste = branch_data.margen_ajuste
-            if ajuste is not None and ajuste != 0:
-                factor = 1 + ajuste / 100
-                base_precio = round(base_precio * factor, 2)
-                if base_precio_por_peso:
-                    base_precio_por_peso = round(base_precio_por_peso * factor, 2)
-            nuevo_margen = (
-                round((base_precio - base_costo) / base_costo * 100, 2)
-                if base_costo and base_costo > 0 else (ref.get("margen") if ref else None)
-            )
-            bp = BranchProduct(
-                empresa_id=user.empresa_id,
-                product_id=product["id"],
-                branch_id=branch.id,
-                precio=base_precio,
-                precio_por_peso=base_precio_por_peso,
-                stock=product.get("stock", 0),
-                stock_minimo=product.get("stock_minimo", 10),
-                margen=nuevo_margen,
-                costo=base_costo,
-            )
-            await db.branch_products.insert_one(bp.dict())
+    products = await db.products.find(
+        {"empresa_id": user.empresa_id, "activo": True},
+        {"_id": 0, "id": 1, "precio": 1, "precio_por_peso": 1, "stock": 1, "stock_minimo": 1, "kind": 1, "control_stock": 1}
+    ).to_list(None)
+    ajuste = branch_data.margen_ajuste
+
+    def armar(product: dict, branch_id: str) -> BranchProduct:
+        ref = ref_map.get(product["id"])
+        base_precio = ref["precio"] if ref else product["precio"]
+        base_precio_por_peso = ref.get("precio_por_peso") if ref else product.get("precio_por_peso")
+        base_costo = ref.get("costo") if ref else None
+        if ajuste is not None and ajuste != 0:
+            factor = 1 + ajuste / 100
+            base_precio = round(base_precio * factor, 2)
+            if base_precio_por_peso:
+                base_precio_por_peso = round(base_precio_por_peso * factor, 2)
+        nuevo_margen = (
+            round((base_precio - base_costo) / base_costo * 100, 2)
+            if base_costo and base_costo > 0 else (ref.get("margen") if ref else None)
+        )
+        return BranchProduct(
+            empresa_id=user.empresa_id,
+            product_id=product["id"],
+            branch_id=branch_id,
+            precio=base_precio,
+            precio_por_peso=base_precio_por_peso,
+            stock=product.get("stock", 0),
+            stock_minimo=product.get("stock_minimo", 10),
+            margen=nuevo_margen,
+            costo=base_costo,
+            **_bp_flags(product),
+        )
+
+    def progreso(hechos: int, total: int):
+        logger.info(f"Sucursal {branch.id}: {hechos}/{total} productos aprovisionados")
+
+    await _aprovisionar_branch_products(user.empresa_id, products, [branch.id], armar, progreso)
     return branch
 
 @api_router.get("/branches", response_model=List[Branch])
@@ -1327,32 +2084,39 @@ async def export_branch_products(
     if not branch:
         raise HTTPException(status_code=404, detail="Branch not found")
 
-    products = await db.products.find({"empresa_id": user.empresa_id, "activo": True}).to_list(10000)
     categories = await db.categories.find({"empresa_id": user.empresa_id}).to_list(1000)
     cat_map = {c["id"]: c["nombre"] for c in categories}
 
-    rows = []
-    for product in products:
-        bp = await db.branch_products.find_one({
-            "product_id": product.get("id"),
-            "branch_id": branch_id,
-            "empresa_id": user.empresa_id
-        })
-        rows.append({
-            "nombre": product.get("nombre"),
-            "codigo_barras": product.get("codigo_barras", ""),
-            "tipo": product.get("tipo"),
-            "categoria": cat_map.get(product.get("categoria_id"), ""),
-            "precio_global": product.get("precio"),
-            "stock_global": product.get("stock", 0),
-            "precio_sucursal": bp.get("precio") if bp else "",
-            "precio_por_peso_sucursal": bp.get("precio_por_peso") if bp else "",
-            "stock_sucursal": bp.get("stock") if bp else "",
-            "stock_minimo_sucursal": bp.get("stock_minimo") if bp else "",
-        })
-
+    async def armar_filas(products):
+        bp_map = await BatchLoader(user.empresa_id).load_many(
+            "branch_products", [p.get("id") for p in products], key="product_id", extra={"branch_id": branch_id}
+        )
+        filas = []
+        for product in products:
+            bp = bp_map.get(product.get("id"))
+            filas.append([
+                product.get("nombre"),
+                product.get("codigo_barras", ""),
+                product.get("tipo"),
+                cat_map.get(product.get("categoria_id"), ""),
+                product.get("precio"),
+                product.get("stock", 0),
+                bp.get("precio") if bp else "",
+                bp.get("precio_por_peso") if bp else "",
+                bp.get("stock") if bp else "",
+                bp.get("stock_minimo") if bp else "",
+            ])
+        return filas
+
+    columns = [
+        "nombre", "codigo_barras", "tipo", "categoria", "precio_global", "stock_global",
+        "precio_sucursal", "precio_por_peso_sucursal", "stock_sucursal", "stock_minimo_sucursal",
+    ]
+    cursor = db.products.find({"empresa_id": user.empresa_id, "activo": True}, {"_id": 0})
     branch_nombre = branch.get("nombre", branch_id).replace(" ", "_")
-    return _rows_to_export_response(rows, f"productos_{branch_nombre}", format, sheet_name="Productos")
+    return await _export_response(
+        columns, _lotes_cursor(cursor, armar_filas), f"productos_{branch_nombre}", format, sheet_name="Productos"
+    )
 
 @api_router.get("/branches/{branch_id}/products")
 async def get_branch_products_admin(
@@ -1364,6 +2128,7 @@ async def get_branch_products_admin(
     kind: Optional[str] = Query(None),
     activo_sucursal: Optional[bool] = Query(None),
     all: bool = Query(False),
+    cursor: Optional[str] = Query(None),
     user: User = Depends(get_current_user)
 ):
     if user.rol not in [UserRole.ADMIN, UserRole.SUPERVISOR]:
@@ -1392,12 +2157,17 @@ async def get_branch_products_admin(
             query["id"] = {"$nin": list(inactive_ids)}
         else:
             query["id"] = {"$in": filtered_ids}
-    total = await db.products.count_documents(query)
+    sort = [("nombre", 1), ("id", 1)]
+    next_cursor = None
     if all:
-        products = await db.products.find(query).to_list(None)
+        products = await db.products.find(query).sort(sort).to_list(None)
+        total = len(products)
     else:
-        skip = (page - 1) * per_page
-        products = await db.products.find(query).skip(skip).limit(per_page).to_list(per_page)
+        count = CountStrategy.FACET if search or activo_sucursal is not None else CountStrategy.CACHED
+        products, total = await _paginar_find(
+            "products", query, sort, page, per_page, cursor, count, user.empresa_id
+        )
+        next_cursor = _next_cursor(products, sort, per_page)
     product_ids = [p.get("id") for p in products]
     bps = await db.branch_products.find({
         "product_id": {"$in": product_ids},
@@ -1430,7 +2200,8 @@ async def get_branch_products_admin(
         "total": total,
         "page": page,
         "per_page": len(result) if all else per_page,
-        "total_pages": 1 if all else max(1, -(-total // per_page))
+        "total_pages": 1 if all else max(1, -(-total // per_page)),
+        "next_cursor": next_cursor,
     }
 
 @api_router.get("/branches/{branch_id}", response_model=Branch)
@@ -1448,6 +2219,7 @@ async def update_branch(branch_id: str, branch_data: BranchUpdate, user: User =
     update_data = {k: v for k, v in branch_data.dict().items() if v is not None}
     if update_data:
         await db.branches.update_one({"id": branch_id, "empresa_id": user.empresa_id}, {"$set": update_data})
+        await _invalidar_onboarding_counts(user.empresa_id)
     updated = await db.branches.find_one({"id": branch_id, "empresa_id": user.empresa_id})
     return Branch(**updated)
 
@@ -1465,6 +2237,7 @@ async def delete_branch(branch_id: str, user: User = Depends(require_role([UserR
     if session_ids:
         await db.cash_movements.delete_many({"session_id": {"$in": session_ids}})
     await db.cash_sessions.delete_many({"branch_id": branch_id, "empresa_id": user.empresa_id})
+    await _invalidar_counts("cash_sessions", user.empresa_id)
     await db.branch_products.delete_many({"branch_id": branch_id, "empresa_id": user.empresa_id})
     await db.users.update_many(
         {"empresa_id": user.empresa_id},
@@ -1475,6 +2248,254 @@ async def delete_branch(branch_id: str, user: User = Depends(require_role([UserR
         {"$unset": {"branch_id": ""}}
     )
     await db.branches.delete_one({"id": branch_id, "empresa_id": user.empresa_id})
+    await _invalidar_onboarding_counts(user.empresa_id)
+
+# --- Totales de caja por medio de pago ---
+# El reporte de caja traía hasta 1000 movimientos, 1000 ventas y sus devoluciones para
+# recalcular efectivo/tarjeta/transferencia (y con más de 1000 ventas cortaba sin avisar).
+# Ahora la sesión lleva los acumulados: cada venta, edición, devolución y retiro hace un
+# $inc sobre el doc de la sesión con lo que le toca a cada medio de pago.
+MEDIOS_PAGO = [m.value for m in PaymentMethod]
+REPORTE_CAJA_MOVIMIENTOS = 500
+
+def _ingresos_por_medio(metodo_pago, pagos, monto: float, total: Optional[float] = None) -> dict:
+    """$inc por medio de pago para `monto` de una venta de `total`. Con pago dividido se
+    reparte en proporción a cada pago, como prorrateaba antes el reporte."""
+    def clave(metodo) -> str:
+        return f"ingresos_{metodo.value if hasattr(metodo, 'value') else metodo}"
+    inc: dict = {}
+    if pagos and len(pagos) > 1:
+        ratio = monto / total if total else 1
+        for p in pagos:
+            metodo, pagado = (p["metodo"], p["monto"]) if isinstance(p, dict) else (p.metodo, p.monto)
+            inc[clave(metodo)] = inc.get(clave(metodo), 0) + pagado * ratio
+    else:
+        inc[clave(metodo_pago)] = monto
+    return {k: v for k, v in inc.items() if k[len("ingresos_"):] in MEDIOS_PAGO}
+
+def _sumar_inc(*incs: dict) -> dict:
+    total: dict = {}
+    for inc in incs:
+        for k, v in inc.items():
+            total[k] = total.get(k, 0) + v
+    return {k: v for k, v in total.items() if v}
+
+async def _inc_sesion_caja(session_id: Optional[str], empresa_id: str, inc: dict) -> None:
+    if session_id and inc:
+        await db.cash_sessions.update_one({"id": session_id, "empresa_id": empresa_id}, {"$inc": inc})
+
+async def _totales_sesion_anterior(session: dict) -> dict:
+    """Acumulados de una sesión abierta antes de que existieran: se calculan una vez con
+    el recorrido de siempre, pero sin el tope de 1000 ventas."""
+    totales = {f"ingresos_{m}": 0.0 for m in MEDIOS_PAGO}
+    totales["cantidad_ventas"] = 0
+    ventas = []
+    async for v in db.sales.find(
+        {"session_id": session["id"], "empresa_id": session["empresa_id"]},
+        {"_id": 0, "id": 1, "total": 1, "metodo_pago": 1, "pagos": 1},
+    ):
+        ventas.append(v)
+    devuelto: dict = {}
+    for i in range(0, len(ventas), 1000):
+        ids = [v["id"] for v in ventas[i:i + 1000]]
+        async for r in db.sale_returns.aggregate([
+            {"$match": {"empresa_id": session["empresa_id"], "sale_id": {"$in": ids}}},
+            {"$group": {"_id": "$sale_id", "total": {"$sum": "$total"}}},
+        ]):
+            devuelto[r["_id"]] = r["total"]
+    for v in ventas:
+        neto = v["total"] - devuelto.get(v["id"], 0)
+        totales = _sumar_inc(totales, _ingresos_por_medio(v.get("metodo_pago"), v.get("pagos"), neto, v["total"]))
+        totales["cantidad_ventas"] = totales.get("cantidad_ventas", 0) + 1
+    totales["monto_devoluciones"] = sum(devuelto.values())
+    return totales
+
+async def _pagina_movimientos(session_id: str, empresa_id: str, per_page: int, cursor: Optional[str]) -> dict:
+    sort = [("fecha", 1), ("id", 1)]
+    query = _keyset_query({"session_id": session_id, "empresa_id": empresa_id}, sort, cursor)
+    items = await db.cash_movements.find(query, {"_id": 0}).sort(sort).limit(per_page).to_list(per_page)
+    return {
+        "items": [CashMovement(**m) for m in items],
+        "per_page": per_page,
+        "next_cursor": _next_cursor(items, sort, per_page),
+    }
+
+
+# --- Cierre Z ---
+# Los reportes de días ya cerrados recorrían las ventas una y otra vez. Ahora cada
+# sucursal tiene sus cierres Z: un resumen chico e inmutable de un tramo [desde, hasta)
+# con totales por medio de pago, impuestos, devoluciones, tickets, productos más vendidos
+# y el detalle por cajero. Como en un controlador fiscal, cada Z arranca donde terminó
+# el anterior de la sucursal y nunca se pisa. Se generan:
+#   - al cerrar la última caja abierta de la sucursal (tramo hasta ese momento)
+#   - con periodic_cierres_z, pasada la medianoche, para lo que quedó del día anterior
+# Un tramo que cruza la medianoche se parte en un Z por día local; los tramos sin
+# movimiento no generan Z. El índice único (empresa, sucursal, desde) evita que dos
+# procesos congelen el mismo tramo.
+# Editar una venta que ya quedó en un Z no reescribe el Z: la diferencia se suma en su
+# campo ajustes (_ajustar_cierre_z) y los reportes la agregan al total neto.
+# Las ventas sin sucursal (branch_id null, "global" en los contadores del dashboard) no
+# tienen caja ni Z: los reportes las toman siempre de las ventas, como un tramo sin Z.
+Z_HISTORIA_DIAS = 92
+Z_TOP_PRODUCTOS = 20
+
+def _inicio_dia_local(fecha: datetime) -> datetime:
+    return fecha.astimezone(AR_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+
+async def _armar_cierre_z(empresa_id: str, branch_id: str, desde: datetime, hasta: datetime) -> Optional[dict]:
+    ventas_match = {"empresa_id": empresa_id, "branch_id": branch_id, "fecha": {"$gte": desde, "$lt": hasta}}
+    facet = {
+        "totales": [{"$group": {
+            "_id": None,
+            "tickets": {"$sum": 1},
+            "total": {"$sum": "$total"},
+            "subtotal": {"$sum": "$subtotal"},
+            "impuestos": {"$sum": {"$ifNull": ["$impuestos", 0]}},
+            "impuestos_extra": {"$sum": {"$ifNull": ["$impuestos_extra_total", 0]}},
+            "descuentos": {"$sum": {"$add": [{"$ifNull": ["$descuento", 0]}, {"$ifNull": ["$descuento_items", 0]}]}},
+        }}],
+        # Pago dividido: cada parte a su medio; si no, el total al metodo_pago
+        "medios": [
+            {"$project": {"pagos": {"$cond": [
+                {"$gt": [{"$size": {"$ifNull": ["$pagos", []]}}, 1]},
+                "$pagos",
+                [{"metodo": "$metodo_pago", "monto": "$total"}],
+            ]}}},
+            {"$unwind": "$pagos"},
+            {"$group": {"_id": "$pagos.metodo", "total": {"$sum": "$pagos.monto"}}},
+        ],
+        "cajeros": [
+            {"$group": {"_id": "$cajero_id", "tickets": {"$sum": 1}, "total": {"$sum": "$total"}}},
+            {"$sort": {"total": -1}},
+        ],
+        "productos": [
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": "$items.producto_id",
+                "nombre": {"$first": "$items.nombre"},
+                "cantidad": {"$sum": "$items.cantidad"},
+                "total": {"$sum": "$items.subtotal"},
+            }},
+            {"$sort": {"total": -1}},
+            {"$limit": Z_TOP_PRODUCTOS},
+        ],
+    }
+    ventas_agg, devoluciones, sesiones = await asyncio.gather(
+        db.sales.aggregate([{"$match": ventas_match}, {"$facet": facet}]).to_list(1),
+        db.sale_returns.find(
+            {"empresa_id": empresa_id, "fecha": {"$gte": desde, "$lt": hasta}}, {"_id": 0, "sale_id": 1, "total": 1}
+        ).to_list(None),
+        db.cash_sessions.find(
+            {"empresa_id": empresa_id, "branch_id": branch_id, "fecha_cierre": {"$gte": desde, "$lt": hasta}},
+            {"_id": 0, "monto_retiros": 1, "diferencia": 1},
+        ).to_list(None),
+    )
+    ventas = ventas_agg[0] if ventas_agg else {}
+    totales = (ventas.get("totales") or [{}])[0]
+
+    # Devoluciones hechas en el tramo de ventas de esta sucursal (de cualquier día),
+    # repartidas por medio de pago igual que en la caja
+    ventas_dev = await BatchLoader(empresa_id).load_many(
+        "sales", [d["sale_id"] for d in devoluciones],
+        projection={"_id": 0, "id": 1, "metodo_pago": 1, "pagos": 1, "total": 1}, extra={"branch_id": branch_id},
+    )
+    devoluciones = [d for d in devoluciones if ventas_dev.get(d["sale_id"])]
+
+    if not totales.get("tickets") and not devoluciones and not sesiones:
+        return None
+
+    por_medio = {m: 0.0 for m in MEDIOS_PAGO}
+    for m in ventas.get("medios", []):
+        if m["_id"] in por_medio:
+            por_medio[m["_id"]] += m["total"]
+    devoluciones_medio = {m: 0.0 for m in MEDIOS_PAGO}
+    for d in devoluciones:
+        v = ventas_dev[d["sale_id"]]
+        for clave, monto in _ingresos_por_medio(v.get("metodo_pago"), v.get("pagos"), d["total"], v.get("total")).items():
+            devoluciones_medio[clave[len("ingresos_"):]] += monto
+
+    cajeros = await BatchLoader(empresa_id).load_many(
+        "users", [c["_id"] for c in ventas.get("cajeros", [])], projection={"_id": 0, "id": 1, "nombre": 1}
+    )
+    total_ventas = totales.get("total", 0.0)
+    total_devoluciones = sum(d["total"] for d in devoluciones)
+    return {
+        "id": str(uuid.uuid4()),
+        "empresa_id": empresa_id,
+        "branch_id": branch_id,
+        "dia": _dia_local(desde),
+        "desde": desde,
+        "hasta": hasta,
+        "tickets": totales.get("tickets", 0),
+        "total_ventas": total_ventas,
+        "subtotal": totales.get("subtotal", 0.0),
+        "impuestos": totales.get("impuestos", 0.0),
+        "impuestos_extra": totales.get("impuestos_extra", 0.0),
+        "descuentos": totales.get("descuentos", 0.0),
+        "por_medio": por_medio,
+        "cantidad_devoluciones": len(devoluciones),
+        "total_devoluciones": total_devoluciones,
+        "devoluciones_por_medio": devoluciones_medio,
+        "total_neto": total_ventas - total_devoluciones,
+        "por_cajero": [
+            {
+                "cajero_id": c["_id"],
+                "nombre": (cajeros.get(c["_id"]) or {}).get("nombre", ""),
+                "tickets": c["tickets"],
+                "total": c["total"],
+            }
+            for c in ventas.get("cajeros", [])
+        ],
+        "top_productos": [
+            {"producto_id": p["_id"], "nombre": p.get("nombre"), "cantidad": p["cantidad"], "total": p["total"]}
+            for p in ventas.get("productos", [])
+        ],
+        "sesiones_cerradas": len(sesiones),
+        "total_retiros": sum(x.get("monto_retiros") or 0 for x in sesiones),
+        "diferencia_cajas": sum(x.get("diferencia") or 0 for x in sesiones),
+        "created_at": datetime.now(timezone.utc),
+    }
+
+async def _cerrar_z(empresa_id: str, branch_id: str, hasta: datetime, origen: str) -> int:
+    """Congela los Z pendientes de la sucursal hasta `hasta`. Devuelve cuántos creó."""
+    ultimo = await db.cierres_z.find_one(
+        {"empresa_id": empresa_id, "branch_id": branch_id}, {"_id": 0, "hasta": 1, "numero": 1}, sort=[("desde", -1)]
+    )
+    if ultimo:
+        desde, numero = ultimo["hasta"], ultimo.get("numero", 0)
+    else:
+        desde, numero = _inicio_dia_local(hasta - timedelta(days=Z_HISTORIA_DIAS)), 0
+    creados = 0
+    while desde < hasta:
+        fin = min(hasta, _inicio_dia_local(desde) + timedelta(days=1))
+        doc = await _armar_cierre_z(empresa_id, branch_id, desde, fin)
+        if doc:
+            numero += 1
+            doc.update(numero=numero, origen=origen)
+            try:
+                await db.cierres_z.insert_one(doc)
+            except DuplicateKeyError:
+                # Otro proceso ya congeló este tramo
+                return creados
+            creados += 1
+        desde = fin
+    return creados
+
+async def _ajustar_cierre_z(empresa_id: str, branch_id: Optional[str], fecha, monto: float) -> None:
+    """Anota `monto` en los ajustes del Z que cubre `fecha`, si ya hay uno."""
+    if not monto or not isinstance(fecha, datetime):
+        return
+    await db.cierres_z.update_one(
+        {"empresa_id": empresa_id, "branch_id": branch_id, "desde": {"$lte": fecha}, "hasta": {"$gt": fecha}},
+        {"$inc": {"ajustes": monto, "cantidad_ajustes": 1}},
+    )
+
+async def _cerrar_z_seguro(empresa_id: str, branch_id: str, hasta: datetime, origen: str) -> None:
+    try:
+        await _cerrar_z(empresa_id, branch_id, hasta, origen)
+    except Exception as e:
+        logger.error(f"Error generando cierre Z de la sucursal {branch_id}: {e}")
+
 
 # Cash Session routes
 @api_router.post("/cash-sessions", response_model=CashSession)
@@ -1507,10 +2528,12 @@ async def open_cash_session(session_data: CashSessionCreate, user: User = Depend
         branch_id=session_branch_id,
         user_id=user.id,
         monto_inicial=session_data.monto_inicial,
-        observaciones=session_data.observaciones
+        observaciones=session_data.observaciones,
+        totales_por_medio=True,
     )
 
     await db.cash_sessions.insert_one(session.dict())
+    await _invalidar_counts("cash_sessions", user.empresa_id)
 
     # Create opening movement
     movement = CashMovement(
@@ -1562,9 +2585,40 @@ async def close_cash_session(session_id: str, close_data: CashSessionClose, user
     )
     await db.cash_movements.insert_one(movement.dict())
 
+    # Última caja abierta de la sucursal: se congela el Z hasta acá
+    abiertas = await db.cash_sessions.count_documents({
+        "empresa_id": user.empresa_id, "branch_id": session["branch_id"], "status": CashSessionStatus.ABIERTA
+    })
+    if not abiertas:
+        _en_segundo_plano(_cerrar_z_seguro(user.empresa_id, session["branch_id"], update_data["fecha_cierre"], "cierre_caja"))
+
     updated_session = await db.cash_sessions.find_one({"id": session_id, "empresa_id": user.empresa_id})
     return CashSession(**updated_session)
 
+@api_router.post("/cash-sessions/{session_id}/withdrawals", response_model=CashMovement)
+async def create_cash_withdrawal(session_id: str, data: CashWithdrawalCreate, user: User = Depends(get_current_user)):
+    query = {"id": session_id, "empresa_id": user.empresa_id}
+    if user.rol != UserRole.ADMIN:
+        query["user_id"] = user.id
+    session = await db.cash_sessions.find_one(query, {"_id": 0, "status": 1})
+    if not session:
+        raise HTTPException(status_code=404, detail="Sesión de caja no encontrada")
+    if session["status"] == CashSessionStatus.CERRADA:
+        raise HTTPException(status_code=400, detail="La sesión ya está cerrada")
+
+    movement = CashMovement(
+        empresa_id=user.empresa_id,
+        session_id=session_id,
+        tipo=MovementType.RETIRO,
+        monto=-data.monto,
+        descripcion=f"Retiro de caja - {data.descripcion or ''}"
+    )
+    await asyncio.gather(
+        db.cash_movements.insert_one(movement.dict()),
+        _inc_sesion_caja(session_id, user.empresa_id, {"monto_retiros": data.monto}),
+    )
+    return movement
+
 @api_router.get("/cash-sessions/current", response_model=Optional[CashSession])
 async def get_current_cash_session(user: User = Depends(get_current_user)):
     if not user.branch_id:
@@ -1596,6 +2650,7 @@ async def get_cash_sessions_history(
     per_page: int = Query(20, ge=1, le=100),
     branch_id: Optional[str] = Query(None),
     user_id: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
 ):
     if user.rol == UserRole.CAJERO:
         raise HTTPException(status_code=403, detail="No tiene permisos para ver el historial")
@@ -1608,33 +2663,29 @@ async def get_cash_sessions_history(
     if user_id:
         query["user_id"] = user_id
 
-    total = await db.cash_sessions.count_documents(query)
-    skip = (page - 1) * per_page
-    sessions = await db.cash_sessions.find(query).sort("fecha_apertura", -1).skip(skip).limit(per_page).to_list(per_page)
+    sort = [("fecha_apertura", -1), ("id", -1)]
+    sessions, total = await _paginar_find(
+        "cash_sessions", query, sort, page, per_page, cursor, CountStrategy.CACHED, user.empresa_id
+    )
 
-    user_cache: dict = {}
-    branch_cache: dict = {}
+    loader = BatchLoader(user.empresa_id)
+    users_map = await loader.load_many("users", [s.get("user_id", "") for s in sessions], projection={"id": 1, "nombre": 1})
+    branches_map = await loader.load_many("branches", [s.get("branch_id", "") for s in sessions], projection={"id": 1, "nombre": 1})
     items = []
 
     for s in sessions:
         uid = s.get("user_id", "")
         bid = s.get("branch_id", "")
-
-        if uid not in user_cache:
-            u = await db.users.find_one({"id": uid})
-            user_cache[uid] = u["nombre"] if u else "Usuario desconocido"
-
-        if bid not in branch_cache:
-            b = await db.branches.find_one({"id": bid})
-            branch_cache[bid] = b["nombre"] if b else "Sucursal desconocida"
+        u = users_map.get(uid)
+        b = branches_map.get(bid)
 
         items.append(CashSessionHistory(
             id=s["id"],
             empresa_id=s["empresa_id"],
             branch_id=bid,
-            branch_nombre=branch_cache[bid],
+            branch_nombre=b["nombre"] if b else "Sucursal desconocida",
             user_id=uid,
-            user_nombre=user_cache[uid],
+            user_nombre=u["nombre"] if u else "Usuario desconocido",
             monto_inicial=s.get("monto_inicial", 0),
             monto_ventas=s.get("monto_ventas", 0),
             monto_retiros=s.get("monto_retiros", 0),
@@ -1652,6 +2703,7 @@ async def get_cash_sessions_history(
         "page": page,
         "per_page": per_page,
         "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": _next_cursor(sessions, sort, per_page),
     }
 
 # Auth routes
@@ -1768,7 +2820,7 @@ async def register_empresa(data: EmpresaRegister):
         plan_tipo="mensual",
         plan_tier="empresarial",
     )
-    await db.suscripciones.insert_one(suscripcion.dict())
+    await _insertar_suscripcion(suscripcion.dict())
 
     # Create default branch
     default_branch = Branch(
@@ -1972,6 +3024,7 @@ async def select_branch(data: SelectBranchRequest, current_user: User = Depends(
 async def create_category(category_data: CategoryCreate, user: User = Depends(require_role([UserRole.ADMIN]))):
     category = Category(**category_data.dict(), empresa_id=user.empresa_id)
     await db.categories.insert_one(category.dict())
+    await _invalidar_onboarding_counts(user.empresa_id)
     return category
 
 @api_router.get("/categories", response_model=List[Category])
@@ -2000,6 +3053,7 @@ async def delete_category(category_id: str, user: User = Depends(require_role([U
     if products_count > 0:
         raise HTTPException(status_code=400, detail=f"No se puede eliminar: {products_count} producto(s) usan esta categoría")
     await db.categories.delete_one({"id": category_id})
+    await _invalidar_onboarding_counts(user.empresa_id)
     return {"message": "Categoría eliminada"}
 
 # Branch Product routes
@@ -2021,7 +3075,7 @@ async def create_branch_product(product_data: BranchProductCreate, user: User =
     if existing:
         raise HTTPException(status_code=400, detail="Product already exists in this branch")
     data = {k: v for k, v in product_data.dict().items() if k != "branch_id"}
-    branch_product = BranchProduct(**data, branch_id=target_branch_id, empresa_id=user.empresa_id)
+    branch_product = BranchProduct(**data, branch_id=target_branch_id, empresa_id=user.empresa_id, **_bp_flags(product))
     await db.branch_products.insert_one(branch_product.dict())
     return branch_product
 
@@ -2032,7 +3086,7 @@ async def update_branch_product(branch_product_id: str, product_data: BranchProd
         raise HTTPException(status_code=404, detail="Branch product not found")
     update_data = {k: v for k, v in product_data.dict().items() if v is not None}
     if update_data:
-        await db.branch_products.update_one({"id": branch_product_id, "empresa_id": user.empresa_id}, {"$set": update_data})
+        await db.branch_products.update_one({"id": branch_product_id, "empresa_id": user.empresa_id}, _bp_stock_update(set_fields=update_data))
     updated = await db.branch_products.find_one({"id": branch_product_id, "empresa_id": user.empresa_id})
     return BranchProduct(**updated)
 
@@ -2060,33 +3114,38 @@ async def bulk_deactivate_branch_products(data: BranchProductBulkDeleteRequest,
     if not product_ids:
         return {"updated": 0}
 
-    existing_bps = await db.branch_products.find(
-        {"product_id": {"$in": product_ids}, "branch_id": branch_id, "empresa_id": user.empresa_id}
-    ).to_list(None)
-    existing_map = {bp["product_id"]: bp for bp in existing_bps}
-
-    updated = 0
-    for pid in product_ids:
-        if pid in existing_map:
-            await db.branch_products.update_one(
-                {"id": existing_map[pid]["id"]},
-                {"$set": {"activo": False}}
+    res = await db.branch_products.update_many(
+        {"product_id": {"$in": product_ids}, "branch_id": branch_id, "empresa_id": user.empresa_id},
+        {"$set": {"activo": False}}
+    )
+    updated = res.matched_count
+
+    # Los productos sin fila en la sucursal se dan de alta ya inactivos
+    sin_fila = product_ids
+    if updated:
+        con_fila = await db.branch_products.distinct(
+            "product_id", {"product_id": {"$in": product_ids}, "branch_id": branch_id, "empresa_id": user.empresa_id}
+        )
+        sin_fila = list(set(product_ids) - set(con_fila))
+    if sin_fila:
+        globales = await db.products.find(
+            {"id": {"$in": sin_fila}, "empresa_id": user.empresa_id},
+            {"_id": 0, "id": 1, "precio": 1, "stock": 1, "stock_minimo": 1, "kind": 1, "control_stock": 1}
+        ).to_list(None)
+
+        def armar(global_product: dict, bid: str) -> BranchProduct:
+            return BranchProduct(
+                product_id=global_product["id"],
+                branch_id=bid,
+                empresa_id=user.empresa_id,
+                precio=global_product.get("precio", 0),
+                stock=global_product.get("stock", 0),
+                stock_minimo=global_product.get("stock_minimo", 10),
+                activo=False,
+                **_bp_flags(global_product),
             )
-            updated += 1
-        else:
-            global_product = await db.products.find_one({"id": pid, "empresa_id": user.empresa_id})
-            if global_product:
-                bp = BranchProduct(
-                    product_id=pid,
-                    branch_id=branch_id,
-                    empresa_id=user.empresa_id,
-                    precio=global_product.get("precio", 0),
-                    stock=global_product.get("stock", 0),
-                    stock_minimo=global_product.get("stock_minimo", 10),
-                    activo=False
-                )
-                await db.branch_products.insert_one(bp.dict())
-                updated += 1
+
+        updated += await _aprovisionar_branch_products(user.empresa_id, globales, [branch_id], armar)
 
     return {"updated": updated}
 
@@ -2123,40 +3182,56 @@ async def get_branch_products(
     page: int = Query(1, ge=1),
     per_page: int = Query(50, ge=1, le=10000),
     search: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
     user: User = Depends(get_current_user)
 ):
     if not user.branch_id:
         raise HTTPException(status_code=400, detail="El usuario debe estar asignado a una sucursal")
 
-    base_pipeline = [
-        {"$match": {"branch_id": user.branch_id, "empresa_id": user.empresa_id, "activo": True}},
+    bp_match = {"branch_id": user.branch_id, "empresa_id": user.empresa_id, "activo": True}
+    join_stages = [
         {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "id", "as": "product"}},
         {"$unwind": "$product"},
         {"$project": {
             "_id": 0, "id": 1, "product_id": 1, "branch_id": 1, "empresa_id": 1,
-            "precio": 1, "precio_por_peso": 1, "stock": 1, "stock_minimo": 1, "activo": 1,
+            "precio": 1, "precio_por_peso": 1, "stock": 1, "stock_minimo": 1, "activo": 1, "created_at": 1,
             "nombre": "$product.nombre", "codigo_barras": "$product.codigo_barras",
             "tipo": "$product.tipo", "categoria_id": "$product.categoria_id",
             "control_stock": "$product.control_stock"
         }}
     ]
-
+    search_stages = []
     if search:
         regex = {"$regex": re.escape(search), "$options": "i"}
-        base_pipeline.append({"$match": {"$or": [{"nombre": regex}, {"codigo_barras": regex}]}})
-
-    count_result = await db.branch_products.aggregate(base_pipeline + [{"$count": "total"}]).to_list(1)
-    total = count_result[0]["total"] if count_result else 0
-
-    paginated_pipeline = base_pipeline + [{"$skip": (page - 1) * per_page}, {"$limit": per_page}]
-    items = await db.branch_products.aggregate(paginated_pipeline).to_list(per_page)
+        search_stages.append({"$match": {"$or": [{"nombre": regex}, {"codigo_barras": regex}]}})
+
+    # Orden por alta (created_at, id): sale del índice de branch_products antes del $lookup.
+    sort = [("created_at", 1), ("id", 1)]
+    paginado = [] if cursor else [{"$skip": (page - 1) * per_page}]
+    paginado.append({"$limit": per_page})
+    if search_stages:
+        # Con búsqueda hay que unir todo para filtrar: join una sola vez, página y total por $facet
+        items, total = await _pagina_facet(
+            "branch_products",
+            [{"$match": bp_match}, {"$sort": dict(sort)}] + join_stages + search_stages,
+            [{"$match": _keyset_query({}, sort, cursor)}] + paginado,
+        )
+    else:
+        # Sin búsqueda, el skip/limit va antes del join y solo se unen las filas de la página;
+        # el total es un count que resuelve el índice (branch_id, empresa_id, activo, ...).
+        pipeline = [{"$match": _keyset_query(bp_match, sort, cursor)}, {"$sort": dict(sort)}] + paginado + join_stages
+        items, total = await asyncio.gather(
+            db.branch_products.aggregate(pipeline).to_list(per_page),
+            _contar("branch_products", bp_match, CountStrategy.EXACT),
+        )
 
     return {
         "items": items,
         "total": total,
         "page": page,
         "per_page": per_page,
-        "total_pages": max(1, -(-total // per_page))
+        "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": _next_cursor(items, sort, per_page),
     }
 
 # Product routes
@@ -2185,30 +3260,29 @@ async def create_product(product_data: ProductCreate, user: User = Depends(requi
     if _cb:
         _pdoc['codigo_barras'] = _cb
     await db.products.insert_one(_pdoc)
+    await _invalidar_onboarding_counts(user.empresa_id)
+    await _invalidar_counts("products", user.empresa_id)
     # Auto-sync: create branch_products for all active branches of this empresa
-    branches = await db.branches.find({"activo": True, "empresa_id": user.empresa_id}).to_list(1000)
-    for branch in branches:
-        existing = await db.branch_products.find_one({
-            "product_id": product.id,
-            "branch_id": branch["id"],
-            "empresa_id": user.empresa_id
-        })
-        if not existing:
-            bp_kwargs = dict(
-                empresa_id=user.empresa_id,
-                product_id=product.id,
-                branch_id=branch["id"],
-                precio=product.precio,
-                precio_por_peso=product.precio_por_peso,
-                stock=product.stock,
-                stock_minimo=product.stock_minimo,
-            )
-            if precio_costo is not None:
-                bp_kwargs["costo"] = precio_costo
-            if margen is not None:
-                bp_kwargs["margen"] = margen
-            bp = BranchProduct(**bp_kwargs)
-            await db.branch_products.insert_one(bp.dict())
+    branches = await db.branches.find({"activo": True, "empresa_id": user.empresa_id}, {"id": 1}).to_list(1000)
+
+    def armar(pdoc: dict, branch_id: str) -> BranchProduct:
+        bp_kwargs = dict(
+            empresa_id=user.empresa_id,
+            product_id=product.id,
+            branch_id=branch_id,
+            precio=product.precio,
+            precio_por_peso=product.precio_por_peso,
+            stock=product.stock,
+            stock_minimo=product.stock_minimo,
+            **_bp_flags(pdoc),
+        )
+        if precio_costo is not None:
+            bp_kwargs["costo"] = precio_costo
+        if margen is not None:
+            bp_kwargs["margen"] = margen
+        return BranchProduct(**bp_kwargs)
+
+    await _aprovisionar_branch_products(user.empresa_id, [_pdoc], [b["id"] for b in branches], armar)
     return product
 
 @api_router.get("/products")
@@ -2219,6 +3293,7 @@ async def get_products(
     category_id: Optional[str] = Query(None),
     kind: Optional[str] = Query(None),
     activo: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None),
     user: User = Depends(get_current_user)
 ):
     query = {"empresa_id": user.empresa_id}
@@ -2230,9 +3305,12 @@ async def get_products(
         query["categoria_id"] = category_id
     if kind:
         query["kind"] = kind
-    total = await db.products.count_documents(query)
-    skip = (page - 1) * per_page
-    raw = await db.products.find(query).skip(skip).limit(per_page).to_list(per_page)
+    sort = [("nombre", 1), ("id", 1)]
+    count = CountStrategy.FACET if search else CountStrategy.CACHED
+    raw, total = await _paginar_find(
+        "products", query, sort, page, per_page, cursor, count, user.empresa_id
+    )
+    next_cursor = _next_cursor(raw, sort, per_page)
     result = []
     for p in raw:
         if p.get('kind') != 'combo' and p.get('control_stock') is None:
@@ -2248,7 +3326,8 @@ async def get_products(
         "total": total,
         "page": page,
         "per_page": per_page,
-        "total_pages": max(1, -(-total // per_page))
+        "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": next_cursor,
     }
 
 @api_router.get("/products/export")
@@ -2258,26 +3337,26 @@ async def export_products(
 ):
     if format not in ("csv", "xlsx"):
         format = "csv"
-    products = await db.products.find({"empresa_id": user.empresa_id, "activo": True}).to_list(10000)
     categories = await db.categories.find({"empresa_id": user.empresa_id}).to_list(1000)
     cat_map = {c["id"]: c["nombre"] for c in categories}
 
-    rows = []
-    for p in products:
-        rows.append({
-            "nombre": p.get("nombre"),
-            "codigo_barras": p.get("codigo_barras", ""),
-            "tipo": p.get("tipo"),
-            "clase": "Combo" if p.get("kind") == "combo" else "Normal",
-            "precio": p.get("precio"),
-            "precio_por_peso": p.get("precio_por_peso", ""),
-            "categoria": cat_map.get(p.get("categoria_id"), ""),
-            "stock": p.get("stock"),
-            "stock_minimo": p.get("stock_minimo"),
-            "activo": p.get("activo"),
-        })
-
-    return _rows_to_export_response(rows, "productos", format, sheet_name="Productos")
+    async def armar_filas(products):
+        return [[
+            p.get("nombre"),
+            p.get("codigo_barras", ""),
+            p.get("tipo"),
+            "Combo" if p.get("kind") == "combo" else "Normal",
+            p.get("precio"),
+            p.get("precio_por_peso", ""),
+            cat_map.get(p.get("categoria_id"), ""),
+            p.get("stock"),
+            p.get("stock_minimo"),
+            p.get("activo"),
+        ] for p in products]
+
+    columns = ["nombre", "codigo_barras", "tipo", "clase", "precio", "precio_por_peso", "categoria", "stock", "stock_minimo", "activo"]
+    cursor = db.products.find({"empresa_id": user.empresa_id, "activo": True}, {"_id": 0})
+    return await _export_response(columns, _lotes_cursor(cursor, armar_filas), "productos", format, sheet_name="Productos")
 
 @api_router.get("/products/import-template")
 async def get_import_template(user: User = Depends(require_role([UserRole.ADMIN]))):
@@ -2369,177 +3448,373 @@ async def get_import_template(user: User = Depends(require_role([UserRole.ADMIN]
         headers={"Content-Disposition": "attachment; filename=plantilla_productos.xlsx"},
     )
 
+# Filas por bulk_write en las importaciones (y por evento de progreso SSE)
+_IMPORT_CHUNK = 500
+
+async def _abrir_planilla_upload(file: UploadFile) -> Planilla:
+    """Copia el archivo subido a un temporal y lo abre para leerlo fila por fila.
+    Los XLSX se pasan a CSV en un proceso aparte (file_pool)."""
+    filename = (file.filename or "").lower()
+    if not filename.endswith((".xlsx", ".xls", ".csv")):
+        raise HTTPException(status_code=400, detail="Formato no soportado. Use CSV o XLSX.")
+    try:
+        path = await guardar_temporal(file)
+    except ArchivoMuyGrande as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not filename.endswith(".csv"):
+        fd, destino = tempfile.mkstemp(prefix="import_", suffix=".csv")
+        os.close(fd)
+        try:
+            await file_pool.run(xlsx_a_csv, path, destino)
+        except BaseException as e:
+            os.unlink(destino)
+            if isinstance(e, LimiteExcedido):
+                raise HTTPException(status_code=413, detail=f"El archivo es demasiado pesado para procesar: {str(e)}")
+            if isinstance(e, TrabajoError):
+                raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {str(e)}")
+            raise
+        finally:
+            os.unlink(path)
+        path = destino
+    try:
+        return await asyncio.to_thread(abrir_planilla, path)
+    except PlanillaError as e:
+        raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {str(e)}")
+
+async def _cerrar_al_terminar(planilla: Planilla, eventos):
+    """Envuelve el generador SSE de una importación y borra el temporal al terminar,
+    también si el cliente corta la conexión a mitad del stream."""
+    try:
+        async for evento in eventos:
+            yield evento
+    finally:
+        planilla.cerrar()
+
+
+_IMPORT_PRODUCTS_COLS = {"nombre", "tipo", "precio", "categoria"}
+
+def _hoja_df(chunk: list) -> pd.DataFrame:
+    """DataFrame de un lote de (linea, fila) de Planilla.filas, para import_plan."""
+    hoja = pd.DataFrame.from_records({"linea": linea, **fila} for linea, fila in chunk)
+    return hoja if "linea" in hoja.columns else pd.DataFrame(columns=["linea"])
+
+async def _catalogo_import(empresa_id: str) -> tuple:
+    """Catálogo de la empresa y agregado de sus branch_products, para import_plan.planificar."""
+    productos = await db.products.find(
+        {"empresa_id": empresa_id, "codigo_barras": {"$exists": True}},
+        {"_id": 0, "id": 1, "codigo_barras": 1, "nombre": 1, "tipo": 1, "kind": 1,
+         "precio": 1, "categoria_id": 1, "stock": 1, "stock_minimo": 1},
+    ).to_list(None)
+    def es_nulo(campo):
+        return {"$cond": [{"$eq": [{"$ifNull": [campo, None]}, None]}, 1, 0]}
+    stats = await db.branch_products.aggregate([
+        {"$match": {"empresa_id": empresa_id}},
+        {"$group": {
+            "_id": "$product_id",
+            "n_bp": {"$sum": 1},
+            "precio_min": {"$min": "$precio"}, "precio_max": {"$max": "$precio"},
+            "costo_min": {"$min": "$costo"}, "costo_max": {"$max": "$costo"}, "sin_costo": {"$sum": es_nulo("$costo")},
+            "margen_min": {"$min": "$margen"}, "margen_max": {"$max": "$margen"}, "sin_margen": {"$sum": es_nulo("$margen")},
+        }},
+    ], allowDiskUse=True).to_list(None)
+    catalogo = pd.DataFrame(productos, columns=[
+        "id", "codigo_barras", "nombre", "tipo", "kind", "precio", "categoria_id", "stock", "stock_minimo",
+    ])
+    sucursales = pd.DataFrame(stats, columns=[
+        "_id", "n_bp", "precio_min", "precio_max", "costo_min", "costo_max", "sin_costo",
+        "margen_min", "margen_max", "sin_margen",
+    ]).rename(columns={"_id": "product_id"})
+    return catalogo, sucursales
+
+@api_router.post("/products/import/preview")
+async def preview_import_products(
+    file: UploadFile = File(...),
+    limite: int = Query(200, ge=0, le=5000),
+    user: User = Depends(require_role([UserRole.ADMIN]))
+):
+    """Dry-run de /products/import: qué filas son nuevas, cuáles cambian y cuáles no, sin escribir nada."""
+    planilla = await _abrir_planilla_upload(file)
+    try:
+        missing = _IMPORT_PRODUCTS_COLS - set(planilla.columnas)
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Columnas faltantes: {', '.join(missing)}")
+        categories = await db.categories.find({"empresa_id": user.empresa_id}).to_list(1000)
+        cat_map = {c["nombre"].strip().lower(): c["id"] for c in categories}
+        cfg = await db.configuration.find_one({"empresa_id": user.empresa_id}) or {}
+        redondeo = cfg.get("redondeo_precio", 100)
+        catalogo, sucursales = await _catalogo_import(user.empresa_id)
+
+        # Se planifica por lotes a medida que se lee; Acumulado junta los duplicados
+        # entre lotes (manda la última fila, como al importar)
+        acumulado = import_plan.Acumulado(limite)
+        lineas = planilla.filas()
+        while True:
+            chunk = list(itertools.islice(lineas, _IMPORT_CHUNK))
+            if not chunk:
+                break
+            plan = await asyncio.to_thread(
+                import_plan.planificar, _hoja_df(chunk), catalogo, sucursales, cat_map, redondeo
+            )
+            acumulado.agregar(plan)
+    finally:
+        planilla.cerrar()
+
+    return {
+        "total": acumulado.total,
+        "resumen": acumulado.resumen,
+        "filas": acumulado.filas,
+    }
+
 @api_router.post("/products/import")
 async def import_products(
     file: UploadFile = File(...),
+    solo_cambios: bool = Query(True),
     user: User = Depends(require_role([UserRole.ADMIN]))
 ):
-    content = await file.read()
-    filename = file.filename or ""
-
-    try:
-        if filename.endswith(".xlsx") or filename.endswith(".xls"):
-            df = pd.read_excel(io.BytesIO(content))
-        elif filename.endswith(".csv"):
-            df = pd.read_csv(io.StringIO(content.decode("utf-8-sig")))
-        else:
-            raise HTTPException(status_code=400, detail="Formato no soportado. Use CSV o XLSX.")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {str(e)}")
+    planilla = await _abrir_planilla_upload(file)
 
-    required_cols = {"nombre", "tipo", "precio", "categoria"}
-    missing = required_cols - set(df.columns.str.strip().str.lower())
+    missing = _IMPORT_PRODUCTS_COLS - set(planilla.columnas)
     if missing:
+        planilla.cerrar()
         raise HTTPException(status_code=400, detail=f"Columnas faltantes: {', '.join(missing)}")
 
-    df.columns = df.columns.str.strip().str.lower()
-
-    await db.products.update_many({"codigo_barras": None}, {"$unset": {"codigo_barras": ""}})
-    try:
-        await db.command("dropIndexes", "products", index="empresa_id_1_codigo_barras_1")
-    except Exception:
-        pass
-    try:
-        await db.command({
-            "createIndexes": "products",
-            "indexes": [{"key": {"empresa_id": 1, "codigo_barras": 1}, "name": "empresa_id_1_codigo_barras_1", "unique": True, "sparse": True}]
-        })
-    except Exception as _e:
-        logger.error(f"FAILED to create sparse index: {_e}")
-
     categories = await db.categories.find({"empresa_id": user.empresa_id}).to_list(1000)
     cat_map = {c["nombre"].strip().lower(): c["id"] for c in categories}
     cat_name_map = {c["nombre"].strip().lower(): c["nombre"].strip() for c in categories}
     branches = await db.branches.find({"activo": True, "empresa_id": user.empresa_id}).to_list(1000)
     empresa_id = user.empresa_id
-    total_rows = len(df)
+    total_rows = planilla.total
 
     cfg = await db.configuration.find_one({"empresa_id": empresa_id}) or {}
     redondeo = cfg.get("redondeo_precio", 100)
 
-    def _redondear(valor: float) -> float:
-        import math
-        if not redondeo:
-            return round(valor, 2)
-        return math.ceil(valor / redondeo) * redondeo
+    # Con solo_cambios cada lote se cruza con el catálogo (import_plan) y se saltean las
+    # filas que no cambiarían nada; el catálogo se lee una vez, al empezar
+    if solo_cambios:
+        catalogo, sucursales = await _catalogo_import(empresa_id)
+
+    # Códigos de barras existentes de la empresa: una sola consulta en vez de un find_one por fila
+    existentes = {
+        p["codigo_barras"]: p["id"]
+        async for p in db.products.find(
+            {"empresa_id": empresa_id, "codigo_barras": {"$exists": True}},
+            {"_id": 0, "id": 1, "codigo_barras": 1},
+        )
+    }
+
+    def _parse_row(fila: dict) -> dict:
+        """Producto de una fila ya normalizada por import_plan.normalizar."""
+        costo = None if pd.isna(fila["costo"]) else float(fila["costo"])
+        margen = None if pd.isna(fila["margen"]) else float(fila["margen"])
+        return {
+            "categoria": fila["categoria"],
+            "costo": costo,
+            "margen": margen,
+            "product_data": {
+                "nombre": fila["nombre"],
+                "codigo_barras": fila["codigo_barras"] or f"INT-{uuid.uuid4().hex[:10].upper()}",
+                "tipo": fila["tipo"],
+                "kind": fila["kind"],
+                "precio": float(fila["precio"]),
+                "stock": int(fila["stock"]),
+                "stock_minimo": int(fila["stock_minimo"]),
+            },
+        }
+
+    async def _flush(nuevas_cats: list, altas: dict, cambios: dict, errors: list) -> tuple:
+        """Escribe un chunk con bulk_write desordenados. Devuelve (creados, actualizados).
+
+        Los conteos salen del resultado del bulk_write (o de los detalles del
+        BulkWriteError); las filas repetidas de un producto cuentan como actualizadas solo
+        si su escritura entró. Las filas cuya escritura falló, en products o en
+        branch_products, van a errors y no se cuentan."""
+        if nuevas_cats:
+            # Otra importación o un alta a mano pueden crear la misma categoría a la par
+            # (índice único empresa + nombre): se upsertea y se releen los ids, y los
+            # productos del chunk pasan a apuntar a la categoría que quedó guardada
+            try:
+                await db.categories.bulk_write([
+                    UpdateOne({"empresa_id": empresa_id, "nombre": c.nombre}, {"$setOnInsert": c.dict()}, upsert=True)
+                    for c in nuevas_cats
+                ], ordered=False)
+            except BulkWriteError as bwe:
+                if any(werr.get("code") != 11000 for werr in bwe.details.get("writeErrors", [])):
+                    raise
+            guardadas = {
+                c["nombre"]: c["id"]
+                async for c in db.categories.find(
+                    {"empresa_id": empresa_id, "nombre": {"$in": [c.nombre for c in nuevas_cats]}},
+                    {"_id": 0, "id": 1, "nombre": 1},
+                )
+            }
+            remap = {c.id: guardadas[c.nombre] for c in nuevas_cats if guardadas.get(c.nombre, c.id) != c.id}
+            for c in nuevas_cats:
+                if c.id in remap:
+                    cat_map[c.nombre.lower()] = remap[c.id]
+            for data in [a[0] for a in altas.values()] + [c[0] for c in cambios.values()]:
+                if data.get("categoria_id") in remap:
+                    data["categoria_id"] = remap[data["categoria_id"]]
+
+        ops, lineas_ops = [], []
+        for doc, _costo, _margen, lineas in altas.values():
+            ops.append(InsertOne(doc))
+            lineas_ops.append(lineas)
+        for product_id, (product_data, _bp_update, lineas) in cambios.items():
+            ops.append(UpdateOne({"id": product_id, "empresa_id": empresa_id}, {"$set": product_data}))
+            lineas_ops.append(lineas)
+        creados = actualizados = 0
+        fallidas = set()
+        if ops:
+            try:
+                res = await db.products.bulk_write(ops, ordered=False)
+                creados, actualizados = res.inserted_count, res.matched_count
+            except BulkWriteError as bwe:
+                creados, actualizados = bwe.details.get("nInserted", 0), bwe.details.get("nMatched", 0)
+                for werr in bwe.details.get("writeErrors", []):
+                    fallidas.add(werr["index"])
+                    for linea in lineas_ops[werr["index"]]:
+                        errors.append(f"Fila {linea}: {werr.get('errmsg', 'error de escritura')}")
+        # Las filas de más sobre un mismo producto (la última gana) cuentan como actualizadas
+        actualizados += sum(len(lineas) - 1 for i, lineas in enumerate(lineas_ops) if i not in fallidas)
+
+        bp_ops, bp_origen = [], []  # bp_origen: índice en ops del producto de cada bp_op
+        for i, (doc, costo, margen, _lineas) in enumerate(altas.values()):
+            if i in fallidas:
+                continue
+            existentes[doc["codigo_barras"]] = doc["id"]
+            for branch in branches:
+                bp_data = dict(
+                    empresa_id=empresa_id,
+                    product_id=doc["id"],
+                    branch_id=branch["id"],
+                    precio=doc["precio"],
+                    precio_por_peso=doc.get("precio_por_peso"),
+                    stock=doc["stock"],
+                    stock_minimo=doc["stock_minimo"],
+                    **_bp_flags(doc),
+                )
+                if costo is not None:
+                    bp_data["costo"] = costo
+                if margen is not None:
+                    bp_data["margen"] = margen
+                bp_ops.append(InsertOne(BranchProduct(**bp_data).dict()))
+                bp_origen.append(i)
+        for i, (product_id, (_data, bp_update, _lineas)) in enumerate(cambios.items(), start=len(altas)):
+            if i in fallidas:
+                continue
+            bp_ops.append(UpdateMany(
+                {"product_id": product_id, "empresa_id": empresa_id},
+                _bp_stock_update(set_fields=bp_update),
+            ))
+            bp_origen.append(i)
+        if bp_ops:
+            try:
+                await db.branch_products.bulk_write(bp_ops, ordered=False)
+            except BulkWriteError as bwe:
+                # El producto quedó escrito pero no en (todas) sus sucursales: sus filas
+                # pasan de los conteos a errors, una vez por producto
+                sin_sucursal = {}
+                for werr in bwe.details.get("writeErrors", []):
+                    sin_sucursal.setdefault(bp_origen[werr["index"]], werr.get("errmsg", "error de escritura"))
+                for i, errmsg in sin_sucursal.items():
+                    lineas = lineas_ops[i]
+                    if i < len(altas):
+                        creados -= 1
+                        actualizados -= len(lineas) - 1
+                    else:
+                        actualizados -= len(lineas)
+                    for linea in lineas:
+                        errors.append(f"Fila {linea}: no se pudo escribir en las sucursales: {errmsg}")
+                logger.error(f"Import de productos: {len(bwe.details.get('writeErrors', []))} errores en branch_products")
+        return creados, actualizados
 
     async def generate():
         created = 0
         updated = 0
         errors = []
         new_categories = []
-
-        for idx, row in df.iterrows():
-            try:
-                cat_nombre_raw = str(row.get("categoria", "")).strip()
-                cat_nombre = cat_nombre_raw.lower()
-                categoria_id = cat_map.get(cat_nombre)
-                if not categoria_id:
-                    new_cat = Category(empresa_id=empresa_id, nombre=cat_nombre_raw)
-                    await db.categories.insert_one(new_cat.dict())
-                    cat_map[cat_nombre] = new_cat.id
-                    cat_name_map[cat_nombre] = cat_nombre_raw
-                    new_categories.append(cat_nombre_raw)
-                    categoria_id = new_cat.id
-
-                raw_barcode = row.get("codigo_barras")
-                if pd.notna(raw_barcode) and str(raw_barcode).strip() not in ("", "nan"):
-                    try:
-                        codigo_barras = str(int(float(str(raw_barcode).strip())))
-                    except (ValueError, OverflowError):
-                        codigo_barras = str(raw_barcode).strip()
-                else:
-                    codigo_barras = f"INT-{uuid.uuid4().hex[:10].upper()}"
-
-                tipo = str(row.get("tipo", "codigo_barras")).strip()
-                if tipo not in ("codigo_barras", "por_peso"):
-                    tipo = "codigo_barras"
-
-                raw_stock = row.get("stock")
-                stock = int(float(raw_stock)) if pd.notna(raw_stock) and str(raw_stock).strip() not in ("", "nan") else 0
-
-                raw_stock_min = row.get("stock_minimo")
-                stock_minimo = int(float(raw_stock_min)) if pd.notna(raw_stock_min) and str(raw_stock_min).strip() not in ("", "nan") else 10
-
-                raw_clase = row.get("clase", "")
-                kind = "combo" if str(raw_clase).strip().lower() == "combo" else "normal"
-
-                precio_raw = _redondear(float(row["precio"]))
-
-                raw_costo = row.get("precio_costo")
-                precio_costo = float(raw_costo) if pd.notna(raw_costo) and str(raw_costo).strip() not in ("", "nan") else None
-                margen = round((precio_raw - precio_costo) / precio_costo * 100, 2) if precio_costo else None
-
-                product_data = {
-                    "nombre": str(row["nombre"]).strip(),
-                    "codigo_barras": codigo_barras,
-                    "tipo": tipo,
-                    "kind": kind,
-                    "precio": precio_raw,
-                    "categoria_id": categoria_id,
-                    "stock": stock,
-                    "stock_minimo": stock_minimo,
-                }
-                existing = None
-                if codigo_barras and not codigo_barras.startswith("INT-"):
-                    existing = await db.products.find_one({"codigo_barras": codigo_barras, "empresa_id": empresa_id})
-
-                if existing:
-                    await db.products.update_one(
-                        {"id": existing["id"], "empresa_id": empresa_id},
-                        {"$set": product_data}
-                    )
-                    bp_update = {"precio": precio_raw}
-                    if precio_costo is not None:
-                        bp_update["costo"] = precio_costo
-                    if margen is not None:
-                        bp_update["margen"] = margen
-                    await db.branch_products.update_many(
-                        {"product_id": existing["id"], "empresa_id": empresa_id},
-                        {"$set": bp_update}
-                    )
-                    updated += 1
-                else:
-                    product_data['codigo_barras'] = codigo_barras
-                    product = Product(**product_data, empresa_id=empresa_id)
-                    _pdoc = {k: v for k, v in product.model_dump().items() if v is not None}
-                    await db.products.insert_one(_pdoc)
-                    for branch in branches:
-                        bp_exists = await db.branch_products.find_one({
-                            "product_id": product.id,
-                            "branch_id": branch["id"],
-                            "empresa_id": empresa_id
-                        })
-                        if not bp_exists:
-                            bp_data = dict(
-                                empresa_id=empresa_id,
-                                product_id=product.id,
-                                branch_id=branch["id"],
-                                precio=product.precio,
-                                precio_por_peso=product.precio_por_peso,
-                                stock=product.stock,
-                                stock_minimo=product.stock_minimo,
-                            )
-                            if precio_costo is not None:
-                                bp_data["costo"] = precio_costo
-                            if margen is not None:
-                                bp_data["margen"] = margen
-                            bp = BranchProduct(**bp_data)
-                            await db.branch_products.insert_one(bp.dict())
-                    created += 1
-
-            except Exception as e:
-                errors.append(f"Fila {idx + 2}: {str(e)}")
-
-            progress = int(((idx + 1) / total_rows) * 100)
-            yield f"data: {json.dumps({'progress': progress, 'processed': idx + 1, 'total': total_rows})}\n\n"
+        procesadas = 0
+        sin_cambios = 0
+        # Códigos ya escritos en esta importación: el catálogo del plan es el del
+        # principio, así que una fila sobre uno de ellos no se puede dar por sin cambios
+        tocados = set()
+
+        # Se arma cada chunk en memoria y se escribe con dos bulk_write (products y branch_products)
+        lineas = planilla.filas()
+        while True:
+            chunk = list(itertools.islice(lineas, _IMPORT_CHUNK))
+            if not chunk:
+                break
+            if solo_cambios:
+                plan = await asyncio.to_thread(
+                    import_plan.planificar, _hoja_df(chunk), catalogo, sucursales, cat_map, redondeo
+                )
+            else:
+                plan = await asyncio.to_thread(import_plan.normalizar, _hoja_df(chunk), cat_map, redondeo)
+            nuevas_cats = []
+            # Con un código repetido en el chunk la última fila gana; lineas junta todas
+            altas = {}    # codigo_barras -> (doc, costo, margen, lineas)
+            cambios = {}  # product_id -> (product_data, bp_update, lineas)
+            for fila in plan.to_dict("records"):
+                linea = fila["linea"]
+                if import_plan.omitible(fila, tocados):
+                    sin_cambios += 1
+                    continue
+                if fila["error"]:
+                    errors.append(f"Fila {linea}: {fila['error']}")
+                    continue
+                try:
+                    r = _parse_row(fila)
+                    cat_nombre = r["categoria"].lower()
+                    categoria_id = cat_map.get(cat_nombre)
+                    if not categoria_id:
+                        new_cat = Category(empresa_id=empresa_id, nombre=r["categoria"])
+                        nuevas_cats.append(new_cat)
+                        cat_map[cat_nombre] = new_cat.id
+                        cat_name_map[cat_nombre] = r["categoria"]
+                        new_categories.append(r["categoria"])
+                        categoria_id = new_cat.id
+                    product_data = {**r["product_data"], "categoria_id": categoria_id}
+                    codigo_barras = product_data["codigo_barras"]
+                    tocados.add(codigo_barras)
+
+                    existing_id = existentes.get(codigo_barras) if not codigo_barras.startswith("INT-") else None
+                    if existing_id:
+                        bp_update = {"precio": product_data["precio"], "kind": product_data["kind"]}
+                        if r["costo"] is not None:
+                            bp_update["costo"] = r["costo"]
+                        if r["margen"] is not None:
+                            bp_update["margen"] = r["margen"]
+                        lineas = cambios[existing_id][2] if existing_id in cambios else []
+                        cambios[existing_id] = (product_data, bp_update, lineas + [linea])
+                    else:
+                        previo = altas.get(codigo_barras)
+                        if previo:
+                            # Código repetido dentro del chunk: se pisa el alta pendiente (mismo id)
+                            product_data["id"] = previo[0]["id"]
+                        product = Product(**product_data, empresa_id=empresa_id)
+                        _pdoc = {k: v for k, v in product.model_dump().items() if v is not None}
+                        lineas = previo[3] if previo else []
+                        altas[codigo_barras] = (_pdoc, r["costo"], r["margen"], lineas + [linea])
+                except Exception as e:
+                    errors.append(f"Fila {linea}: {str(e)}")
+
+            creados, actualizados = await _flush(nuevas_cats, altas, cambios, errors)
+            created += creados
+            updated += actualizados
+            procesadas += len(chunk)
+            progress = min(100, int((procesadas / max(total_rows, 1)) * 100))
+            yield f"data: {json.dumps({'progress': progress, 'processed': procesadas, 'total': total_rows})}\n\n"
             await asyncio.sleep(0)
 
-        yield f"data: {json.dumps({'done': True, 'created': created, 'updated': updated, 'errors': errors, 'total_procesado': created + updated + len(errors), 'new_categories': new_categories})}\n\n"
+        await _invalidar_onboarding_counts(empresa_id)
+        await _invalidar_counts("products", empresa_id)
+        yield f"data: {json.dumps({'done': True, 'created': created, 'updated': updated, 'sin_cambios': sin_cambios, 'errors': errors, 'total_procesado': created + updated + sin_cambios + len(errors), 'new_categories': new_categories})}\n\n"
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return StreamingResponse(
+        _cerrar_al_terminar(planilla, generate()),
+        media_type="text/event-stream",
+    )
 
 
 @api_router.get("/branch-products/import-template")
@@ -2679,28 +3954,14 @@ async def import_branch_products(
     if not branch:
         raise HTTPException(status_code=404, detail="Sucursal no encontrada")
 
-    content = await file.read()
-    filename = file.filename or ""
-
-    try:
-        if filename.endswith(".xlsx") or filename.endswith(".xls"):
-            df = pd.read_excel(io.BytesIO(content))
-        elif filename.endswith(".csv"):
-            df = pd.read_csv(io.StringIO(content.decode("utf-8-sig")))
-        else:
-            raise HTTPException(status_code=400, detail="Formato no soportado. Use CSV o XLSX.")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {str(e)}")
-
-    df.columns = df.columns.str.strip().str.lower()
+    planilla = await _abrir_planilla_upload(file)
 
-    if "codigo_barras" not in df.columns:
+    if "codigo_barras" not in planilla.columnas:
+        planilla.cerrar()
         raise HTTPException(status_code=400, detail="Columna 'codigo_barras' es requerida.")
 
     empresa_id = user.empresa_id
-    total_rows = len(df)
+    total_rows = planilla.total
 
     cfg = await db.configuration.find_one({"empresa_id": empresa_id}) or {}
     redondeo = cfg.get("redondeo_precio", 100)
@@ -2732,12 +3993,12 @@ async def import_branch_products(
         imported_barcodes = set()   # barcodes procesados con éxito
         new_product_ids = []        # IDs de productos creados en esta importación
 
-        for idx, row in df.iterrows():
+        for idx, (linea, row) in enumerate(planilla.filas()):
             try:
                 raw_barcode = row.get("codigo_barras")
                 if pd.isna(raw_barcode) or str(raw_barcode).strip() in ("", "nan"):
                     skipped += 1
-                    yield f"data: {json.dumps({'progress': int(((idx+1)/total_rows)*100), 'processed': idx+1, 'total': total_rows})}\n\n"
+                    yield f"data: {json.dumps({'progress': min(100, int(((idx+1)/max(total_rows, 1))*100)), 'processed': idx+1, 'total': total_rows})}\n\n"
                     await asyncio.sleep(0)
                     continue
 
@@ -2767,8 +4028,8 @@ async def import_branch_products(
                     raw_clase = str(row.get("clase", "")).strip().lower()
 
                     if not raw_nombre or precio_venta is None or not raw_categoria:
-                        errors.append(f"Fila {idx+2}: código '{codigo_barras}' no encontrado. Para crear el producto complete nombre, precio_venta y categoria.")
-                        yield f"data: {json.dumps({'progress': int(((idx+1)/total_rows)*100), 'processed': idx+1, 'total': total_rows})}\n\n"
+                        errors.append(f"Fila {linea}: código '{codigo_barras}' no encontrado. Para crear el producto complete nombre, precio_venta y categoria.")
+                        yield f"data: {json.dumps({'progress': min(100, int(((idx+1)/max(total_rows, 1))*100)), 'processed': idx+1, 'total': total_rows})}\n\n"
                         await asyncio.sleep(0)
                         continue
 
@@ -2809,12 +4070,13 @@ async def import_branch_products(
                         costo=precio_costo,
                         margen=margen,
                         activo=True,
+                        **_bp_flags(_pdoc),
                     )
                     await db.branch_products.insert_one(new_bp.dict())
                     imported_barcodes.add(codigo_barras)
                     new_product_ids.append(new_product.id)
                     created += 1
-                    yield f"data: {json.dumps({'progress': int(((idx+1)/total_rows)*100), 'processed': idx+1, 'total': total_rows})}\n\n"
+                    yield f"data: {json.dumps({'progress': min(100, int(((idx+1)/max(total_rows, 1))*100)), 'processed': idx+1, 'total': total_rows})}\n\n"
                     await asyncio.sleep(0)
                     continue
 
@@ -2840,7 +4102,7 @@ async def import_branch_products(
                     # Sin datos editables pero el barcode está en el archivo: contar como importado
                     imported_barcodes.add(codigo_barras)
                     skipped += 1
-                    yield f"data: {json.dumps({'progress': int(((idx+1)/total_rows)*100), 'processed': idx+1, 'total': total_rows})}\n\n"
+                    yield f"data: {json.dumps({'progress': min(100, int(((idx+1)/max(total_rows, 1))*100)), 'processed': idx+1, 'total': total_rows})}\n\n"
                     await asyncio.sleep(0)
                     continue
 
@@ -2849,7 +4111,7 @@ async def import_branch_products(
                     bp_update["activo"] = True
                     await db.branch_products.update_one(
                         {"id": existing_bp["id"], "empresa_id": empresa_id},
-                        {"$set": bp_update}
+                        _bp_stock_update(set_fields=bp_update)
                     )
                 else:
                     new_bp = BranchProduct(
@@ -2862,6 +4124,7 @@ async def import_branch_products(
                         costo=bp_update.get("costo"),
                         margen=bp_update.get("margen"),
                         activo=True,
+                        **_bp_flags(product),
                     )
                     await db.branch_products.insert_one(new_bp.dict())
 
@@ -2869,9 +4132,9 @@ async def import_branch_products(
                 updated += 1
 
             except Exception as e:
-                errors.append(f"Fila {idx+2}: {str(e)}")
+                errors.append(f"Fila {linea}: {str(e)}")
 
-            yield f"data: {json.dumps({'progress': int(((idx+1)/total_rows)*100), 'processed': idx+1, 'total': total_rows})}\n\n"
+            yield f"data: {json.dumps({'progress': min(100, int(((idx+1)/max(total_rows, 1))*100)), 'processed': idx+1, 'total': total_rows})}\n\n"
             await asyncio.sleep(0)
 
         # --- Lista completa: desactivar lo que no vino en el archivo ---
@@ -2895,6 +4158,7 @@ async def import_branch_products(
                         precio=prod.get("precio", 0),
                         stock=0,
                         activo=False,
+                        **_bp_flags(prod),
                     )
                     await db.branch_products.insert_one(bp_inactivo.dict())
                     desactivados += 1
@@ -2916,12 +4180,18 @@ async def import_branch_products(
                                 precio=new_prod.get("precio", 0),
                                 stock=0,
                                 activo=False,
+                                **_bp_flags(new_prod),
                             )
                             await db.branch_products.insert_one(bp_ob.dict())
 
+        await _invalidar_onboarding_counts(empresa_id)
+        await _invalidar_counts("products", empresa_id)
         yield f"data: {json.dumps({'done': True, 'created': created, 'updated': updated, 'skipped': skipped, 'desactivados': desactivados, 'errors': errors, 'total_procesado': created + updated + skipped + len(errors)})}\n\n"
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return StreamingResponse(
+        _cerrar_al_terminar(planilla, generate()),
+        media_type="text/event-stream",
+    )
 
 
 @api_router.get("/products/{product_id}", response_model=Product)
@@ -2955,6 +4225,10 @@ async def bulk_update_control_stock(data: BulkUpdateControlStockRequest, user: U
         {"id": {"$in": ids}, "empresa_id": user.empresa_id, "kind": {"$ne": "combo"}},
         {"$set": {"control_stock": data.control_stock}}
     )
+    await db.branch_products.update_many(
+        {"product_id": {"$in": ids}, "empresa_id": user.empresa_id, "kind": {"$ne": "combo"}},
+        _bp_stock_update(set_fields={"control_stock": data.control_stock})
+    )
     return {"updated": result.modified_count}
 
 @api_router.put("/products/{product_id}", response_model=Product)
@@ -2982,6 +4256,11 @@ async def update_product(product_id: str, product_data: ProductUpdate, user: Use
 
     if update_data:
         await db.products.update_one({"id": product_id, "empresa_id": user.empresa_id}, {"$set": update_data})
+        await _invalidar_counts("products", user.empresa_id)
+        if 'activo' in update_data:
+            await _invalidar_onboarding_counts(user.empresa_id)
+        if 'control_stock' in update_data or 'kind' in update_data:
+            await _sync_bp_product_flags(user.empresa_id, [{**existing_product, **update_data}])
 
     # Update costo/margen in all branch_products if precio_costo provided
     # Use aggregation pipeline so each branch recomputes margen from its own precio
@@ -3024,6 +4303,8 @@ async def bulk_delete_products(data: BulkDeleteRequest, user: User = Depends(req
         return {"deleted": 0}
     result = await db.products.delete_many({"id": {"$in": ids}, "empresa_id": user.empresa_id})
     await db.branch_products.delete_many({"product_id": {"$in": ids}, "empresa_id": user.empresa_id})
+    await _invalidar_onboarding_counts(user.empresa_id)
+    await _invalidar_counts("products", user.empresa_id)
     return {"deleted": result.deleted_count}
 
 @api_router.delete("/products/{product_id}")
@@ -3033,10 +4314,29 @@ async def delete_product(product_id: str, user: User = Depends(require_role([Use
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     await db.products.delete_one({"id": product_id, "empresa_id": user.empresa_id})
     await db.branch_products.delete_many({"product_id": product_id, "empresa_id": user.empresa_id})
+    await _invalidar_onboarding_counts(user.empresa_id)
+    await _invalidar_counts("products", user.empresa_id)
     return {"ok": True}
 
 # ===== CUSTOMERS =====
 
+# Claves normalizadas del documento para detectar duplicados con búsquedas por índice:
+#   documento_digitos: solo los dígitos (para DNI/CUIT/CUIL; "20-12345678-9" -> "20123456789")
+#   documento_dni:     el DNI sin ceros a la izquierda; en CUIT/CUIL, el de las posiciones 2-9
+# Se recalculan en cada alta/edición (Customer.calc_documento) y migrar_documentos_clientes
+# completa los clientes anteriores.
+_TIPOS_DOC_NUMERICOS = ("dni", "cuit", "cuil")
+
+def _documento_claves(tipo_documento: Optional[str], documento: Optional[str]) -> dict:
+    tipo = (tipo_documento or "").lower()
+    digitos = re.sub(r"\D", "", documento or "") if tipo in _TIPOS_DOC_NUMERICOS else ""
+    dni = None
+    if tipo == "dni" and digitos:
+        dni = str(int(digitos))
+    elif tipo in ("cuit", "cuil") and len(digitos) == 11:
+        dni = str(int(digitos[2:10]))
+    return {"documento_digitos": digitos or None, "documento_dni": dni}
+
 class Customer(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     empresa_id: str
@@ -3050,6 +4350,13 @@ class Customer(BaseModel):
     observaciones: Optional[str] = None
     activo: bool = True
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    documento_digitos: Optional[str] = None
+    documento_dni: Optional[str] = None
+
+    @root_validator(skip_on_failure=True)
+    def calc_documento(cls, values):
+        values.update(_documento_claves(values.get("tipo_documento"), values.get("documento")))
+        return values
 
 class CustomerCreate(BaseModel):
     nombre: str
@@ -3088,6 +4395,7 @@ class CustomerBulkUpdateRequest(BaseModel):
 async def create_customer(customer_data: CustomerCreate, user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR, UserRole.CAJERO]))):
     customer = Customer(**customer_data.dict(), empresa_id=user.empresa_id)
     await db.customers.insert_one(customer.model_dump())
+    await _invalidar_counts("customers", user.empresa_id)
     return customer
 
 @api_router.get("/customers")
@@ -3096,6 +4404,7 @@ async def get_customers(
     per_page: int = Query(50, ge=1, le=10000),
     search: Optional[str] = Query(None),
     activo: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None),
     user: User = Depends(get_current_user)
 ):
     query = {"empresa_id": user.empresa_id}
@@ -3109,9 +4418,12 @@ async def get_customers(
             {"email": regex},
             {"telefono": regex},
         ]
-    total = await db.customers.count_documents(query)
-    skip = (page - 1) * per_page
-    raw = await db.customers.find(query).sort("nombre", 1).skip(skip).limit(per_page).to_list(per_page)
+    sort = [("nombre", 1), ("id", 1)]
+    count = CountStrategy.FACET if search else CountStrategy.CACHED
+    raw, total = await _paginar_find(
+        "customers", query, sort, page, per_page, cursor, count, user.empresa_id
+    )
+    next_cursor = _next_cursor(raw, sort, per_page)
     result = []
     for c in raw:
         try:
@@ -3123,7 +4435,8 @@ async def get_customers(
         "total": total,
         "page": page,
         "per_page": per_page,
-        "total_pages": max(1, -(-total // per_page))
+        "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": next_cursor,
     }
 
 @api_router.get("/customers/check-documento")
@@ -3145,49 +4458,28 @@ async def check_documento_existente(
 
     def _hit(doc): return {"existe": True, **{k: doc.get(k) for k in CUSTOMER_PROJ if k != "_id"}}
 
-    # 1. Coincidencia exacta (mismo tipo + mismo valor)
-    exact = await db.customers.find_one(
-        {**base_q, "tipo_documento": tipo, "documento": documento}, CUSTOMER_PROJ,
-    )
+    # 1. Coincidencia exacta (mismo tipo + mismo documento; en DNI/CUIT/CUIL sin guiones ni espacios)
+    claves = _documento_claves(tipo, documento)
+    if claves["documento_digitos"]:
+        exact_q = {**base_q, "tipo_documento": tipo, "documento_digitos": claves["documento_digitos"]}
+    else:
+        exact_q = {**base_q, "tipo_documento": tipo, "documento": documento}
+    exact = await db.customers.find_one(exact_q, CUSTOMER_PROJ)
     if exact:
         return _hit(exact)
 
-    # Helper: strip guiones/espacios del documento almacenado
-    strip_expr = {
-        "$replaceAll": {
-            "input": {"$replaceAll": {"input": "$documento", "find": "-", "replacement": ""}},
-            "find": " ", "replacement": "",
-        }
-    }
-
-    # 2. DNI → busca CUIT/CUIL que contengan ese DNI en las posiciones 2-9
+    # 2. DNI → busca CUIT/CUIL con ese DNI en las posiciones 2-9
     if tipo == "dni" and len(clean) >= 7:
-        dni_padded = clean.zfill(8)
-        pipeline = [
-            {"$match": {**base_q, "tipo_documento": {"$in": ["cuit", "cuil"]}}},
-            {"$addFields": {"doc_digits": strip_expr}},
-            {"$match": {"$expr": {"$eq": [{"$substr": ["$doc_digits", 2, 8]}, dni_padded]}}},
-            {"$limit": 1},
-            {"$project": CUSTOMER_PROJ},
-        ]
-        rows = await db.customers.aggregate(pipeline).to_list(1)
-        if rows:
-            return _hit(rows[0])
-
-    # 3. CUIT/CUIL → extrae el DNI de las posiciones 2-9 y busca clientes con ese DNI
+        cruce_q = {**base_q, "documento_dni": claves["documento_dni"], "tipo_documento": {"$in": ["cuit", "cuil"]}}
+    # 3. CUIT/CUIL → busca clientes con el DNI de las posiciones 2-9
     elif tipo in ("cuit", "cuil") and len(clean) == 11:
-        dni_from_cuit = clean[2:10]
-        dni_no_pad    = str(int(dni_from_cuit))
-        pipeline = [
-            {"$match": {**base_q, "tipo_documento": "dni"}},
-            {"$addFields": {"doc_digits": strip_expr}},
-            {"$match": {"$or": [{"doc_digits": dni_from_cuit}, {"doc_digits": dni_no_pad}]}},
-            {"$limit": 1},
-            {"$project": CUSTOMER_PROJ},
-        ]
-        rows = await db.customers.aggregate(pipeline).to_list(1)
-        if rows:
-            return _hit(rows[0])
+        cruce_q = {**base_q, "documento_dni": claves["documento_dni"], "tipo_documento": "dni"}
+    else:
+        cruce_q = None
+    if cruce_q:
+        row = await db.customers.find_one(cruce_q, CUSTOMER_PROJ)
+        if row:
+            return _hit(row)
 
     return {"existe": False}
 
@@ -3204,8 +4496,14 @@ async def update_customer(customer_id: str, customer_data: CustomerUpdate, user:
     if not c:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
     update_data = {k: v for k, v in customer_data.dict().items() if v is not None}
+    if "tipo_documento" in update_data or "documento" in update_data:
+        update_data.update(_documento_claves(
+            update_data.get("tipo_documento", c.get("tipo_documento")),
+            update_data.get("documento", c.get("documento")),
+        ))
     if update_data:
         await db.customers.update_one({"id": customer_id, "empresa_id": user.empresa_id}, {"$set": update_data})
+        await _invalidar_counts("customers", user.empresa_id)
     updated = await db.customers.find_one({"id": customer_id, "empresa_id": user.empresa_id})
     return Customer(**updated)
 
@@ -3220,6 +4518,7 @@ async def bulk_update_customer_status(data: CustomerBulkUpdateRequest, user: Use
         regex = {"$regex": re.escape(data.search), "$options": "i"}
         query["$or"] = [{"nombre": regex}, {"documento": regex}, {"email": regex}, {"telefono": regex}]
     result = await db.customers.update_many(query, {"$set": {"activo": data.activo}})
+    await _invalidar_counts("customers", user.empresa_id)
     return {"updated": result.modified_count}
 
 @api_router.delete("/customers/bulk")
@@ -3233,6 +4532,7 @@ async def bulk_delete_customers(data: CustomerBulkDeleteRequest, user: User = De
         regex = {"$regex": re.escape(data.search), "$options": "i"}
         query["$or"] = [{"nombre": regex}, {"documento": regex}, {"email": regex}, {"telefono": regex}]
     result = await db.customers.delete_many(query)
+    await _invalidar_counts("customers", user.empresa_id)
     return {"deleted": result.deleted_count}
 
 @api_router.delete("/customers/{customer_id}")
@@ -3241,6 +4541,7 @@ async def delete_customer(customer_id: str, user: User = Depends(require_role([U
     if not c:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
     await db.customers.delete_one({"id": customer_id, "empresa_id": user.empresa_id})
+    await _invalidar_counts("customers", user.empresa_id)
     return {"ok": True}
 
 async def _consultar_cuit_cuitonline(cuit_clean: str) -> dict:
@@ -3538,7 +4839,7 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(get_current_us
                         else:
                             await db.branch_products.update_one(
                                 {"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id},
-                                {"$inc": {"stock": -int(comp_cantidad)}}
+                                _bp_stock_update(-int(comp_cantidad))
                             )
                         deducted = True
                 if not deducted:
@@ -3575,7 +4876,7 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(get_current_us
                         else:
                             await db.branch_products.update_one(
                                 {"product_id": item.producto_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id},
-                                {"$inc": {"stock": -int(item.cantidad)}}
+                                _bp_stock_update(-int(item.cantidad))
                             )
                     product_nombre = global_product['nombre']
 
@@ -3661,12 +4962,17 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(get_current_us
     )
 
     await db.sales.insert_one(sale.dict())
+    await _inc_dashboard_counter(user.empresa_id, sale.branch_id, sale.fecha, ventas=total, tickets=1)
+    await _inc_resumen_cliente(
+        user.empresa_id, sale.cliente_id, [i.dict() for i in sale.items], total=total, tickets=1, fecha=sale.fecha
+    )
 
     # Update cash session
-    await db.cash_sessions.update_one(
-        {"id": current_session['id'], "empresa_id": user.empresa_id},
-        {"$inc": {"monto_ventas": total}}
-    )
+    await _inc_sesion_caja(current_session['id'], user.empresa_id, {
+        "monto_ventas": total,
+        "cantidad_ventas": 1,
+        **_ingresos_por_medio(sale.metodo_pago, sale.pagos, total, total),
+    })
 
     # Create cash movement
     if sale_data.pagos and len(sale_data.pagos) > 1:
@@ -3711,8 +5017,16 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(get_current_us
             sale.tipo_comprobante = tipo_cbte
             sale.afip_estado      = "sin_cae"
 
-            # Si hay certificado disponible → solicitar CAE (contingencia si falla)
-            if afip_cfg.get("cert_pem") and afip_cfg.get("key_pem_encrypted"):
+            # Si hay certificado disponible → solicitar CAE (contingencia si falla).
+            # Con el circuito abierto no se espera a AFIP: la venta la retoma el worker
+            if afip_cfg.get("cert_pem") and afip_cfg.get("key_pem_encrypted") and await _afip_circuito_abierto(afip_cfg):
+                sale.afip_estado = "contingencia"
+                sale.afip_error  = "AFIP no disponible: se reintenta automáticamente"
+                await db.sales.update_one(
+                    {"id": sale.id},
+                    {"$set": {"afip_estado": sale.afip_estado, "afip_error": sale.afip_error}}
+                )
+            elif afip_cfg.get("cert_pem") and afip_cfg.get("key_pem_encrypted"):
                 try:
                     token, sign = await _afip_service.get_token_sign(afip_cfg, db, SECRET_KEY)
                     cae_result = await _afip_service.solicitar_cae(
@@ -3726,12 +5040,14 @@ async def create_sale(sale_data: SaleCreate, user: User = Depends(get_current_us
                         "nro_comprobante_afip": cae_result["nro_comprobante"],
                     }
                     await db.sales.update_one({"id": sale.id}, {"$set": afip_update})
+                    await _afip_circuito_resultado(afip_cfg)
                     sale.cae                 = cae_result["cae"]
                     sale.cae_vencimiento     = cae_result["cae_vencimiento"]
                     sale.afip_estado         = "autorizado"
                     sale.nro_comprobante_afip = cae_result["nro_comprobante"]
                 except Exception as afip_err:
                     logger.warning(f"AFIP contingencia para venta {sale.id}: {afip_err}")
+                    await _afip_circuito_resultado(afip_cfg, afip_err)
                     await db.sales.update_one(
                         {"id": sale.id},
                         {"$set": {"afip_estado": "contingencia", "afip_error": str(afip_err)}}
@@ -3779,7 +5095,7 @@ async def update_sale(sale_id: str, sale_data: SaleCreate, user: User = Depends(
                     if user.branch_id:
                         comp_bp = await db.branch_products.find_one({"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id})
                         if comp_bp:
-                            await db.branch_products.update_one({"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id}, {"$inc": {"stock": int(comp_cantidad)}})
+                            await db.branch_products.update_one({"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id}, _bp_stock_update(int(comp_cantidad)))
                             restored = True
                     if not restored:
                         await db.products.update_one({"id": ci['product_id'], "empresa_id": user.empresa_id}, {"$inc": {"stock": int(comp_cantidad)}})
@@ -3790,7 +5106,7 @@ async def update_sale(sale_id: str, sale_data: SaleCreate, user: User = Depends(
                 if user.branch_id:
                     bp = await db.branch_products.find_one({"product_id": prod_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id, "activo": True})
                     if bp:
-                        await db.branch_products.update_one({"product_id": prod_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id}, {"$inc": {"stock": int(cantidad)}})
+                        await db.branch_products.update_one({"product_id": prod_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id}, _bp_stock_update(int(cantidad)))
                         restored = True
                 if not restored:
                     await db.products.update_one({"id": prod_id, "empresa_id": user.empresa_id}, {"$inc": {"stock": int(cantidad)}})
@@ -3833,7 +5149,7 @@ async def update_sale(sale_id: str, sale_data: SaleCreate, user: User = Depends(
                                 raise HTTPException(status_code=400, detail=f"Stock insuficiente para {comp['nombre']}")
                             comp_stock_ok = False
                         else:
-                            await db.branch_products.update_one({"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id}, {"$inc": {"stock": -int(comp_cantidad)}})
+                            await db.branch_products.update_one({"product_id": ci['product_id'], "branch_id": user.branch_id, "empresa_id": user.empresa_id}, _bp_stock_update(-int(comp_cantidad)))
                         deducted = True
                 if not deducted:
                     if comp.get('stock', 0) < comp_cantidad:
@@ -3856,7 +5172,7 @@ async def update_sale(sale_id: str, sale_data: SaleCreate, user: User = Depends(
                         if insuficiente:
                             stock_deducted = False
                         else:
-                            await db.branch_products.update_one({"product_id": item.producto_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id}, {"$inc": {"stock": -int(item.cantidad)}})
+                            await db.branch_products.update_one({"product_id": item.producto_id, "branch_id": user.branch_id, "empresa_id": user.empresa_id}, _bp_stock_update(-int(item.cantidad)))
                     product_nombre = global_product['nombre']
             if precio_unitario is None:
                 insuficiente = manage_stock and global_product.get('stock', 0) < item.cantidad
@@ -3916,11 +5232,34 @@ async def update_sale(sale_id: str, sale_data: SaleCreate, user: User = Depends(
         "fecha_modificacion": datetime.now(timezone.utc).isoformat(),
     }
     await db.sales.update_one({"id": sale_id}, {"$set": update_fields})
+    # Resumen del cliente: se descuenta la venta como estaba y se suma como quedó
+    # (si cambió de cliente, cada uno recibe su parte)
+    await _inc_resumen_cliente(
+        user.empresa_id, original_sale.get("cliente_id"), original_sale.get("items", []),
+        total=-old_total, tickets=-1, fecha=original_sale.get("fecha"), signo=-1,
+    )
+    await _inc_resumen_cliente(
+        user.empresa_id, sale_data.cliente_id, update_fields["items"],
+        total=total, tickets=1, fecha=original_sale.get("fecha"),
+    )
+    # Unidades por día para reposición, con el mismo criterio
+    fecha_venta = original_sale.get("fecha") or datetime.now(timezone.utc)
+    await _inc_ventas_diarias(user.empresa_id, original_sale.get("branch_id"), fecha_venta, original_sale.get("items", []), -1)
+    await _inc_ventas_diarias(user.empresa_id, original_sale.get("branch_id"), fecha_venta, update_fields["items"], 1)
 
-    # Adjust cash session total and the corresponding movement record
+    # Adjust cash session totals (el medio de pago puede haber cambiado aunque el total no)
+    # and the corresponding movement record
     diff = total - old_total
+    await _inc_sesion_caja(original_sale.get('session_id'), user.empresa_id, _sumar_inc(
+        {"monto_ventas": diff},
+        _ingresos_por_medio(original_sale.get('metodo_pago'), original_sale.get('pagos'), -old_total, old_total),
+        _ingresos_por_medio(sale_data.metodo_pago, update_fields["pagos"], total, total),
+    ))
     if diff != 0:
-        await db.cash_sessions.update_one({"id": original_sale['session_id']}, {"$inc": {"monto_ventas": diff}})
+        await _inc_dashboard_counter(
+            user.empresa_id, original_sale.get('branch_id'), original_sale.get('fecha') or datetime.now(timezone.utc), ventas=diff
+        )
+        await _ajustar_cierre_z(user.empresa_id, original_sale.get('branch_id'), original_sale.get('fecha'), diff)
         await db.cash_movements.update_one(
             {"venta_id": sale_id, "empresa_id": user.empresa_id, "tipo": MovementType.VENTA.value},
             {"$inc": {"monto": diff}}
@@ -3953,6 +5292,52 @@ async def get_sales(customer_id: Optional[str] = None, for_report: bool = False,
             logger.warning(f"Skipping invalid sale {sale.get('id')}: {e}")
     return result
 
+@api_router.get("/customers/{customer_id}/summary")
+async def get_customer_summary(customer_id: str, user: User = Depends(get_current_user)):
+    if not await db.customers.find_one({"id": customer_id, "empresa_id": user.empresa_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    resumen = await db.cliente_resumen.find_one(
+        {"empresa_id": user.empresa_id, "cliente_id": customer_id, "completo": True}, {"_id": 0}
+    )
+    if not resumen:
+        resumen = await _armar_resumen_cliente(user.empresa_id, customer_id)
+    productos = [
+        {"product_id": pid, **p} for pid, p in (resumen.get("productos") or {}).items() if p.get("cantidad", 0) > 0
+    ]
+    productos.sort(key=lambda p: (-p["cantidad"], -p.get("monto", 0)))
+    tickets = resumen.get("tickets", 0)
+    return {
+        "cliente_id": customer_id,
+        "total_gastado": round(resumen.get("total_gastado", 0.0), 2),
+        "tickets": tickets,
+        "ticket_promedio": round(resumen.get("total_gastado", 0.0) / tickets, 2) if tickets else 0.0,
+        "devoluciones": round(resumen.get("devoluciones", 0.0), 2),
+        "ultima_compra": resumen.get("ultima_compra"),
+        "top_productos": productos[:_TOP_PRODUCTOS_CLIENTE],
+    }
+
+@api_router.get("/customers/{customer_id}/purchases")
+async def get_customer_purchases(
+    customer_id: str,
+    per_page: int = Query(20, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(get_current_user)
+):
+    # Mismas restricciones de visibilidad que /sales
+    query: dict = {"empresa_id": user.empresa_id, "cliente_id": customer_id}
+    if user.branch_id and user.rol not in [UserRole.ADMIN, UserRole.SUPERVISOR]:
+        query["branch_id"] = user.branch_id
+    if user.rol == UserRole.CAJERO:
+        query["cajero_id"] = user.id
+    sort = [("fecha", -1), ("id", -1)]
+    proyeccion = {
+        "_id": 0, "id": 1, "fecha": 1, "numero_factura": 1, "total": 1, "metodo_pago": 1,
+        "estado": 1, "branch_id": 1, "tipo_comprobante": 1, "cae": 1,
+        "cantidad_items": {"$size": {"$ifNull": ["$items", []]}},
+    }
+    items = await db.sales.find(_keyset_query(query, sort, cursor), proyeccion).sort(sort).limit(per_page).to_list(per_page)
+    return {"items": items, "per_page": per_page, "next_cursor": _next_cursor(items, sort, per_page)}
+
 @api_router.get("/returns", response_model=List[SaleReturn])
 async def get_all_returns(user: User = Depends(get_current_user)):
     returns = await db.sale_returns.find({"empresa_id": user.empresa_id}).sort("fecha", -1).to_list(10000)
@@ -4386,16 +5771,25 @@ async def create_sale_return(sale_id: str, return_data: ReturnCreate, user: User
         raise HTTPException(status_code=400, detail="Esta venta ya fue cancelada completamente")
 
     # Quantities already returned for this sale
-    existing_returns = await db.sale_returns.find({"sale_id": sale_id}).to_list(100)
+    existing_returns = await db.sale_returns.find(
+        {"sale_id": sale_id, "empresa_id": user.empresa_id}, {"_id": 0, "items.producto_id": 1, "items.cantidad": 1}
+    ).to_list(None)
     returned_qty = {}
     for ret in existing_returns:
         for item in ret["items"]:
             pid = item["producto_id"]
             returned_qty[pid] = returned_qty.get(pid, 0) + item["cantidad"]
 
+    # Un solo $in para todos los productos de la devolución (nombre para errores + control_stock)
+    prods_map = await BatchLoader(user.empresa_id).load_many(
+        "products", [ri.producto_id for ri in return_data.items],
+        projection={"_id": 0, "id": 1, "nombre": 1, "control_stock": 1},
+    )
+
     sale_items_map = {item.producto_id: item for item in sale_obj.items}
     return_items = []
     total_return = 0.0
+    pedido: dict = {}
 
     for ri in return_data.items:
         if ri.cantidad <= 0:
@@ -4403,11 +5797,12 @@ async def create_sale_return(sale_id: str, return_data: ReturnCreate, user: User
         original = sale_items_map.get(ri.producto_id)
         if not original:
             raise HTTPException(status_code=400, detail=f"Producto no encontrado en la venta")
-        available = original.cantidad - returned_qty.get(ri.producto_id, 0)
+        available = original.cantidad - returned_qty.get(ri.producto_id, 0) - pedido.get(ri.producto_id, 0)
         if ri.cantidad > available:
-            prod = await db.products.find_one({"id": ri.producto_id})
+            prod = prods_map.get(ri.producto_id)
             name = prod["nombre"] if prod else ri.producto_id
             raise HTTPException(status_code=400, detail=f"Solo quedan {available} unidades disponibles para devolver de '{name}'")
+        pedido[ri.producto_id] = pedido.get(ri.producto_id, 0) + ri.cantidad
         subtotal = ri.cantidad * original.precio_unitario
         total_return += subtotal
         return_items.append(SaleItem(
@@ -4421,47 +5816,57 @@ async def create_sale_return(sale_id: str, return_data: ReturnCreate, user: User
     if not return_items:
         raise HTTPException(status_code=400, detail="Debe seleccionar al menos un producto para devolver")
 
-    # Restore stock (only for products with control_stock enabled)
+    # Restore stock (only for products with control_stock enabled): un bulk_write por colección
+    reponer: dict = {}
     for item in return_items:
-        gp = await db.products.find_one({"id": item.producto_id, "empresa_id": user.empresa_id})
-        if not gp or not gp.get("control_stock", True):
-            continue
-        await db.products.update_one(
-            {"id": item.producto_id, "empresa_id": user.empresa_id},
-            {"$inc": {"stock": int(item.cantidad)}}
-        )
+        gp = prods_map.get(item.producto_id)
+        if gp and gp.get("control_stock", True):
+            reponer[item.producto_id] = reponer.get(item.producto_id, 0) + int(item.cantidad)
+    stock_writes = []
+    if reponer:
+        stock_writes.append(db.products.bulk_write([
+            UpdateOne({"id": pid, "empresa_id": user.empresa_id}, {"$inc": {"stock": cantidad}})
+            for pid, cantidad in reponer.items()
+        ], ordered=False))
         if sale_obj.branch_id and sale_obj.branch_id != "global":
-            await db.branch_products.update_one(
-                {"product_id": item.producto_id, "branch_id": sale_obj.branch_id, "empresa_id": user.empresa_id},
-                {"$inc": {"stock": int(item.cantidad)}}
-            )
+            stock_writes.append(db.branch_products.bulk_write([
+                UpdateOne(
+                    {"product_id": pid, "branch_id": sale_obj.branch_id, "empresa_id": user.empresa_id},
+                    _bp_stock_update(cantidad),
+                )
+                for pid, cantidad in reponer.items()
+            ], ordered=False))
 
-    # Generate return number
-    count = await db.sale_returns.count_documents({"empresa_id": user.empresa_id})
-    numero_devolucion = f"DEV-{str(count + 1).zfill(6)}"
+    # Generate return / credit note numbers
+    numero_dev, numero_nc = await asyncio.gather(
+        _siguiente_numero(user.empresa_id, "devolucion", "sale_returns"),
+        _siguiente_numero(user.empresa_id, "nota_credito", "credit_notes"),
+    )
+    numero_devolucion = f"DEV-{str(numero_dev).zfill(6)}"
+    numero_nota_credito = f"NC-{str(numero_nc).zfill(6)}"
 
     sale_return = SaleReturn(
         empresa_id=user.empresa_id,
         sale_id=sale_id,
+        branch_id=sale.get("branch_id"),
         cajero_id=user.id,
         items=return_items,
         total=total_return,
         motivo=return_data.motivo,
         numero_devolucion=numero_devolucion
     )
-    await db.sale_returns.insert_one(sale_return.dict())
 
-    # Update sale estado
+    # Sale estado
     new_returned = dict(returned_qty)
     for item in return_items:
         new_returned[item.producto_id] = new_returned.get(item.producto_id, 0) + item.cantidad
     fully_returned = all(new_returned.get(si.producto_id, 0) >= si.cantidad for si in sale_obj.items)
     new_estado = "cancelado" if fully_returned else "devolucion_parcial"
-    await db.sales.update_one({"id": sale_id}, {"$set": {"estado": new_estado}})
 
-    # Create credit note
-    cn_count = await db.credit_notes.count_documents({"empresa_id": user.empresa_id})
-    numero_nota_credito = f"NC-{str(cn_count + 1).zfill(6)}"
+    # Credit note: si la venta tenía CAE, la NC queda "pendiente" y se autoriza en segundo plano
+    # Factura A(1)→NC-A(3)  Factura B(6)→NC-B(8)  Factura C(11)→NC-C(13)
+    nc_tipo = NC_TIPO_MAP.get(sale_obj.tipo_comprobante) if sale_obj.tipo_comprobante else None
+    requiere_cae = sale_obj.afip_estado == "autorizado" and nc_tipo and sale_obj.nro_comprobante_afip
     credit_note = CreditNote(
         empresa_id=user.empresa_id,
         sale_id=sale_id,
@@ -4472,75 +5877,11 @@ async def create_sale_return(sale_id: str, return_data: ReturnCreate, user: User
         items=return_items,
         total=total_return,
         motivo=return_data.motivo,
-        tipo="total" if fully_returned else "parcial"
-    )
-    await db.credit_notes.insert_one(credit_note.dict())
-
-    # Request CAE for credit note if original sale was authorized by AFIP
-    # Factura A(1)→NC-A(3)  Factura B(6)→NC-B(8)  Factura C(11)→NC-C(13)
-    NC_TIPO_MAP = {1: 3, 6: 8, 11: 13}
-    nc_tipo = NC_TIPO_MAP.get(sale_obj.tipo_comprobante) if sale_obj.tipo_comprobante else None
-    if sale_obj.afip_estado == "autorizado" and nc_tipo and sale_obj.nro_comprobante_afip:
-        afip_cfg = await db.afip_config.find_one({"empresa_id": user.empresa_id, "activo": True})
-        if afip_cfg and afip_cfg.get("cert_pem") and afip_cfg.get("key_pem_encrypted"):
-            try:
-                token_a, sign_a = await _afip_service.get_token_sign(afip_cfg, db, SECRET_KEY)
-                tax_rate = afip_cfg.get("tax_rate", 0.21) if nc_tipo != 13 else 0.0
-                if tax_rate > 0:
-                    nc_subtotal = round(total_return / (1 + tax_rate), 2)
-                    nc_impuestos = round(total_return - nc_subtotal, 2)
-                else:
-                    nc_subtotal = round(total_return, 2)
-                    nc_impuestos = 0.0
-                nc_sale_dict = {
-                    "total": round(total_return, 2),
-                    "subtotal": nc_subtotal,
-                    "impuestos": nc_impuestos,
-                    "impuestos_extra_total": 0.0,
-                }
-                cbtes_asoc = [{
-                    "Tipo": sale_obj.tipo_comprobante,
-                    "PtoVta": afip_cfg["punto_venta"],
-                    "Nro": sale_obj.nro_comprobante_afip,
-                }]
-                nc_result = await _afip_service.solicitar_cae(
-                    nc_sale_dict, afip_cfg, token_a, sign_a, nc_tipo,
-                    cuit_receptor=sale_obj.cuit_receptor,
-                    cbtes_asoc=cbtes_asoc,
-                )
-                await db.credit_notes.update_one(
-                    {"id": credit_note.id},
-                    {"$set": {
-                        "cae": nc_result["cae"],
-                        "cae_vencimiento": nc_result["cae_vencimiento"],
-                        "afip_estado": "autorizado",
-                        "tipo_comprobante_nc": nc_tipo,
-                        "nro_comprobante_afip": nc_result["nro_comprobante"],
-                    }}
-                )
-                credit_note.cae = nc_result["cae"]
-                credit_note.cae_vencimiento = nc_result["cae_vencimiento"]
-                credit_note.afip_estado = "autorizado"
-                credit_note.tipo_comprobante_nc = nc_tipo
-                credit_note.nro_comprobante_afip = nc_result["nro_comprobante"]
-            except Exception as e:
-                logger.warning(f"Error al obtener CAE para nota de crédito {numero_nota_credito}: {e}")
-                await db.credit_notes.update_one(
-                    {"id": credit_note.id},
-                    {"$set": {
-                        "afip_estado": "contingencia",
-                        "afip_error": str(e),
-                        "tipo_comprobante_nc": nc_tipo,
-                    }}
-                )
-
-    # Reduce cash session monto_ventas
-    await db.cash_sessions.update_one(
-        {"id": sale_obj.session_id},
-        {"$inc": {"monto_ventas": -total_return}}
+        tipo="total" if fully_returned else "parcial",
+        afip_estado="pendiente" if requiere_cae else "no_aplica",
+        tipo_comprobante_nc=nc_tipo if requiere_cae else None,
     )
 
-    # Cash movement
     movement = CashMovement(
         empresa_id=user.empresa_id,
         session_id=sale_obj.session_id,
@@ -4549,80 +5890,102 @@ async def create_sale_return(sale_id: str, return_data: ReturnCreate, user: User
         descripcion=f"Nota de crédito {numero_nota_credito} - {numero_devolucion} - Factura {sale_obj.numero_factura}",
         venta_id=sale_id
     )
-    await db.cash_movements.insert_one(movement.dict())
+
+    # Escrituras independientes entre sí: van todas juntas
+    await asyncio.gather(
+        *stock_writes,
+        db.sale_returns.insert_one(sale_return.dict()),
+        _inc_dashboard_counter(
+            user.empresa_id, sale_obj.branch_id, sale_obj.fecha,
+            devoluciones=total_return, cantidad_devoluciones=1,
+        ),
+        _inc_resumen_cliente(
+            user.empresa_id, sale_obj.cliente_id, [i.dict() for i in return_items],
+            total=-total_return, devoluciones=total_return, fecha=sale_return.fecha, signo=-1,
+        ),
+        db.sales.update_one({"id": sale_id, "empresa_id": user.empresa_id}, {"$set": {"estado": new_estado}}),
+        db.credit_notes.insert_one(credit_note.dict()),
+        # Reduce cash session monto_ventas y lo que entró por cada medio de pago
+        _inc_sesion_caja(sale_obj.session_id, user.empresa_id, {
+            "monto_ventas": -total_return,
+            "monto_devoluciones": total_return,
+            **_ingresos_por_medio(sale_obj.metodo_pago, sale_obj.pagos, -total_return, sale_obj.total),
+        }),
+        db.cash_movements.insert_one(movement.dict()),
+    )
+
+    if requiere_cae:
+        _en_segundo_plano(_autorizar_nota_credito_fondo(user.empresa_id, credit_note.id))
 
     return {
         "message": "Devolución procesada exitosamente",
         "numero_devolucion": numero_devolucion,
         "numero_nota_credito": numero_nota_credito,
+        "nota_credito_id": credit_note.id,
         "cae_nc": credit_note.cae,
         "afip_estado_nc": credit_note.afip_estado,
         "total": total_return
     }
 
 # Cash Reports routes
-@api_router.get("/cash-sessions/{session_id}/movements", response_model=List[CashMovement])
-async def get_session_movements(session_id: str, user: User = Depends(get_current_user)):
-    movements = await db.cash_movements.find({"session_id": session_id, "empresa_id": user.empresa_id}).sort("fecha", 1).to_list(1000)
-    return [CashMovement(**movement) for movement in movements]
+@api_router.get("/cash-sessions/{session_id}/movements")
+async def get_session_movements(
+    session_id: str,
+    per_page: int = Query(100, ge=1, le=REPORTE_CAJA_MOVIMIENTOS),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(get_current_user)
+):
+    return await _pagina_movimientos(session_id, user.empresa_id, per_page, cursor)
+
+@api_router.get("/cash-sessions/{session_id}/sales")
+async def get_session_sales(
+    session_id: str,
+    per_page: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(get_current_user)
+):
+    sort = [("fecha", 1), ("id", 1)]
+    query = {"session_id": session_id, "empresa_id": user.empresa_id}
+    proyeccion = {
+        "_id": 0, "id": 1, "fecha": 1, "numero_factura": 1, "total": 1, "metodo_pago": 1, "pagos": 1,
+        "estado": 1, "cliente_id": 1, "tipo_comprobante": 1, "cae": 1,
+        "cantidad_items": {"$size": {"$ifNull": ["$items", []]}},
+    }
+    items = await db.sales.find(_keyset_query(query, sort, cursor), proyeccion).sort(sort).limit(per_page).to_list(per_page)
+    return {"items": items, "per_page": per_page, "next_cursor": _next_cursor(items, sort, per_page)}
 
 @api_router.get("/cash-sessions/{session_id}/report")
 async def get_cash_session_report(session_id: str, user: User = Depends(get_current_user)):
-    session = await db.cash_sessions.find_one({"id": session_id, "empresa_id": user.empresa_id})
+    session = await db.cash_sessions.find_one({"id": session_id, "empresa_id": user.empresa_id}, {"_id": 0})
     if not session:
         raise HTTPException(status_code=404, detail="Sesión no encontrada")
 
-    # Get movements
-    movements_docs = await db.cash_movements.find({"session_id": session_id, "empresa_id": user.empresa_id}).sort("fecha", 1).to_list(1000)
-    movements = [CashMovement(**movement) for movement in movements_docs]
-
-    # Get sales details
-    sales_docs = await db.sales.find({"session_id": session_id, "empresa_id": user.empresa_id}).to_list(1000)
-    sales = [Sale(**sale) for sale in sales_docs]
+    # Los totales salen del doc de la sesión; las ventas y los movimientos se piden
+    # paginados (/sales, /movements). Acá va solo la primera página de movimientos.
+    if not session.get("totales_por_medio"):
+        session.update(await _totales_sesion_anterior(session))
 
-    # Get user info
-    user_doc = await db.users.find_one({"id": session["user_id"], "empresa_id": user.empresa_id})
+    movimientos, user_doc, branch_doc = await asyncio.gather(
+        _pagina_movimientos(session_id, user.empresa_id, REPORTE_CAJA_MOVIMIENTOS, None),
+        db.users.find_one({"id": session["user_id"], "empresa_id": user.empresa_id}),
+        db.branches.find_one({"id": session["branch_id"], "empresa_id": user.empresa_id}),
+    )
     user_info = User(**user_doc) if user_doc else None
-
-    # Get branch info
-    branch_doc = await db.branches.find_one({"id": session["branch_id"], "empresa_id": user.empresa_id})
     branch_info = Branch(**branch_doc) if branch_doc else None
 
-    # Devoluciones de esta sesión para descontar del resumen
-    sale_ids = [s.id for s in sales]
-    returns_docs = await db.sale_returns.find({"sale_id": {"$in": sale_ids}, "empresa_id": user.empresa_id}).to_list(1000)
-    returned_by_sale = {}
-    for ret in returns_docs:
-        returned_by_sale[ret["sale_id"]] = returned_by_sale.get(ret["sale_id"], 0) + ret["total"]
-
-    def net_total(sale):
-        return sale.total - returned_by_sale.get(sale.id, 0)
-
-    method_income = {'efectivo': 0.0, 'tarjeta': 0.0, 'transferencia': 0.0}
-    for s in sales:
-        returned = returned_by_sale.get(s.id, 0)
-        if s.pagos and len(s.pagos) > 1:
-            ratio = (1 - returned / s.total) if s.total > 0 else 1
-            for p in s.pagos:
-                key = p.metodo.value if hasattr(p.metodo, 'value') else p.metodo
-                if key in method_income:
-                    method_income[key] += p.monto * ratio
-        else:
-            key = s.metodo_pago.value if hasattr(s.metodo_pago, 'value') else s.metodo_pago
-            if key in method_income:
-                method_income[key] += net_total(s)
-
     return {
         "session": CashSession(**session),
-        "movements": movements,
-        "sales": sales,
+        "movements": movimientos["items"],
+        "movements_next_cursor": movimientos["next_cursor"],
         "user": user_info,
         "branch": branch_info,
         "resumen": {
-            "total_ventas": len(sales),
-            "ingresos_efectivo": method_income['efectivo'],
-            "ingresos_tarjeta": method_income['tarjeta'],
-            "ingresos_transferencia": method_income['transferencia'],
+            "total_ventas": session.get("cantidad_ventas", 0),
+            "ingresos_efectivo": session.get("ingresos_efectivo", 0.0),
+            "ingresos_tarjeta": session.get("ingresos_tarjeta", 0.0),
+            "ingresos_transferencia": session.get("ingresos_transferencia", 0.0),
+            "total_devoluciones": session.get("monto_devoluciones", 0.0),
+            "total_retiros": session.get("monto_retiros", 0.0),
         }
     }
 
@@ -4631,66 +5994,41 @@ async def get_cash_session_report(session_id: str, user: User = Depends(get_curr
 async def get_dashboard_stats(user: User = Depends(get_current_user)):
     is_admin_or_supervisor = user.rol in [UserRole.ADMIN, UserRole.SUPERVISOR]
 
-    # Today's sales — use Argentina local time (UTC-3) so "today" matches the user's calendar day
-    AR_TZ = timezone(timedelta(hours=-3))
-    today = datetime.now(AR_TZ).replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc)
-    tomorrow = today + timedelta(days=1)
-
-    sales_filter = {"empresa_id": user.empresa_id, "fecha": {"$gte": today, "$lt": tomorrow}}
+    # Ventas de hoy desde los contadores (día local AR, ver _inc_dashboard_counter):
+    # un doc por sucursal en vez de traer todas las ventas y devoluciones del día.
+    counters_filter = {"empresa_id": user.empresa_id, "dia": _dia_local(datetime.now(timezone.utc))}
     if not is_admin_or_supervisor and user.branch_id:
-        sales_filter["branch_id"] = user.branch_id
-
-    # Proyección: este resumen solo usa id/total/branch_id de cada venta, no hace falta
-    # traer los items ni los campos de AFIP de cada una (esto se llama en cada carga
-    # del home, es el endpoint más golpeado de toda la app).
-    today_sales = await db.sales.find(sales_filter, {"id": 1, "total": 1, "branch_id": 1}).to_list(1000)
-    today_sale_ids = [s['id'] for s in today_sales]
-    today_returns = await db.sale_returns.find(
-        {"sale_id": {"$in": today_sale_ids}, "empresa_id": user.empresa_id},
-        {"sale_id": 1, "total": 1}
-    ).to_list(1000)
-    returned_by_sale_today = {}
-    for ret in today_returns:
-        returned_by_sale_today[ret["sale_id"]] = returned_by_sale_today.get(ret["sale_id"], 0) + ret["total"]
-    total_ventas_hoy = sum(sale['total'] - returned_by_sale_today.get(sale['id'], 0) for sale in today_sales)
-    numero_ventas_hoy = len(today_sales)
+        counters_filter["branch_id"] = user.branch_id
+    counters_hoy = await db.dashboard_counters.find(counters_filter, {"_id": 0}).to_list(1000)
+    total_ventas_hoy = sum(c.get("total_ventas", 0) - c.get("total_devoluciones", 0) for c in counters_hoy)
+    numero_ventas_hoy = sum(c.get("tickets", 0) for c in counters_hoy)
 
     # Per-branch breakdown for admin
     ventas_por_sucursal = []
     if user.rol == UserRole.ADMIN:
-        branches_list = await db.branches.find({"empresa_id": user.empresa_id, "activo": True}).to_list(1000)
+        branches_list = await db.branches.find(
+            {"empresa_id": user.empresa_id, "activo": True}, {"id": 1, "nombre": 1}
+        ).to_list(1000)
         branch_map = {b["id"]: b["nombre"] for b in branches_list}
-        branch_totals = {}
-        for sale in today_sales:
-            bid = sale.get("branch_id") or "global"
-            net = sale["total"] - returned_by_sale_today.get(sale["id"], 0)
-            if bid not in branch_totals:
-                branch_totals[bid] = {"total": 0, "cantidad": 0}
-            branch_totals[bid]["total"] += net
-            branch_totals[bid]["cantidad"] += 1
-        for bid, data in branch_totals.items():
+        for c in counters_hoy:
+            if not c.get("tickets"):
+                continue
+            bid = c["branch_id"]
             nombre = branch_map.get(bid, "Sin sucursal") if bid != "global" else "Sin sucursal"
-            ventas_por_sucursal.append({"branch_id": bid, "nombre": nombre, "total": data["total"], "cantidad": data["cantidad"]})
+            ventas_por_sucursal.append({
+                "branch_id": bid,
+                "nombre": nombre,
+                "total": c.get("total_ventas", 0) - c.get("total_devoluciones", 0),
+                "cantidad": c.get("tickets", 0),
+            })
         ventas_por_sucursal.sort(key=lambda x: x["total"], reverse=True)
 
-    # Total products
-    total_productos = await db.products.count_documents({"empresa_id": user.empresa_id, "activo": True})
-
-    # Low stock from branch_products (real per-branch stock)
-    # Exclude combo products and products with control_stock=False
-    excluded_dash = await db.products.find(
-        {"empresa_id": user.empresa_id, "$or": [{"kind": "combo"}, {"control_stock": False}]},
-        {"id": 1}
-    ).to_list(100000)
-    excluded_ids_dash = [p["id"] for p in excluded_dash]
+    onboarding = await _get_onboarding_counts(user.empresa_id)
+    total_productos = onboarding["productos"]
 
-    bp_filter = {
-        "empresa_id": user.empresa_id,
-        "activo": True,
-        "$expr": {"$lte": ["$stock", "$stock_minimo"]}
-    }
-    if excluded_ids_dash:
-        bp_filter["product_id"] = {"$nin": excluded_ids_dash}
+    # Low stock from branch_products (real per-branch stock).
+    # bajo_stock ya excluye combos y productos sin control de stock (ver _bp_stock_update)
+    bp_filter = {"empresa_id": user.empresa_id, "activo": True, "bajo_stock": True}
     if not is_admin_or_supervisor and user.branch_id:
         bp_filter["branch_id"] = user.branch_id
     elif is_admin_or_supervisor and user.rol == UserRole.SUPERVISOR and user.branch_id:
@@ -4709,9 +6047,12 @@ async def get_dashboard_stats(user: User = Depends(get_current_user)):
         bajo_stock_bps_preview = []
 
     # Build preview list (up to 5) with product names
+    loader = BatchLoader(user.empresa_id)
+    prods_map = await loader.load_many("products", [bp["product_id"] for bp in bajo_stock_bps_preview], projection={"id": 1, "nombre": 1})
+    branches_map = await loader.load_many("branches", [bp["branch_id"] for bp in bajo_stock_bps_preview], projection={"id": 1, "nombre": 1})
     for bp in bajo_stock_bps_preview:
-        prod = await db.products.find_one({"id": bp["product_id"], "empresa_id": user.empresa_id})
-        branch = await db.branches.find_one({"id": bp["branch_id"], "empresa_id": user.empresa_id})
+        prod = prods_map.get(bp["product_id"])
+        branch = branches_map.get(bp["branch_id"])
         if prod:
             preview.append({
                 "id": bp["id"],
@@ -4721,9 +6062,6 @@ async def get_dashboard_stats(user: User = Depends(get_current_user)):
                 "stock_minimo": bp.get("stock_minimo", 0)
             })
 
-    sucursales_count = await db.branches.count_documents({"empresa_id": user.empresa_id, "activo": True})
-    categorias_count = await db.categories.count_documents({"empresa_id": user.empresa_id})
-
     return {
         "ventas_hoy": {
             "total": total_ventas_hoy,
@@ -4736,8 +6074,8 @@ async def get_dashboard_stats(user: User = Depends(get_current_user)):
         },
         "productos_bajo_stock": preview,
         "onboarding": {
-            "sucursales": sucursales_count,
-            "categorias": categorias_count,
+            "sucursales": onboarding["sucursales"],
+            "categorias": onboarding["categorias"],
             "productos": total_productos,
         }
     }
@@ -4755,31 +6093,50 @@ async def get_ventas_diarias(
     # Convertir a UTC para el filtro de MongoDB
     desde_utc = desde_local.astimezone(timezone.utc)
 
-    filtro = {"empresa_id": user.empresa_id, "fecha": {"$gte": desde_utc}}
+    # Los tramos con cierre Z salen del Z (más sus ajustes por ventas editadas después);
+    # de cada sucursal solo se leen los movimientos posteriores a su último Z (en general,
+    # los de hoy). Igual que en el Z y en la caja, una devolución resta el día en que se
+    # hizo, no el de la venta.
+    filtro_z = {"empresa_id": user.empresa_id, "dia": {"$gte": desde_local.strftime("%Y-%m-%d")}}
+    if branch_id:
+        filtro_z["branch_id"] = branch_id
+    totals: dict = {}
+    cubierto: dict = {}
+    async for z in db.cierres_z.find(filtro_z, {"_id": 0, "branch_id": 1, "dia": 1, "hasta": 1, "total_neto": 1, "ajustes": 1}):
+        totals[z["dia"]] = totals.get(z["dia"], 0) + z["total_neto"] + z.get("ajustes", 0)
+        cubierto[z["branch_id"]] = max(cubierto.get(z["branch_id"], z["hasta"]), z["hasta"])
+
+    def pendiente(branch: Optional[str], fecha) -> bool:
+        if branch_id and branch != branch_id:
+            return False
+        return fecha >= cubierto.get(branch, desde_utc)
+
+    pendientes = [{"branch_id": b, "fecha": {"$gte": hasta}} for b, hasta in cubierto.items()]
+    pendientes.append({"branch_id": {"$nin": list(cubierto)}, "fecha": {"$gte": desde_utc}})
+    filtro = {"empresa_id": user.empresa_id, "$or": pendientes}
     if branch_id:
         filtro["branch_id"] = branch_id
-    ventas = await db.sales.find(filtro, {"id": 1, "fecha": 1, "total": 1}).to_list(100000)
-
-    # Traer devoluciones de esas ventas para descontar
-    sale_ids = [v["id"] for v in ventas if v.get("id")]
-    returns_docs = await db.sale_returns.find({"sale_id": {"$in": sale_ids}, "empresa_id": user.empresa_id}, {"sale_id": 1, "total": 1}).to_list(100000)
-    returned_by_sale = {}
-    for r in returns_docs:
-        returned_by_sale[r["sale_id"]] = returned_by_sale.get(r["sale_id"], 0) + r.get("total", 0)
+    ventas, devoluciones = await asyncio.gather(
+        db.sales.find(filtro, {"_id": 0, "fecha": 1, "total": 1}).to_list(100000),
+        db.sale_returns.find(
+            {"empresa_id": user.empresa_id, "fecha": {"$gte": min([desde_utc, *cubierto.values()])}},
+            {"_id": 0, "sale_id": 1, "fecha": 1, "total": 1},
+        ).to_list(100000),
+    )
+    ventas_dev = await BatchLoader(user.empresa_id).load_many(
+        "sales", [d["sale_id"] for d in devoluciones], projection={"_id": 0, "id": 1, "branch_id": 1}
+    )
 
     # Agrupar por fecha local (no UTC)
-    totals: dict = {}
     for v in ventas:
-        fecha = v.get("fecha")
-        if not fecha:
-            continue
-        if isinstance(fecha, str):
-            day = fecha[:10]
-        else:
-            fecha_local = fecha.astimezone(AR_TZ) if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc).astimezone(AR_TZ)
-            day = fecha_local.strftime("%Y-%m-%d")
-        net = v.get("total", 0) - returned_by_sale.get(v.get("id", ""), 0)
-        totals[day] = totals.get(day, 0) + net
+        if v.get("fecha"):
+            day = _dia_local(v["fecha"])
+            totals[day] = totals.get(day, 0) + v.get("total", 0)
+    for d in devoluciones:
+        venta = ventas_dev.get(d["sale_id"])
+        if venta and pendiente(venta.get("branch_id"), d["fecha"]):
+            day = _dia_local(d["fecha"])
+            totals[day] = totals.get(day, 0) - d.get("total", 0)
 
     # Rellenar todos los días del rango con 0 si no hay ventas
     result = []
@@ -4789,28 +6146,147 @@ async def get_ventas_diarias(
 
     return result
 
+def _filtro_cierres_z(user: User, fecha_desde: Optional[str], fecha_hasta: Optional[str], branch_id: Optional[str]) -> dict:
+    query: dict = {"empresa_id": user.empresa_id}
+    if user.rol != UserRole.ADMIN and user.branch_id:
+        query["branch_id"] = user.branch_id
+    elif branch_id:
+        query["branch_id"] = branch_id
+    if fecha_desde or fecha_hasta:
+        query["dia"] = {}
+        if fecha_desde:
+            query["dia"]["$gte"] = fecha_desde
+        if fecha_hasta:
+            query["dia"]["$lte"] = fecha_hasta
+    return query
+
+@api_router.get("/cierres-z")
+async def get_cierres_z(
+    fecha_desde: Optional[str] = Query(None),
+    fecha_hasta: Optional[str] = Query(None),
+    branch_id: Optional[str] = Query(None),
+    page: int = Query(1, ge=1),
+    per_page: int = Query(31, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+):
+    query = _filtro_cierres_z(user, fecha_desde, fecha_hasta, branch_id)
+    sort = [("desde", -1), ("id", -1)]
+    items, total = await _paginar_find("cierres_z", query, sort, page, per_page, cursor, CountStrategy.EXACT)
+    for z in items:
+        z.pop("_id", None)
+    return {
+        "items": items,
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "next_cursor": _next_cursor(items, sort, per_page),
+    }
+
+@api_router.get("/cierres-z/export")
+async def export_cierres_z(
+    fecha_desde: Optional[str] = Query(None),
+    fecha_hasta: Optional[str] = Query(None),
+    branch_id: Optional[str] = Query(None),
+    format: str = Query("xlsx"),
+    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+):
+    loader = BatchLoader(user.empresa_id)
+
+    async def armar_filas(cierres):
+        branches_map = await loader.load_many("branches", [z["branch_id"] for z in cierres], projection={"id": 1, "nombre": 1})
+        filas = []
+        for z in cierres:
+            branch = branches_map.get(z["branch_id"])
+            por_medio = z.get("por_medio", {})
+            filas.append([
+                z["dia"],
+                branch.get("nombre", "") if branch else z["branch_id"],
+                z.get("numero"),
+                z.get("tickets", 0),
+                z.get("subtotal", 0),
+                z.get("impuestos", 0),
+                z.get("impuestos_extra", 0),
+                z.get("descuentos", 0),
+                z.get("total_ventas", 0),
+                por_medio.get("efectivo", 0),
+                por_medio.get("tarjeta", 0),
+                por_medio.get("transferencia", 0),
+                z.get("total_devoluciones", 0),
+                z.get("total_neto", 0),
+                z.get("ajustes", 0),
+                z.get("total_neto", 0) + z.get("ajustes", 0),
+            ])
+        return filas
+
+    columns = [
+        "Día", "Sucursal", "Z N°", "Tickets", "Subtotal", "IVA", "Otros impuestos", "Descuentos", "Total ventas",
+        "Efectivo", "Tarjeta", "Transferencia", "Devoluciones", "Total neto", "Ajustes", "Total neto ajustado",
+    ]
+    cursor = db.cierres_z.find(_filtro_cierres_z(user, fecha_desde, fecha_hasta, branch_id), {"_id": 0}).sort([("desde", 1)])
+    return await _export_response(columns, _lotes_cursor(cursor, armar_filas), "cierres_z", format, sheet_name="Cierres Z")
+
+# Un change stream por empresa, compartido por todas las pestañas abiertas del dashboard
+_realtime_hub = RealtimeHub(db)
+
+# EventSource no puede mandar el header Authorization: el front pide con su sesión un
+# ticket corto (POST /dashboard/stream/ticket) y lo pasa en la URL del stream. El ticket
+# solo sirve para abrir el stream, así que si queda en un log no da acceso a nada más;
+# al reconectar se pide uno nuevo.
+STREAM_TICKET_TTL = timedelta(seconds=60)
+
+@api_router.post("/dashboard/stream/ticket")
+async def dashboard_stream_ticket(user: User = Depends(get_current_user)):
+    data = {"sub": user.id, "empresa_id": user.empresa_id, "uso": "stream"}
+    if user.active_branch_id:
+        data["active_branch_id"] = user.active_branch_id
+    return {
+        "ticket": create_access_token(data, expires_delta=STREAM_TICKET_TTL),
+        "expira_en": int(STREAM_TICKET_TTL.total_seconds()),
+    }
+
+@api_router.get("/dashboard/stream")
+async def dashboard_stream(request: Request, ticket: str = Query(...)):
+    """SSE con ventas, devoluciones, cajas y alertas de stock de la empresa en tiempo real.
+    Los usuarios que no son admin solo reciben eventos de su sucursal activa; los que no
+    traen sucursal (devoluciones anteriores a guardarla) no les llegan."""
+    user = await _usuario_del_token(ticket, uso="stream")
+    filtrar_sucursal = user.branch_id if user.rol != UserRole.ADMIN else None
+    queue = _realtime_hub.subscribe(user.empresa_id)
+
+    async def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if (filtrar_sucursal and evento["tipo"] != "no_disponible"
+                        and evento["datos"].get("branch_id") != filtrar_sucursal):
+                    continue
+                yield f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            _realtime_hub.unsubscribe(user.empresa_id, queue)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @api_router.get("/dashboard/stock-alerts")
 async def get_stock_alerts(
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=10000),
+    cursor: Optional[str] = Query(None),
     user: User = Depends(get_current_user)
 ):
     is_admin = user.rol == UserRole.ADMIN
 
-    # Exclude combo products and products with control_stock=False
-    excluded_prods = await db.products.find(
-        {"empresa_id": user.empresa_id, "$or": [{"kind": "combo"}, {"control_stock": False}]},
-        {"id": 1}
-    ).to_list(100000)
-    excluded_ids = [p["id"] for p in excluded_prods]
-
-    bp_filter = {
-        "empresa_id": user.empresa_id,
-        "activo": True,
-        "$expr": {"$lte": ["$stock", "$stock_minimo"]}
-    }
-    if excluded_ids:
-        bp_filter["product_id"] = {"$nin": excluded_ids}
+    # Partial index scan: bajo_stock ya excluye combos y productos sin control de stock
+    bp_filter = {"empresa_id": user.empresa_id, "activo": True, "bajo_stock": True}
     # Supervisor and cajero: filter to their branch
     if user.rol != UserRole.ADMIN and user.branch_id:
         bp_filter["branch_id"] = user.branch_id
@@ -4819,15 +6295,20 @@ async def get_stock_alerts(
     if not (empresa_config.get("low_stock_alert_enabled", True) if empresa_config else True):
         return {"items": [], "total": 0, "page": page, "per_page": per_page}
 
-    total = await db.branch_products.count_documents(bp_filter)
-    skip = (page - 1) * per_page
-    bajo_stock_bps = await db.branch_products.find(bp_filter).skip(skip).limit(per_page).to_list(per_page)
+    # bajo_stock cambia con cada venta: no se cachea, el count sale del índice parcial
+    sort = [("created_at", 1), ("id", 1)]
+    bajo_stock_bps, total = await _paginar_find(
+        "branch_products", bp_filter, sort, page, per_page, cursor, CountStrategy.EXACT
+    )
 
-    # Fetch product and branch info
+    # Fetch product and branch info (2 queries en total, no 2 por fila)
+    loader = BatchLoader(user.empresa_id)
+    prods_map = await loader.load_many("products", [bp["product_id"] for bp in bajo_stock_bps], projection={"id": 1, "nombre": 1, "codigo_barras": 1})
+    branches_map = await loader.load_many("branches", [bp["branch_id"] for bp in bajo_stock_bps], projection={"id": 1, "nombre": 1})
     items = []
     for bp in bajo_stock_bps:
-        prod = await db.products.find_one({"id": bp["product_id"], "empresa_id": user.empresa_id})
-        branch = await db.branches.find_one({"id": bp["branch_id"], "empresa_id": user.empresa_id})
+        prod = prods_map.get(bp["product_id"])
+        branch = branches_map.get(bp["branch_id"])
         items.append({
             "branch_product_id": bp["id"],
             "product_id": bp["product_id"],
@@ -4845,7 +6326,8 @@ async def get_stock_alerts(
         "total": total,
         "page": page,
         "per_page": per_page,
-        "total_pages": max(1, -(-total // per_page))
+        "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": _next_cursor(bajo_stock_bps, sort, per_page),
     }
 
 @api_router.get("/dashboard/stock-alerts/export")
@@ -4853,38 +6335,259 @@ async def export_stock_alerts(
     format: str = Query("xlsx"),
     user: User = Depends(get_current_user)
 ):
-    excluded_prods_exp = await db.products.find(
-        {"empresa_id": user.empresa_id, "$or": [{"kind": "combo"}, {"control_stock": False}]},
-        {"id": 1}
-    ).to_list(100000)
-    excluded_ids_exp = [p["id"] for p in excluded_prods_exp]
-
-    bp_filter = {
-        "empresa_id": user.empresa_id,
-        "activo": True,
-        "$expr": {"$lte": ["$stock", "$stock_minimo"]}
-    }
-    if excluded_ids_exp:
-        bp_filter["product_id"] = {"$nin": excluded_ids_exp}
+    bp_filter = {"empresa_id": user.empresa_id, "activo": True, "bajo_stock": True}
     if user.rol != UserRole.ADMIN and user.branch_id:
         bp_filter["branch_id"] = user.branch_id
 
-    bajo_stock_bps = await db.branch_products.find(bp_filter).to_list(10000)
+    # Un loader para todo el export: las sucursales se repiten entre lotes
+    loader = BatchLoader(user.empresa_id)
 
-    rows = []
-    for bp in bajo_stock_bps:
-        prod = await db.products.find_one({"id": bp["product_id"], "empresa_id": user.empresa_id})
-        branch = await db.branches.find_one({"id": bp["branch_id"], "empresa_id": user.empresa_id})
-        rows.append({
-            "Producto": prod.get("nombre", "") if prod else "",
-            "Código de Barras": prod.get("codigo_barras", "") if prod else "",
-            "Sucursal": branch.get("nombre", "") if branch else "",
-            "Stock Actual": bp.get("stock", 0),
-            "Stock Mínimo": bp.get("stock_minimo", 0),
-            "Diferencia": bp.get("stock", 0) - bp.get("stock_minimo", 0)
+    async def armar_filas(bajo_stock_bps):
+        prods_map = await BatchLoader(user.empresa_id).load_many(
+            "products", [bp["product_id"] for bp in bajo_stock_bps], projection={"id": 1, "nombre": 1, "codigo_barras": 1}
+        )
+        branches_map = await loader.load_many("branches", [bp["branch_id"] for bp in bajo_stock_bps], projection={"id": 1, "nombre": 1})
+        filas = []
+        for bp in bajo_stock_bps:
+            prod = prods_map.get(bp["product_id"])
+            branch = branches_map.get(bp["branch_id"])
+            filas.append([
+                prod.get("nombre", "") if prod else "",
+                prod.get("codigo_barras", "") if prod else "",
+                branch.get("nombre", "") if branch else "",
+                bp.get("stock", 0),
+                bp.get("stock_minimo", 0),
+                bp.get("stock", 0) - bp.get("stock_minimo", 0),
+            ])
+        return filas
+
+    columns = ["Producto", "Código de Barras", "Sucursal", "Stock Actual", "Stock Mínimo", "Diferencia"]
+    cursor = db.branch_products.find(bp_filter, {"_id": 0})
+    return await _export_response(columns, _lotes_cursor(cursor, armar_filas), "stock_bajo", format, sheet_name="Stock bajo")
+
+# --- Sugerencias de reposición ---
+# ventas_diarias guarda las unidades vendidas por (empresa, sucursal, producto, día local
+# AR). _acumular_ventas_diarias la completa de forma incremental desde la última marca
+# (reposicion_estado) y _recalcular_reposicion corre reorder.py sobre el catálogo entero
+# de una empresa; el resultado queda en reposicion, un doc por branch_product, para
+# listarlo ordenado por días de cobertura.
+# Las ventas se insertan con la fecha de cuando se armaron: se deja un margen para no
+# pasar la marca por encima de una venta que todavía está autorizando en AFIP.
+# Cada pasada recalcula enteros (con $set) los días locales que toca el tramo nuevo, y la
+# marca avanza recién cuando la escritura terminó: si el proceso se cae a mitad, la
+# próxima pasada repite el tramo sin contar nada dos veces. Un lease evita que dos
+# procesos lo hagan a la vez. Las ediciones de ventas ya acumuladas llegan por
+# _inc_ventas_diarias desde update_sale.
+_VENTAS_DIARIAS_DEMORA = timedelta(minutes=5)
+_VENTAS_DIARIAS_LEASE = timedelta(minutes=30)
+_REPOSICION_CHUNK = 1000
+
+async def _bulk_por_tandas(coll: str, ops: list) -> None:
+    for inicio in range(0, len(ops), _REPOSICION_CHUNK):
+        await db[coll].bulk_write(ops[inicio:inicio + _REPOSICION_CHUNK], ordered=False)
+
+async def _acumular_ventas_diarias() -> set:
+    """Lleva ventas_diarias hasta ahora recalculando los días entre la última marca y
+    ahora. Devuelve las empresas que tuvieron ventas en esos días."""
+    duenio = leases.nuevo_duenio()
+    if not await leases.tomar(db, "ventas_diarias", _VENTAS_DIARIAS_LEASE, duenio):
+        return set()
+    try:
+        hasta = datetime.now(timezone.utc) - _VENTAS_DIARIAS_DEMORA
+        estado = await db.reposicion_estado.find_one({"_id": "ventas_diarias"})
+        # Primera vez: se arma la historia completa que usa el modelo
+        desde = estado["hasta"] if estado else hasta - timedelta(days=reorder.DIAS_HISTORIA + 1)
+        inicio = _inicio_dia_local(desde)
+        dias = []
+        dia = inicio.date()
+        while dia <= hasta.astimezone(AR_TZ).date():
+            dias.append(dia.isoformat())
+            dia += timedelta(days=1)
+
+        grupos = await db.sales.aggregate([
+            {"$match": {"fecha": {"$gte": inicio, "$lt": hasta}}},
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": {
+                    "empresa_id": "$empresa_id",
+                    "branch_id": "$branch_id",
+                    "product_id": "$items.producto_id",
+                    "dia": {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha", "timezone": "-03:00"}},
+                },
+                "cantidad": {"$sum": "$items.cantidad"},
+            }},
+        ], allowDiskUse=True).to_list(None)
+        # Los docs de estos días que esta pasada no reescribió ya no tienen ventas: se borran
+        calculo = str(uuid.uuid4())
+        await _bulk_por_tandas("ventas_diarias", [
+            UpdateOne(g["_id"], {"$set": {"cantidad": g["cantidad"], "calculo": calculo}}, upsert=True) for g in grupos
+        ])
+        await db.ventas_diarias.delete_many({"dia": {"$in": dias}, "calculo": {"$ne": calculo}})
+        await db.reposicion_estado.update_one({"_id": "ventas_diarias"}, {"$set": {"hasta": hasta}}, upsert=True)
+
+        corte = (datetime.now(AR_TZ).date() - timedelta(days=reorder.DIAS_HISTORIA + 1)).isoformat()
+        await db.ventas_diarias.delete_many({"dia": {"$lt": corte}})
+        return {g["_id"]["empresa_id"] for g in grupos}
+    finally:
+        await leases.soltar(db, "ventas_diarias", duenio)
+
+async def _inc_ventas_diarias(empresa_id: str, branch_id: Optional[str], fecha: datetime, items: list, signo: int) -> None:
+    """Suma (signo=1) o resta (signo=-1) los ítems de una venta en su día de ventas_diarias.
+    Si el día todavía no pasó por _acumular_ventas_diarias, el recálculo lo pisa igual."""
+    cantidades = {}
+    for item in items:
+        cantidades[item["producto_id"]] = cantidades.get(item["producto_id"], 0) + item["cantidad"]
+    dia = _dia_local(fecha)
+    await _bulk_por_tandas("ventas_diarias", [
+        UpdateOne(
+            {"empresa_id": empresa_id, "branch_id": branch_id, "product_id": product_id, "dia": dia},
+            {"$inc": {"cantidad": signo * cantidad}},
+            upsert=True,
+        )
+        for product_id, cantidad in cantidades.items()
+    ])
+
+async def _recalcular_reposicion(empresa_id: str) -> int:
+    """Recalcula las sugerencias de todos los branch_products de la empresa."""
+    hoy = datetime.now(AR_TZ).date()
+    desde_dia = (hoy - timedelta(days=reorder.DIAS_HISTORIA)).isoformat()
+    ventas, combos, bps, cfg = await asyncio.gather(
+        db.ventas_diarias.find(
+            {"empresa_id": empresa_id, "dia": {"$gte": desde_dia}},
+            {"_id": 0, "branch_id": 1, "product_id": 1, "dia": 1, "cantidad": 1}
+        ).to_list(None),
+        db.products.find({"empresa_id": empresa_id, "kind": "combo"}, {"_id": 0, "id": 1, "combo_items": 1}).to_list(None),
+        db.branch_products.find(
+            {"empresa_id": empresa_id, "activo": True, "control_stock": {"$ne": False}, "kind": {"$ne": "combo"}},
+            {"_id": 0, "id": 1, "branch_id": 1, "product_id": 1, "stock": 1, "stock_minimo": 1, "costo": 1}
+        ).to_list(None),
+        db.configuration.find_one({"empresa_id": empresa_id}),
+    )
+    cfg = cfg or {}
+
+    def calcular() -> list:
+        v = pd.DataFrame(ventas, columns=["branch_id", "product_id", "dia", "cantidad"])
+        c = pd.DataFrame(
+            [
+                {"combo_id": p["id"], "product_id": ci["product_id"], "cantidad": ci.get("cantidad", 1)}
+                for p in combos for ci in (p.get("combo_items") or [])
+            ],
+            columns=["combo_id", "product_id", "cantidad"],
+        )
+        demanda = reorder.demanda_diaria(reorder.expandir_combos(v, c), hoy)
+        stock = pd.DataFrame(bps, columns=["id", "branch_id", "product_id", "stock", "stock_minimo", "costo"])
+        plan = reorder.sugerir(
+            stock, demanda, cfg.get("reposicion_dias_entrega"), cfg.get("reposicion_dias_cobertura")
+        )
+        plan = plan.astype(object).where(plan.notna(), None)
+        return plan.to_dict("records")
+
+    filas = await asyncio.to_thread(calcular)
+    corrida = str(uuid.uuid4())
+    ahora = datetime.now(timezone.utc)
+    await _bulk_por_tandas("reposicion", [
+        UpdateOne({"id": fila["id"]}, {"$set": {**fila, "empresa_id": empresa_id, "corrida": corrida, "actualizado": ahora}}, upsert=True)
+        for fila in filas
+    ])
+    # Lo que no se tocó en esta corrida es de branch_products dados de baja
+    await db.reposicion.delete_many({"empresa_id": empresa_id, "corrida": {"$ne": corrida}})
+    return len(filas)
+
+def _reposicion_query(user: User, branch_id: Optional[str], solo_sugeridos: bool) -> dict:
+    query = {"empresa_id": user.empresa_id}
+    # Supervisor: solo su sucursal
+    if user.rol != UserRole.ADMIN and user.branch_id:
+        query["branch_id"] = user.branch_id
+    elif branch_id:
+        query["branch_id"] = branch_id
+    if solo_sugeridos:
+        query["sugerido"] = {"$gt": 0}
+    return query
+
+async def _armar_reposicion(loader: BatchLoader, filas: list) -> list:
+    prods_map = await loader.load_many("products", [f["product_id"] for f in filas], projection={"id": 1, "nombre": 1, "codigo_barras": 1})
+    branches_map = await loader.load_many("branches", [f["branch_id"] for f in filas], projection={"id": 1, "nombre": 1})
+    items = []
+    for f in filas:
+        prod = prods_map.get(f["product_id"]) or {}
+        branch = branches_map.get(f["branch_id"]) or {}
+        costo = f.get("costo") or 0
+        items.append({
+            "branch_product_id": f["id"],
+            "product_id": f["product_id"],
+            "branch_id": f["branch_id"],
+            "nombre": prod.get("nombre", ""),
+            "codigo_barras": prod.get("codigo_barras", ""),
+            "sucursal": branch.get("nombre", ""),
+            "stock": f.get("stock", 0),
+            "stock_minimo": f.get("stock_minimo", 0),
+            "demanda_diaria": f.get("demanda_diaria", 0),
+            "dias_cobertura": f.get("dias_cobertura"),
+            "punto_pedido": f.get("punto_pedido", 0),
+            "sugerido": f.get("sugerido", 0),
+            "urgente": f.get("urgente", False),
+            # Listo para mandar en CompraCreate.items
+            "item_compra": {
+                "product_id": f["product_id"],
+                "descripcion": prod.get("nombre", ""),
+                "cantidad": f.get("sugerido", 0),
+                "precio_unitario": costo,
+                "subtotal": round(costo * f.get("sugerido", 0), 2),
+            },
         })
+    return items
+
+@api_router.get("/reorder-suggestions")
+async def get_reorder_suggestions(
+    branch_id: Optional[str] = Query(None),
+    solo_sugeridos: bool = Query(True),
+    page: int = Query(1, ge=1),
+    per_page: int = Query(50, ge=1, le=10000),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+):
+    query = _reposicion_query(user, branch_id, solo_sugeridos)
+    sort = [("dias_cobertura", 1), ("id", 1)]
+    filas, total = await _paginar_find("reposicion", query, sort, page, per_page, cursor, CountStrategy.EXACT)
+    items = await _armar_reposicion(BatchLoader(user.empresa_id), filas)
+    return {
+        "items": items,
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "total_pages": max(1, -(-total // per_page)),
+        "next_cursor": _next_cursor(filas, sort, per_page),
+        "actualizado": filas[0].get("actualizado") if filas else None,
+    }
+
+@api_router.get("/reorder-suggestions/export")
+async def export_reorder_suggestions(
+    branch_id: Optional[str] = Query(None),
+    solo_sugeridos: bool = Query(True),
+    format: str = Query("xlsx"),
+    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+):
+    query = _reposicion_query(user, branch_id, solo_sugeridos)
+    loader = BatchLoader(user.empresa_id)
+
+    async def armar_filas(filas):
+        return [
+            [
+                it["nombre"], it["codigo_barras"], it["sucursal"], it["stock"], it["demanda_diaria"],
+                it["dias_cobertura"], it["sugerido"], it["item_compra"]["precio_unitario"], it["item_compra"]["subtotal"],
+            ]
+            for it in await _armar_reposicion(loader, filas)
+        ]
 
-    return _rows_to_export_response(rows, "stock_bajo", format, sheet_name="Stock bajo")
+    columns = ["Producto", "Código de Barras", "Sucursal", "Stock Actual", "Venta Diaria", "Días de Cobertura", "Sugerido", "Costo Unitario", "Subtotal"]
+    cursor = db.reposicion.find(query, {"_id": 0}).sort([("dias_cobertura", 1), ("id", 1)])
+    return await _export_response(columns, _lotes_cursor(cursor, armar_filas), "reposicion", format, sheet_name="Reposición")
+
+@api_router.post("/reorder-suggestions/refresh")
+async def refresh_reorder_suggestions(user: User = Depends(require_role([UserRole.ADMIN]))):
+    await _acumular_ventas_diarias()
+    actualizados = await _recalcular_reposicion(user.empresa_id)
+    return {"actualizados": actualizados}
 
 # Proveedores routes
 @api_router.post("/proveedores", response_model=Proveedor)
@@ -4931,11 +6634,100 @@ async def delete_proveedor(
     await db.proveedores.update_one({"id": proveedor_id}, {"$set": {"activo": False}})
     return {"message": "Proveedor deactivated"}
 
-# Compras routes
-@api_router.post("/compras", response_model=Compra)
-async def create_compra(
-    compra_data: CompraCreate,
-    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+# --- Recepción de mercadería ---
+# Una compra (o su distribución) resuelve todas las líneas con un $in por colección y
+# escribe con un bulk_write sin orden por colección. Los cambios se acumulan por
+# producto sobre el estado del branch_product, así varias líneas del mismo producto
+# terminan en una sola escritura con el mismo resultado que aplicarlas en orden.
+RECEPCION_ACTUALIZADO = "actualizado"
+RECEPCION_ALTA = "alta_sucursal"
+RECEPCION_SIN_PRODUCTO = "sin_producto"
+
+class _Recepcion:
+    def __init__(self, empresa_id: str, branch_id: str):
+        self.empresa_id = empresa_id
+        self.branch_id = branch_id
+        self.bps: dict = {}
+        self.productos: dict = {}
+        self.stock_global: dict = {}
+        self._cambios: dict = {}
+
+    async def cargar(self, product_ids) -> None:
+        loader = BatchLoader(self.empresa_id)
+        self.bps, self.productos = await asyncio.gather(
+            loader.load_many("branch_products", product_ids, key="product_id", extra={"branch_id": self.branch_id}),
+            loader.load_many(
+                "products", product_ids,
+                projection={"_id": 0, "id": 1, "precio": 1, "costo": 1, "stock_minimo": 1, "kind": 1, "control_stock": 1},
+            ),
+        )
+
+    def actual(self, product_id: str) -> Optional[dict]:
+        """El branch_product como queda con los cambios acumulados hasta ahora."""
+        cambio = self._cambios.get(product_id)
+        if cambio and cambio["nuevo"] is not None:
+            return cambio["nuevo"]
+        bp = self.bps.get(product_id)
+        if bp is None:
+            return None
+        return {**bp, **cambio["set"]} if cambio else bp
+
+    def crear(self, product_id: str, bp: BranchProduct) -> None:
+        self._cambios[product_id] = {"inc": 0, "set": {}, "nuevo": bp.dict()}
+
+    def actualizar(self, product_id: str, inc: int = 0, set_fields: Optional[dict] = None) -> None:
+        cambio = self._cambios.setdefault(product_id, {"inc": 0, "set": {}, "nuevo": None})
+        if cambio["nuevo"] is not None:
+            cambio["nuevo"].update(set_fields or {})
+            cambio["nuevo"]["stock"] = (cambio["nuevo"].get("stock") or 0) + inc
+            cambio["nuevo"]["bajo_stock"] = _es_bajo_stock(cambio["nuevo"])
+        else:
+            cambio["inc"] += inc
+            cambio["set"].update(set_fields or {})
+
+    def sumar_stock_global(self, product_id: str, cantidad: int) -> None:
+        self.stock_global[product_id] = self.stock_global.get(product_id, 0) + cantidad
+
+    async def _bulk(self, coll: str, ops: list, claves: list, errores: dict) -> None:
+        if not ops:
+            return
+        try:
+            await db[coll].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                errores[claves[err["index"]]] = err.get("errmsg", "error de escritura")
+
+    async def aplicar(self) -> dict:
+        """Escribe todo lo acumulado. Devuelve {product_id: error} de lo que falló."""
+        bp_ops, bp_ids = [], []
+        for pid, cambio in self._cambios.items():
+            if cambio["nuevo"] is not None:
+                bp_ops.append(InsertOne(cambio["nuevo"]))
+            elif cambio["inc"] or cambio["set"]:
+                bp_ops.append(UpdateOne(
+                    {"id": self.bps[pid]["id"], "empresa_id": self.empresa_id},
+                    _bp_stock_update(cambio["inc"], cambio["set"]),
+                ))
+            else:
+                continue
+            bp_ids.append(pid)
+        prod_ids = [pid for pid, n in self.stock_global.items() if n]
+        prod_ops = [
+            UpdateOne({"id": pid, "empresa_id": self.empresa_id}, {"$inc": {"stock": self.stock_global[pid]}})
+            for pid in prod_ids
+        ]
+        errores: dict = {}
+        await asyncio.gather(
+            self._bulk("branch_products", bp_ops, bp_ids, errores),
+            self._bulk("products", prod_ops, prod_ids, errores),
+        )
+        return errores
+
+# Compras routes
+@api_router.post("/compras", response_model=Compra)
+async def create_compra(
+    compra_data: CompraCreate,
+    user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
 ):
     cfg = await db.configuration.find_one({"empresa_id": user.empresa_id}) or {}
     redondeo = cfg.get("redondeo_precio", 100)
@@ -4953,44 +6745,49 @@ async def create_compra(
             proveedor_nombre = prov["nombre"]
 
     # Process items: capture costo_anterior and update branch products in one pass
-    enriched_items = []
-    for item in compra_data.items:
-        item_dict = item.dict()
-        if item.product_id and compra_data.sucursal_id:
-            bp = await db.branch_products.find_one({
-                "product_id": item.product_id,
-                "branch_id": compra_data.sucursal_id,
-                "empresa_id": user.empresa_id
-            })
-            if bp:
-                item_dict["costo_anterior"] = bp.get("costo")
-                bp_update: dict = {"costo": item.precio_unitario}
-                if item.actualizar_precio:
-                    if item.nuevo_precio is not None:
-                        bp_update["precio"] = item.nuevo_precio
-                    else:
-                        margen = bp.get("margen") or 0
-                        bp_update["precio"] = _redondear_precio(item.precio_unitario * (1 + margen / 100))
-                    if item.nuevo_margen is not None:
-                        bp_update["margen"] = item.nuevo_margen
-                await db.branch_products.update_one(
-                    {"id": bp["id"]},
-                    {"$set": bp_update, "$inc": {"stock": int(item.cantidad)}}
-                )
+    enriched_items = [item.dict() for item in compra_data.items]
+    recepcion = None
+    if compra_data.sucursal_id:
+        recepcion = _Recepcion(user.empresa_id, compra_data.sucursal_id)
+        await recepcion.cargar([item.product_id for item in compra_data.items])
+    for item, item_dict in zip(compra_data.items, enriched_items):
+        if not item.product_id or recepcion is None:
+            continue
+        bp = recepcion.actual(item.product_id)
+        if bp:
+            item_dict["costo_anterior"] = bp.get("costo")
+            bp_update: dict = {"costo": item.precio_unitario}
+            if item.actualizar_precio:
+                if item.nuevo_precio is not None:
+                    bp_update["precio"] = item.nuevo_precio
+                else:
+                    margen = bp.get("margen") or 0
+                    bp_update["precio"] = _redondear_precio(item.precio_unitario * (1 + margen / 100))
+                if item.nuevo_margen is not None:
+                    bp_update["margen"] = item.nuevo_margen
+            recepcion.actualizar(item.product_id, int(item.cantidad), bp_update)
+            item_dict["resultado"] = RECEPCION_ACTUALIZADO
+        else:
+            global_product = recepcion.productos.get(item.product_id)
+            if global_product:
+                recepcion.crear(item.product_id, BranchProduct(
+                    empresa_id=user.empresa_id,
+                    product_id=item.product_id,
+                    branch_id=compra_data.sucursal_id,
+                    precio=global_product.get("precio", 0),
+                    stock=int(item.cantidad),
+                    stock_minimo=global_product.get("stock_minimo", 10),
+                    costo=item.precio_unitario,
+                    **_bp_flags(global_product),
+                ))
+                item_dict["resultado"] = RECEPCION_ALTA
             else:
-                global_product = await db.products.find_one({"id": item.product_id, "empresa_id": user.empresa_id})
-                if global_product:
-                    new_bp = BranchProduct(
-                        empresa_id=user.empresa_id,
-                        product_id=item.product_id,
-                        branch_id=compra_data.sucursal_id,
-                        precio=global_product.get("precio", 0),
-                        stock=int(item.cantidad),
-                        stock_minimo=global_product.get("stock_minimo", 10),
-                        costo=item.precio_unitario,
-                    )
-                    await db.branch_products.insert_one(new_bp.dict())
-        enriched_items.append(item_dict)
+                item_dict["resultado"] = RECEPCION_SIN_PRODUCTO
+    if recepcion is not None:
+        errores = await recepcion.aplicar()
+        for item_dict in enriched_items:
+            if item_dict.get("product_id") in errores:
+                item_dict["resultado"] = f"error: {errores[item_dict['product_id']]}"
 
     compra_dict = compra_data.dict()
     compra_dict["items"] = enriched_items
@@ -5110,18 +6907,14 @@ async def distribuir_compra(
             )
 
     # Aplicar a sucursal
+    recepcion = _Recepcion(user.empresa_id, data.sucursal_id)
+    await recepcion.cargar([item.product_id for item in data.items])
     distribucion_items = []
     for item in data.items:
         if not item.actualizar_stock and not item.actualizar_precio:
             continue
 
-        bp = await db.branch_products.find_one({
-            "product_id": item.product_id,
-            "branch_id": data.sucursal_id,
-            "empresa_id": user.empresa_id
-        })
-
-        update_op: dict = {}
+        inc = 0
         set_fields: dict = {}
 
         costo = costo_por_producto.get(item.product_id)
@@ -5134,35 +6927,34 @@ async def distribuir_compra(
             if item.nuevo_margen is not None:
                 set_fields["margen"] = item.nuevo_margen
 
-        if set_fields:
-            update_op["$set"] = set_fields
-
         if item.actualizar_stock and item.cantidad > 0:
-            update_op.setdefault("$inc", {})["stock"] = int(item.cantidad)
-            await db.products.update_one(
-                {"id": item.product_id, "empresa_id": user.empresa_id},
-                {"$inc": {"stock": int(item.cantidad)}}
-            )
-
-        if update_op:
-            if bp:
-                await db.branch_products.update_one({"id": bp["id"]}, update_op)
+            inc = int(item.cantidad)
+            recepcion.sumar_stock_global(item.product_id, inc)
+
+        resultado = RECEPCION_ACTUALIZADO
+        if not inc and not set_fields:
+            pass
+        elif recepcion.actual(item.product_id):
+            recepcion.actualizar(item.product_id, inc, set_fields)
+        else:
+            global_product = recepcion.productos.get(item.product_id)
+            if global_product:
+                bp_data = dict(
+                    empresa_id=user.empresa_id,
+                    product_id=item.product_id,
+                    branch_id=data.sucursal_id,
+                    precio=item.nuevo_precio or global_product.get("precio", 0),
+                    stock=int(item.cantidad) if item.actualizar_stock else 0,
+                    stock_minimo=global_product.get("stock_minimo", 10),
+                    costo=costo_por_producto.get(item.product_id, global_product.get("costo", 0)),
+                    **_bp_flags(global_product),
+                )
+                if item.nuevo_margen is not None:
+                    bp_data["margen"] = item.nuevo_margen
+                recepcion.crear(item.product_id, BranchProduct(**bp_data))
+                resultado = RECEPCION_ALTA
             else:
-                global_product = await db.products.find_one({"id": item.product_id, "empresa_id": user.empresa_id})
-                if global_product:
-                    bp_data = dict(
-                        empresa_id=user.empresa_id,
-                        product_id=item.product_id,
-                        branch_id=data.sucursal_id,
-                        precio=item.nuevo_precio or global_product.get("precio", 0),
-                        stock=int(item.cantidad) if item.actualizar_stock else 0,
-                        stock_minimo=global_product.get("stock_minimo", 10),
-                        costo=costo_por_producto.get(item.product_id, global_product.get("costo", 0)),
-                    )
-                    if item.nuevo_margen is not None:
-                        bp_data["margen"] = item.nuevo_margen
-                    new_bp = BranchProduct(**bp_data)
-                    await db.branch_products.insert_one(new_bp.dict())
+                resultado = RECEPCION_SIN_PRODUCTO
 
         distribucion_items.append({
             "product_id": item.product_id,
@@ -5171,11 +6963,17 @@ async def distribuir_compra(
             "nuevo_margen": item.nuevo_margen,
             "actualizo_stock": item.actualizar_stock,
             "actualizo_precio": item.actualizar_precio,
+            "resultado": resultado,
         })
 
     if not distribucion_items:
         raise HTTPException(status_code=400, detail="No hay ítems para aplicar")
 
+    errores = await recepcion.aplicar()
+    for it in distribucion_items:
+        if it["product_id"] in errores:
+            it["resultado"] = f"error: {errores[it['product_id']]}"
+
     distribucion = {
         "id": str(uuid.uuid4()),
         "sucursal_id": data.sucursal_id,
@@ -5193,6 +6991,140 @@ async def distribuir_compra(
 # CUENTA / SUSCRIPCIÓN routes
 # ─────────────────────────────────────────────
 
+# --- Métricas del panel owner ---
+# owner_stats contaba suscripciones por estado y sumaba en Python todos los pagos
+# aprobados de la historia (y con más de 10000 se quedaba corto). Ahora owner_metricas
+# guarda los acumulados y cada escritura que los mueve los ajusta con un $inc:
+#   _id "global":       suscripciones por estado, MRR, total recaudado, pagos aprobados
+#   _id "mes:AAAA-MM":  recaudado, pagos y altas del mes (serie para el historial)
+# Las suscripciones se escriben con _insertar_suscripcion / _set_suscripcion, que
+# comparan el doc antes y después; los pagos ajustan al entrar o salir de "approved".
+# _reconstruir_metricas_owner arma todo de cero (al arrancar si no hay, a pedido y en
+# el rollup nocturno).
+def _estado_suscripcion(sus: Optional[dict]) -> Optional[str]:
+    if not sus:
+        return None
+    estado = sus.get("status")
+    return estado.value if hasattr(estado, "value") else estado
+
+def _mrr_suscripcion(sus: Optional[dict]) -> float:
+    """Ingreso mensual de una suscripción activa (las anuales se prorratean en 12)."""
+    if _estado_suscripcion(sus) != SuscripcionStatus.ACTIVA.value:
+        return 0.0
+    precio = float(sus.get("precio") or 0)
+    return precio / 12 if sus.get("plan_tipo") == "anual" else precio
+
+def _mes_metricas(fecha) -> str:
+    return f"mes:{_dia_local(fecha or datetime.now(timezone.utc))[:7]}"
+
+async def _inc_metricas_suscripcion(antes: Optional[dict], despues: Optional[dict]) -> None:
+    inc: dict = {}
+    estado_antes, estado_despues = _estado_suscripcion(antes), _estado_suscripcion(despues)
+    if estado_antes != estado_despues:
+        if estado_antes:
+            inc[f"estados.{estado_antes}"] = -1
+        if estado_despues:
+            inc[f"estados.{estado_despues}"] = 1
+    mrr = _mrr_suscripcion(despues) - _mrr_suscripcion(antes)
+    if mrr:
+        inc["mrr"] = mrr
+    if inc:
+        await db.owner_metricas.update_one({"_id": "global"}, {"$inc": inc}, upsert=True)
+    if antes is None and despues is not None:
+        await db.owner_metricas.update_one(
+            {"_id": _mes_metricas(despues.get("created_at"))}, {"$inc": {"altas": 1}}, upsert=True
+        )
+
+async def _inc_metricas_pago(monto: float, fecha, signo: int = 1) -> None:
+    monto = float(monto or 0) * signo
+    await asyncio.gather(
+        db.owner_metricas.update_one(
+            {"_id": "global"}, {"$inc": {"total_recaudado": monto, "pagos_aprobados": signo}}, upsert=True
+        ),
+        db.owner_metricas.update_one(
+            {"_id": _mes_metricas(fecha)}, {"$inc": {"recaudado": monto, "pagos": signo}}, upsert=True
+        ),
+    )
+
+async def _insertar_suscripcion(doc: dict) -> None:
+    await db.suscripciones.insert_one(doc)
+    await _inc_metricas_suscripcion(None, doc)
+
+async def _set_suscripcion(filtro: dict, campos: dict) -> None:
+    antes = await db.suscripciones.find_one_and_update(
+        filtro, {"$set": campos}, return_document=ReturnDocument.BEFORE
+    )
+    if antes:
+        await _inc_metricas_suscripcion(antes, {**antes, **campos})
+
+async def _insertar_pago(doc: dict) -> None:
+    await db.pagos_suscripcion.insert_one(doc)
+    if doc.get("estado") == "approved":
+        await _inc_metricas_pago(doc.get("monto"), doc.get("fecha"))
+
+async def _set_pago(filtro: dict, campos: dict) -> None:
+    antes = await db.pagos_suscripcion.find_one_and_update(
+        filtro, {"$set": campos}, return_document=ReturnDocument.BEFORE
+    )
+    if not antes:
+        return
+    era, es = antes.get("estado") == "approved", {**antes, **campos}.get("estado") == "approved"
+    if era != es:
+        await _inc_metricas_pago(antes.get("monto"), antes.get("fecha"), 1 if es else -1)
+
+async def _reconstruir_metricas_owner() -> dict:
+    """Recalcula owner_metricas desde suscripciones y pagos_suscripcion y reemplaza lo
+    guardado. Los meses se pisan uno por uno marcados con la generación de esta corrida y
+    después se borran los de otra generación, así el historial nunca queda vacío a medias."""
+    def mes(campo: str) -> dict:
+        # $toDate también acepta las fechas guardadas como texto ISO; sin fecha queda en null
+        return {"$dateToString": {"format": "mes:%Y-%m", "date": {"$toDate": campo}, "timezone": "-03:00"}}
+    estados, pagos_mes, altas_mes = await asyncio.gather(
+        db.suscripciones.aggregate([{"$group": {
+            "_id": "$status",
+            "n": {"$sum": 1},
+            "mrr": {"$sum": {"$cond": [
+                {"$eq": ["$plan_tipo", "anual"]},
+                {"$divide": [{"$ifNull": ["$precio", 0]}, 12]},
+                {"$ifNull": ["$precio", 0]},
+            ]}},
+        }}]).to_list(None),
+        db.pagos_suscripcion.aggregate([
+            {"$match": {"estado": "approved"}},
+            {"$group": {"_id": mes("$fecha"), "recaudado": {"$sum": "$monto"}, "pagos": {"$sum": 1}}},
+        ]).to_list(None),
+        db.suscripciones.aggregate([
+            {"$match": {"created_at": {"$ne": None}}},
+            {"$group": {"_id": mes("$created_at"), "altas": {"$sum": 1}}},
+        ]).to_list(None),
+    )
+    meses: dict = {}
+    for p in pagos_mes:
+        if not p["_id"]:
+            continue
+        meses.setdefault(p["_id"], {"recaudado": 0.0, "pagos": 0, "altas": 0}).update(recaudado=p["recaudado"], pagos=p["pagos"])
+    for a in altas_mes:
+        if not a["_id"]:
+            continue
+        meses.setdefault(a["_id"], {"recaudado": 0.0, "pagos": 0, "altas": 0})["altas"] = a["altas"]
+    global_doc = {
+        "estados": {e["_id"]: e["n"] for e in estados if e["_id"]},
+        "mrr": sum(e["mrr"] for e in estados if e["_id"] == SuscripcionStatus.ACTIVA.value),
+        "total_recaudado": sum(p["recaudado"] for p in pagos_mes),
+        "pagos_aprobados": sum(p["pagos"] for p in pagos_mes),
+        "reconstruido": datetime.now(timezone.utc),
+    }
+    generacion = str(uuid.uuid4())
+    if meses:
+        await db.owner_metricas.bulk_write([
+            UpdateOne({"_id": k}, {"$set": {**v, "generacion": generacion}}, upsert=True)
+            for k, v in meses.items()
+        ], ordered=False)
+    await db.owner_metricas.delete_many({"_id": {"$regex": "^mes:"}, "generacion": {"$ne": generacion}})
+    await db.owner_metricas.replace_one({"_id": "global"}, global_doc, upsert=True)
+    return global_doc
+
+
 async def _get_or_create_suscripcion(empresa_id: str) -> dict:
     """Devuelve la suscripción de la empresa; si no existe, crea una trial."""
     doc = await db.suscripciones.find_one({"empresa_id": empresa_id})
@@ -5210,7 +7142,7 @@ async def _get_or_create_suscripcion(empresa_id: str) -> dict:
             dia_facturacion=dia_facturacion,
             plan_tipo="mensual",
         )
-        await db.suscripciones.insert_one(suscripcion.dict())
+        await _insertar_suscripcion(suscripcion.dict())
         doc = suscripcion.dict()
     # Normalizar vencimiento
     vencimiento = doc["fecha_vencimiento"]
@@ -5223,20 +7155,14 @@ async def _get_or_create_suscripcion(empresa_id: str) -> dict:
     if vencimiento < now:
         if doc["status"] == SuscripcionStatus.TRIAL:
             # Trial vencido: sin periodo de gracia, bloqueo inmediato
-            await db.suscripciones.update_one(
-                {"empresa_id": empresa_id},
-                {"$set": {"status": SuscripcionStatus.VENCIDA}}
-            )
+            await _set_suscripcion({"empresa_id": empresa_id}, {"status": SuscripcionStatus.VENCIDA})
             doc["status"] = SuscripcionStatus.VENCIDA
         elif doc["status"] == SuscripcionStatus.ACTIVA:
             # Suscripción paga: periodo de gracia configurable
             gracia_fin = vencimiento + timedelta(days=await get_grace_days())
             if now > gracia_fin:
                 # Gracia expirada → bloquear
-                await db.suscripciones.update_one(
-                    {"empresa_id": empresa_id},
-                    {"$set": {"status": SuscripcionStatus.VENCIDA}}
-                )
+                await _set_suscripcion({"empresa_id": empresa_id}, {"status": SuscripcionStatus.VENCIDA})
                 doc["status"] = SuscripcionStatus.VENCIDA
             # else: dentro de gracia, mantener ACTIVA en DB
     return doc
@@ -5543,7 +7469,7 @@ async def crear_pago_suscripcion(data: PagoCreate = PagoCreate(), user: User = D
         sucursales_extra=sucursales_extra,
         usuarios_extra_packs=usuarios_extra_packs,
     )
-    await db.pagos_suscripcion.insert_one(pago.dict())
+    await _insertar_pago(pago.dict())
 
     return {
         "init_point": preference["init_point"],
@@ -5625,7 +7551,7 @@ async def activar_suscripcion_automatica(user: User = Depends(require_role([User
         # Crear suscripción si no existe (edge case)
         now = datetime.now(timezone.utc)
         nueva_fecha = calcular_siguiente_vencimiento(dia_facturacion, 1, now)
-        await db.suscripciones.insert_one(Suscripcion(
+        await _insertar_suscripcion(Suscripcion(
             empresa_id=user.empresa_id,
             plan_nombre=nombre_base,
             precio=precio_mensual,
@@ -5707,22 +7633,22 @@ async def simular_pago_aprobado(
     suscripcion = await db.suscripciones.find_one({"empresa_id": user.empresa_id})
     if suscripcion:
         base, nueva_fecha = _aplicar_renovacion(suscripcion, meses, now)
-        await db.suscripciones.update_one(
+        await _set_suscripcion(
             {"empresa_id": user.empresa_id},
-            {"$set": {
+            {
                 "status": SuscripcionStatus.ACTIVA,
                 "fecha_vencimiento": nueva_fecha,
                 "plan_tipo": plan_tipo,
                 "fue_pagada": True,
                 "plan_nombre": plan_nombre,
                 "precio": precio,
-            }},
+            },
         )
     else:
         dia_facturacion = min(now.day, 28)
         base = now
         nueva_fecha = calcular_siguiente_vencimiento(dia_facturacion, meses, now)
-        await db.suscripciones.insert_one(Suscripcion(
+        await _insertar_suscripcion(Suscripcion(
             empresa_id=user.empresa_id,
             plan_nombre=plan_nombre,
             precio=precio,
@@ -5746,7 +7672,7 @@ async def simular_pago_aprobado(
         periodo_fin=nueva_fecha,
         plan_tipo=plan_tipo,
     )
-    await db.pagos_suscripcion.insert_one(pago.dict())
+    await _insertar_pago(pago.dict())
 
     return {"ok": True, "nueva_fecha_vencimiento": nueva_fecha.isoformat()}
 
@@ -5793,7 +7719,7 @@ async def _procesar_pago_aprobado(empresa_id: str, payment_id: str, monto: float
         if preapproval_id:
             update_fields["tipo_cobro"] = "automatico"
             update_fields["mp_preapproval_id"] = preapproval_id
-        await db.suscripciones.update_one({"empresa_id": empresa_id}, {"$set": update_fields})
+        await _set_suscripcion({"empresa_id": empresa_id}, update_fields)
         dia_sus = suscripcion.get("dia_facturacion") or min(base.day, 28)
         await db.pagos_suscripcion.update_one(
             {"empresa_id": empresa_id, "mp_payment_id": payment_id},
@@ -5816,7 +7742,7 @@ async def _procesar_pago_aprobado(empresa_id: str, payment_id: str, monto: float
             tipo_cobro="automatico" if preapproval_id else "manual",
             mp_preapproval_id=preapproval_id,
         )
-        await db.suscripciones.insert_one(suscripcion_nueva.dict())
+        await _insertar_suscripcion(suscripcion_nueva.dict())
 
 
 # Webhook de MercadoPago (sin autenticación JWT)
@@ -5879,7 +7805,7 @@ async def mp_webhook(request: Request):
                 origen="preapproval",
                 plan_tipo="mensual",
             )
-            await db.pagos_suscripcion.insert_one(pago.dict())
+            await _insertar_pago(pago.dict())
 
         if estado_pago in ("approved", "") or not estado_pago:
             await _procesar_pago_aprobado(
@@ -5971,10 +7897,7 @@ async def mp_webhook(request: Request):
             "estado": "pending",
         })
         if pago_doc:
-            await db.pagos_suscripcion.update_one(
-                {"id": pago_doc["id"]},
-                {"$set": {"estado": estado, "mp_payment_id": payment_id}}
-            )
+            await _set_pago({"id": pago_doc["id"]}, {"estado": estado, "mp_payment_id": payment_id})
         else:
             empresa = await db.empresas.find_one({"id": empresa_id})
             empresa_nombre = empresa["nombre"] if empresa else empresa_id
@@ -5986,12 +7909,9 @@ async def mp_webhook(request: Request):
                 concepto=f"{SUSCRIPCION_PLAN_NOMBRE} - {empresa_nombre}",
                 mp_payment_id=payment_id,
             )
-            await db.pagos_suscripcion.insert_one(pago.dict())
+            await _insertar_pago(pago.dict())
     else:
-        await db.pagos_suscripcion.update_one(
-            {"id": existing_pago["id"]},
-            {"$set": {"estado": estado}}
-        )
+        await _set_pago({"id": existing_pago["id"]}, {"estado": estado})
 
     # Si el pago fue aprobado → extender suscripción
     if estado == "approved":
@@ -6095,24 +8015,58 @@ async def owner_impersonate(empresa_id: str, _=Depends(verify_owner_token)):
 
 @owner_router.get("/stats")
 async def owner_stats(_=Depends(verify_owner_token)):
-    total = await db.empresas.count_documents({})
-    activas = await db.suscripciones.count_documents({"status": SuscripcionStatus.ACTIVA})
-    trial = await db.suscripciones.count_documents({"status": SuscripcionStatus.TRIAL})
-    vencidas = await db.suscripciones.count_documents({"status": SuscripcionStatus.VENCIDA})
-    suspendidas = await db.suscripciones.count_documents({"status": SuscripcionStatus.SUSPENDIDA})
-    pagos = await db.pagos_suscripcion.find({"estado": "approved"}).to_list(10000)
-    total_recaudado = sum(p.get("monto", 0) for p in pagos)
-    alertas_sin_leer = await db.notificaciones.count_documents({"leida": False})
+    total, metricas, alertas_sin_leer = await asyncio.gather(
+        _contar("empresas", {}, CountStrategy.ESTIMATED),
+        db.owner_metricas.find_one({"_id": "global"}),
+        db.notificaciones.count_documents({"leida": False}),
+    )
+    if not metricas:
+        metricas = await _reconstruir_metricas_owner()
+    estados = metricas.get("estados", {})
     return {
         "total_clientes": total,
-        "activas": activas,
-        "trial": trial,
-        "vencidas": vencidas,
-        "suspendidas": suspendidas,
-        "total_recaudado": total_recaudado,
+        "activas": estados.get(SuscripcionStatus.ACTIVA.value, 0),
+        "trial": estados.get(SuscripcionStatus.TRIAL.value, 0),
+        "vencidas": estados.get(SuscripcionStatus.VENCIDA.value, 0),
+        "suspendidas": estados.get(SuscripcionStatus.SUSPENDIDA.value, 0),
+        "total_recaudado": metricas.get("total_recaudado", 0.0),
+        "pagos_aprobados": metricas.get("pagos_aprobados", 0),
+        "mrr": round(metricas.get("mrr", 0.0), 2),
         "alertas_sin_leer": alertas_sin_leer,
     }
 
+@owner_router.get("/stats/history")
+async def owner_stats_history(meses: int = Query(12, ge=1, le=120), _=Depends(verify_owner_token)):
+    """Serie mensual de recaudación, pagos y altas (los meses sin movimiento van en cero)."""
+    hoy = datetime.now(AR_TZ)
+    claves = []
+    anio, mes = hoy.year, hoy.month
+    for _ in range(meses):
+        claves.append(f"mes:{anio:04d}-{mes:02d}")
+        anio, mes = (anio, mes - 1) if mes > 1 else (anio - 1, 12)
+    docs = {d["_id"]: d async for d in db.owner_metricas.find({"_id": {"$in": claves}})}
+    return [
+        {
+            "mes": clave[len("mes:"):],
+            "recaudado": docs.get(clave, {}).get("recaudado", 0.0),
+            "pagos": docs.get(clave, {}).get("pagos", 0),
+            "altas": docs.get(clave, {}).get("altas", 0),
+        }
+        for clave in reversed(claves)
+    ]
+
+@owner_router.post("/stats/rebuild")
+async def owner_stats_rebuild(_=Depends(verify_owner_token)):
+    """Recalcula las métricas del panel desde cero (por si alguna escritura quedó afuera)."""
+    metricas = await _reconstruir_metricas_owner()
+    return {"ok": True, "mrr": round(metricas["mrr"], 2), "total_recaudado": metricas["total_recaudado"]}
+
+@owner_router.get("/indexes")
+async def owner_indexes(_=Depends(verify_owner_token)):
+    """Diferencias entre los índices declarados en indexes.py y los de la base (solo lectura)."""
+    drift = await indexes.revisar(db)
+    return {k: [{**i, "claves": dict(i["claves"])} for i in items] for k, items in drift.items()}
+
 def _calc_dias_restantes(suscripcion: dict) -> int:
     if not suscripcion:
         return 0
@@ -6156,7 +8110,7 @@ async def owner_create_cliente(data: OwnerCreateCliente, _=Depends(verify_owner_
         plan_tipo="mensual",
         plan_tier="empresarial",
     )
-    await db.suscripciones.insert_one(suscripcion.dict())
+    await _insertar_suscripcion(suscripcion.dict())
 
     default_branch = Branch(empresa_id=empresa.id, nombre="Sucursal Principal", direccion="")
     await db.branches.insert_one(default_branch.dict())
@@ -6166,21 +8120,94 @@ async def owner_create_cliente(data: OwnerCreateCliente, _=Depends(verify_owner_
 
     return {"id": empresa.id, "nombre": empresa.nombre, "email": data.admin_email}
 
+# Orden del listado de clientes del panel (mismas opciones que el selector del panel).
+# Sin suscripción o sin vencimiento quedan al final en los dos sentidos.
+_VENCIMIENTO_SIN_DATO = {"asc": datetime(9999, 1, 1, tzinfo=timezone.utc), "desc": datetime(1970, 1, 1, tzinfo=timezone.utc)}
+_ORDEN_CLIENTES = {
+    "created_desc": [("created_at", -1), ("id", -1)],
+    "created_asc": [("created_at", 1), ("id", 1)],
+    "nombre_asc": [("nombre", 1), ("id", 1)],
+    "nombre_desc": [("nombre", -1), ("id", -1)],
+    "vencimiento_asc": [("vencimiento_orden", 1), ("id", 1)],
+    "vencimiento_desc": [("vencimiento_orden", -1), ("id", -1)],
+}
+
 @owner_router.get("/clientes")
-async def owner_get_clientes(_=Depends(verify_owner_token)):
-    empresas = await db.empresas.find({}).sort("created_at", -1).to_list(1000)
+async def owner_get_clientes(
+    q: Optional[str] = Query(None),
+    estado: Optional[str] = Query(None, alias="status"),
+    sort: str = Query("created_desc"),
+    page: int = Query(1, ge=1),
+    per_page: Optional[int] = Query(None, ge=1, le=500),
+    _=Depends(verify_owner_token)
+):
+    """Un solo aggregate: suscripción y admin por $lookup, filtro/orden/página en Mongo y
+    los pagos aprobados solo para la página. Sin per_page devuelve la lista completa
+    (como la usa hoy el panel); con per_page, {items, total, page, per_page, por_estado}."""
+    filtro: dict = {}
+    if q and q.strip():
+        regex = {"$regex": re.escape(q.strip()), "$options": "i"}
+        filtro["$or"] = [{"nombre": regex}, {"admin.email": regex}]
+    if estado and estado != "all":
+        filtro["estado_suscripcion"] = estado
+    orden = _ORDEN_CLIENTES.get(sort, _ORDEN_CLIENTES["created_desc"])
+    sin_vencimiento = _VENCIMIENTO_SIN_DATO["desc" if orden[0][1] == -1 else "asc"]
+
+    items = [{"$match": filtro}, {"$sort": dict(orden)}]
+    if per_page:
+        items += [{"$skip": (page - 1) * per_page}, {"$limit": per_page}]
+    items += [
+        {"$lookup": {
+            "from": "pagos_suscripcion",
+            "let": {"empresa_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$empresa_id", "$$empresa_id"]}, "estado": "approved"}},
+                {"$count": "n"},
+            ],
+            "as": "pagos",
+        }},
+    ]
+    pipeline = [
+        {"$project": {"_id": 0, "id": 1, "nombre": 1, "activo": 1, "created_at": 1}},
+        {"$lookup": {"from": "suscripciones", "localField": "id", "foreignField": "empresa_id", "as": "suscripcion"}},
+        {"$lookup": {
+            "from": "users",
+            "let": {"empresa_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$empresa_id", "$$empresa_id"]}, "rol": "admin"}},
+                {"$limit": 1},
+                {"$project": {"_id": 0, "email": 1, "nombre": 1}},
+            ],
+            "as": "admin",
+        }},
+        {"$set": {
+            "suscripcion": {"$arrayElemAt": ["$suscripcion", 0]},
+            "admin": {"$arrayElemAt": ["$admin", 0]},
+        }},
+        {"$set": {
+            "estado_suscripcion": {"$ifNull": ["$suscripcion.status", "sin_suscripcion"]},
+            # Hay suscripciones viejas con fecha_vencimiento en texto ISO: se pasa todo a
+            # date ($toDate, que con un texto inválido da null) para no ordenar strings
+            # contra fechas, que Mongo pone en bloques separados
+            "vencimiento_orden": {"$ifNull": [
+                {"$convert": {"input": "$suscripcion.fecha_vencimiento", "to": "date", "onError": None, "onNull": None}},
+                sin_vencimiento,
+            ]},
+        }},
+        {"$facet": {
+            "items": items,
+            "total": [{"$match": filtro}, {"$count": "n"}],
+            "por_estado": [{"$group": {"_id": "$estado_suscripcion", "n": {"$sum": 1}}}],
+        }},
+    ]
+    res = (await db.empresas.aggregate(pipeline, allowDiskUse=True).to_list(1) or [{}])[0]
+
     result = []
-    for emp in empresas:
-        suscripcion = await db.suscripciones.find_one({"empresa_id": emp["id"]})
-        admin = await db.users.find_one({"empresa_id": emp["id"], "rol": "admin"})
-        pagos_count = await db.pagos_suscripcion.count_documents(
-            {"empresa_id": emp["id"], "estado": "approved"}
-        )
-        dias_restantes = _calc_dias_restantes(suscripcion)
-        # Convert ObjectId and datetime for JSON serialization
-        sus_data = None
+    for emp in res.get("items", []):
+        suscripcion = emp.get("suscripcion")
+        admin = emp.get("admin")
         if suscripcion:
-            sus_data = {k: v for k, v in suscripcion.items() if k != "_id"}
+            suscripcion.pop("_id", None)
         result.append({
             "id": emp["id"],
             "nombre": emp["nombre"],
@@ -6188,11 +8215,21 @@ async def owner_get_clientes(_=Depends(verify_owner_token)):
             "created_at": emp.get("created_at"),
             "admin_email": admin["email"] if admin else None,
             "admin_nombre": admin["nombre"] if admin else None,
-            "suscripcion": sus_data,
-            "dias_restantes": dias_restantes,
-            "pagos_aprobados": pagos_count,
+            "suscripcion": suscripcion,
+            "dias_restantes": _calc_dias_restantes(suscripcion),
+            "pagos_aprobados": emp["pagos"][0]["n"] if emp.get("pagos") else 0,
         })
-    return result
+    if not per_page:
+        return result
+    por_estado = {e["_id"]: e["n"] for e in res.get("por_estado", [])}
+    por_estado["all"] = sum(por_estado.values())
+    return {
+        "items": result,
+        "total": res["total"][0]["n"] if res.get("total") else 0,
+        "page": page,
+        "per_page": per_page,
+        "por_estado": por_estado,
+    }
 
 @owner_router.get("/clientes/{empresa_id}")
 async def owner_get_cliente(empresa_id: str, _=Depends(verify_owner_token)):
@@ -6272,7 +8309,7 @@ async def owner_update_suscripcion(
         update["fecha_vencimiento"] = data.fecha_vencimiento
     if update:
         if suscripcion:
-            await db.suscripciones.update_one({"empresa_id": empresa_id}, {"$set": update})
+            await _set_suscripcion({"empresa_id": empresa_id}, update)
         else:
             now = datetime.now(timezone.utc)
             fv = update.get("fecha_vencimiento", now + timedelta(days=await get_trial_dias()))
@@ -6286,7 +8323,7 @@ async def owner_update_suscripcion(
                 fecha_vencimiento=fv,
                 dia_facturacion=dia_fact,
             )
-            await db.suscripciones.insert_one(nueva.dict())
+            await _insertar_suscripcion(nueva.dict())
     return {"message": "Suscripción actualizada"}
 
 @owner_router.post("/clientes/{empresa_id}/pago")
@@ -6309,18 +8346,18 @@ async def owner_registrar_pago(
         plan_tipo=plan_tipo,
         fecha=fecha_pago,
     )
-    await db.pagos_suscripcion.insert_one(pago.dict())
+    await _insertar_pago(pago.dict())
     suscripcion = await db.suscripciones.find_one({"empresa_id": empresa_id})
     if suscripcion:
         base, nueva_fecha = _aplicar_renovacion(suscripcion, meses, fecha_pago)
-        await db.suscripciones.update_one(
+        await _set_suscripcion(
             {"empresa_id": empresa_id},
-            {"$set": {
+            {
                 "status": SuscripcionStatus.ACTIVA,
                 "fecha_vencimiento": nueva_fecha,
                 "plan_tipo": plan_tipo,
                 "fue_pagada": True,
-            }}
+            }
         )
         dia_sus = suscripcion.get("dia_facturacion") or min(base.day, 28)
         await db.pagos_suscripcion.update_one(
@@ -6340,7 +8377,7 @@ async def owner_registrar_pago(
             dia_facturacion=dia_facturacion,
             plan_tipo=plan_tipo,
         )
-        await db.suscripciones.insert_one(nueva_sus.dict())
+        await _insertar_suscripcion(nueva_sus.dict())
     return {"message": "Pago registrado y suscripción renovada"}
 
 @owner_router.delete("/clientes/{empresa_id}/pago/{pago_id}")
@@ -6356,6 +8393,8 @@ async def owner_eliminar_pago(empresa_id: str, pago_id: str, _=Depends(verify_ow
     if not ultimo or ultimo["id"] != pago_id:
         raise HTTPException(status_code=400, detail="Solo se puede eliminar el último pago registrado")
     await db.pagos_suscripcion.delete_one({"id": pago_id})
+    if pago.get("estado") == "approved":
+        await _inc_metricas_pago(pago.get("monto"), pago.get("fecha"), -1)
     # Rollback: revertir el vencimiento al inicio del período del pago eliminado
     suscripcion = await db.suscripciones.find_one({"empresa_id": empresa_id})
     if suscripcion:
@@ -6371,9 +8410,9 @@ async def owner_eliminar_pago(empresa_id: str, pago_id: str, _=Depends(verify_ow
             nuevo_status = SuscripcionStatus.ACTIVA if periodo_inicio > now else (
                 SuscripcionStatus.TRIAL if pagos_restantes == 0 and suscripcion.get("status") == SuscripcionStatus.TRIAL else SuscripcionStatus.VENCIDA
             )
-            await db.suscripciones.update_one(
+            await _set_suscripcion(
                 {"empresa_id": empresa_id},
-                {"$set": {"fecha_vencimiento": periodo_inicio, "status": nuevo_status, "fue_pagada": pagos_restantes > 0}}
+                {"fecha_vencimiento": periodo_inicio, "status": nuevo_status, "fue_pagada": pagos_restantes > 0}
             )
     return {"message": "Pago eliminado y suscripción revertida"}
 
@@ -6453,7 +8492,14 @@ async def owner_delete_cliente(empresa_id: str, _=Depends(verify_owner_token)):
         db.users, db.configuration, db.suscripciones, db.pagos_suscripcion,
         db.notificaciones, db.sales, db.sale_returns, db.cash_sessions,
         db.cash_movements, db.compras, db.proveedores, db.afip_config,
+        db.dashboard_counters, db.onboarding_counts, db.count_cache,
+        db.cliente_resumen, db.ventas_diarias, db.reposicion, db.numeradores, db.cierres_z,
     ]
+    # Sale de las métricas del panel igual que salía de los conteos en vivo
+    suscripcion = await db.suscripciones.find_one({"empresa_id": empresa_id})
+    await _inc_metricas_suscripcion(suscripcion, None)
+    async for pago in db.pagos_suscripcion.find({"empresa_id": empresa_id, "estado": "approved"}, {"_id": 0, "monto": 1, "fecha": 1}):
+        await _inc_metricas_pago(pago.get("monto"), pago.get("fecha"), -1)
     for col in collections:
         await col.delete_many({"empresa_id": empresa_id})
     await db.empresas.delete_one({"id": empresa_id})
@@ -6470,9 +8516,9 @@ async def owner_toggle_empresa(empresa_id: str, _=Depends(verify_owner_token)):
         # Guardar el status actual antes de suspender para poder restaurarlo
         sus = await db.suscripciones.find_one({"empresa_id": empresa_id})
         prev_status = sus.get("status") if sus else None
-        await db.suscripciones.update_one(
+        await _set_suscripcion(
             {"empresa_id": empresa_id},
-            {"$set": {"status": SuscripcionStatus.SUSPENDIDA, "status_antes_suspension": prev_status}}
+            {"status": SuscripcionStatus.SUSPENDIDA, "status_antes_suspension": prev_status}
         )
     else:
         # Al re-activar: restaurar el status anterior si no venció
@@ -6489,10 +8535,7 @@ async def owner_toggle_empresa(empresa_id: str, _=Depends(verify_owner_token)):
                 nuevo_status = status_previo if status_previo in (SuscripcionStatus.TRIAL, SuscripcionStatus.ACTIVA) else SuscripcionStatus.ACTIVA
             else:
                 nuevo_status = SuscripcionStatus.VENCIDA
-            await db.suscripciones.update_one(
-                {"empresa_id": empresa_id},
-                {"$set": {"status": nuevo_status}}
-            )
+            await _set_suscripcion({"empresa_id": empresa_id}, {"status": nuevo_status})
     return {"activo": new_status, "message": f"Empresa {'activada' if new_status else 'suspendida'}"}
 
 @owner_router.put("/clientes/{empresa_id}/datos")
@@ -6676,16 +8719,22 @@ async def owner_get_alertas(_=Depends(verify_owner_token)):
             })
     por_vencer.sort(key=lambda x: x["dias_restantes"])
     alertas_recientes = await db.notificaciones.find().sort("fecha", -1).limit(50).to_list(50)
+    corridas = await db.tareas_corridas.find(
+        {"tarea": "alertas_vencimiento"}, {"_id": 0}
+    ).sort("inicio", -1).limit(10).to_list(10)
     return {
         "por_vencer": por_vencer,
         "alertas_recientes": [Notificacion(**a).dict() for a in alertas_recientes],
+        "corridas": corridas,
     }
 
 @owner_router.post("/alertas/generar")
 async def owner_generar_alertas(_=Depends(verify_owner_token)):
     """Genera manualmente alertas para suscripciones próximas a vencer."""
-    generadas = await generar_alertas_vencimiento()
-    return {"ok": True, "generadas": generadas}
+    corrida = await scheduler.correr_tarea(db, "alertas_vencimiento", generar_alertas_vencimiento, "manual")
+    if corrida is None:
+        raise HTTPException(status_code=409, detail="Ya hay una generación de alertas en curso")
+    return {"ok": True, **corrida["metricas"]}
 
 @owner_router.get("/pagos")
 async def owner_get_pagos(_=Depends(verify_owner_token)):
@@ -6805,6 +8854,83 @@ async def test_afip_conexion(user: User = Depends(require_role([UserRole.ADMIN])
         raise HTTPException(status_code=503, detail=f"Error de conexión con ARCA: {result.get('error')}")
     return result
 
+# --- Circuito AFIP ---
+# Cuando AFIP no responde, cada venta esperaba el timeout del SOAP antes de quedar en
+# contingencia, y los reintentos le seguían pegando. El circuito (afip_circuitos, un doc
+# por empresa y punto de venta, compartido por todos los workers) cuenta los fallos de
+# conexión seguidos; al llegar a AFIP_CIRCUITO_UMBRAL se abre por un enfriamiento que se
+# duplica con cada apertura seguida. Abierto, create_sale deja la venta en contingencia
+# sin llamar a AFIP y el worker de reintentos saltea la empresa. Solo cuenta como fallo
+# AfipNoDisponible (conexión o credenciales); un rechazo (AfipRechazo) lo cierra, porque
+# AFIP respondió, y cualquier otro error (un comprobante mal armado) no dice nada.
+AFIP_CIRCUITO_UMBRAL = 3
+AFIP_CIRCUITO_ENFRIAMIENTO = timedelta(minutes=2)
+AFIP_CIRCUITO_MAX = timedelta(minutes=30)
+
+def _afip_circuito_id(cfg: dict) -> str:
+    return f"{cfg['empresa_id']}:{cfg.get('punto_venta')}"
+
+async def _afip_circuito_abierto(cfg: dict) -> Optional[dict]:
+    """El doc del circuito si está abierto ahora; None si se puede llamar a AFIP."""
+    return await db.afip_circuitos.find_one(
+        {"_id": _afip_circuito_id(cfg), "abierto_hasta": {"$gt": datetime.now(timezone.utc)}}
+    )
+
+async def _afip_circuito_resultado(cfg: dict, error: Optional[Exception] = None) -> None:
+    """Registra cómo salió una llamada a AFIP: sin error (o con rechazo) cierra el circuito."""
+    if error is not None and not isinstance(error, (AfipRechazo, AfipNoDisponible)):
+        return
+    if error is None or isinstance(error, AfipRechazo):
+        await db.afip_circuitos.update_one(
+            {"_id": _afip_circuito_id(cfg), "fallos": {"$gt": 0}},
+            {"$set": {"fallos": 0, "abierto_hasta": None}},
+        )
+        return
+    now = datetime.now(timezone.utc)
+    doc = await db.afip_circuitos.find_one_and_update(
+        {"_id": _afip_circuito_id(cfg)},
+        {
+            "$inc": {"fallos": 1},
+            "$set": {"empresa_id": cfg["empresa_id"], "ultimo_error": str(error), "ultimo_fallo": now},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc["fallos"] >= AFIP_CIRCUITO_UMBRAL:
+        espera = min(AFIP_CIRCUITO_ENFRIAMIENTO * 2 ** (doc["fallos"] - AFIP_CIRCUITO_UMBRAL), AFIP_CIRCUITO_MAX)
+        await db.afip_circuitos.update_one({"_id": doc["_id"]}, {"$set": {"abierto_hasta": now + espera}})
+        logger.warning(f"Circuito AFIP abierto para {doc['_id']} por {espera}: {error}")
+
+async def _autorizar_venta(sale_doc: dict, cfg: dict, estado_error: str = "contingencia") -> dict:
+    """Pide el CAE de una venta ya emitida y guarda el resultado. Si falla la deja en
+    estado_error y relanza la excepción."""
+    try:
+        token, sign = await _afip_service.get_token_sign(cfg, db, SECRET_KEY)
+        tipo_cbte = sale_doc.get("tipo_comprobante") or cfg.get("tipo_comprobante_default", 6)
+        result = await _afip_service.solicitar_cae(
+            sale_doc, cfg, token, sign, tipo_cbte,
+            cuit_receptor=sale_doc.get("cuit_receptor")
+        )
+    except Exception as e:
+        await _afip_circuito_resultado(cfg, e)
+        await db.sales.update_one(
+            {"id": sale_doc["id"]},
+            {"$set": {"afip_estado": estado_error, "afip_error": str(e)}}
+        )
+        raise
+    await _afip_circuito_resultado(cfg)
+    await db.sales.update_one(
+        {"id": sale_doc["id"]},
+        {"$set": {
+            "cae": result["cae"],
+            "cae_vencimiento": result["cae_vencimiento"],
+            "afip_estado": "autorizado",
+            "afip_error": None,
+            "nro_comprobante_afip": result["nro_comprobante"],
+        }}
+    )
+    return result
+
 @afip_router.post("/reintentar/{sale_id}")
 async def reintentar_cae(sale_id: str, user: User = Depends(require_role([UserRole.ADMIN]))):
     """Reintenta obtener el CAE para una venta en estado contingencia o error."""
@@ -6819,38 +8945,392 @@ async def reintentar_cae(sale_id: str, user: User = Depends(require_role([UserRo
         raise HTTPException(status_code=400, detail="AFIP no está configurado o falta el certificado.")
 
     try:
-        token, sign = await _afip_service.get_token_sign(cfg, db, SECRET_KEY)
-        tipo_cbte = sale_doc.get("tipo_comprobante") or cfg.get("tipo_comprobante_default", 6)
+        result = await _autorizar_venta(sale_doc, cfg, estado_error="error")
+        return {"ok": True, "cae": result["cae"], "cae_vencimiento": result["cae_vencimiento"]}
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Error al obtener CAE: {e}")
+
+@afip_router.get("/ventas-pendientes")
+async def get_ventas_pendientes(
+    page: int = Query(1, ge=1),
+    per_page: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+    user: User = Depends(require_role([UserRole.ADMIN]))
+):
+    """Lista ventas con CAE pendiente (contingencia o error), las más viejas primero.
+    Sin per_page devuelve la lista de siempre (hasta 200); con per_page, paginada."""
+    query = {"empresa_id": user.empresa_id, "afip_estado": {"$in": AFIP_ESTADOS_PENDIENTES["sales"]}}
+    if per_page is None:
+        ventas = await db.sales.find(query).to_list(200)
+        return [Sale(**v) for v in ventas]
+    sort = [("fecha", 1), ("id", 1)]
+    items, total = await _paginar_find("sales", query, sort, page, per_page, cursor, CountStrategy.EXACT)
+    return {
+        "items": [Sale(**v) for v in items],
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "next_cursor": _next_cursor(items, sort, per_page),
+    }
+
+# Factura A(1)→NC-A(3)  Factura B(6)→NC-B(8)  Factura C(11)→NC-C(13)
+NC_TIPO_MAP = {1: 3, 6: 8, 11: 13}
+
+# Tareas sueltas (create_task) que no deben perderse por GC antes de terminar
+_tareas_fondo: set = set()
+
+def _en_segundo_plano(coro) -> None:
+    tarea = asyncio.create_task(coro)
+    _tareas_fondo.add(tarea)
+    tarea.add_done_callback(_tareas_fondo.discard)
+
+def _comprobante_nc(nc_doc: dict, sale_doc: dict, cfg: dict, cuit_receptor: Optional[str] = None) -> dict:
+    """Lo que se manda a AFIP por una NC: importes, receptor y la factura asociada."""
+    nc_tipo = NC_TIPO_MAP.get(sale_doc.get("tipo_comprobante"))
+    total_return = nc_doc["total"]
+    tax_rate = cfg.get("tax_rate", 0.21) if nc_tipo != 13 else 0.0
+    if tax_rate > 0:
+        nc_subtotal = round(total_return / (1 + tax_rate), 2)
+        nc_impuestos = round(total_return - nc_subtotal, 2)
+    else:
+        nc_subtotal = round(total_return, 2)
+        nc_impuestos = 0.0
+    return {
+        "sale": {
+            "total": round(total_return, 2),
+            "subtotal": nc_subtotal,
+            "impuestos": nc_impuestos,
+            "impuestos_extra_total": 0.0,
+        },
+        "cuit_receptor": cuit_receptor or sale_doc.get("cuit_receptor"),
+        "cbtes_asoc": [{
+            "Tipo": sale_doc["tipo_comprobante"],
+            "PtoVta": cfg["punto_venta"],
+            "Nro": sale_doc["nro_comprobante_afip"],
+        }],
+    }
+
+async def _autorizar_nota_credito(nc_doc: dict, sale_doc: dict, cfg: dict, cuit_receptor: Optional[str] = None) -> dict:
+    """Pide el CAE de la NC y guarda el resultado. Si falla la deja en contingencia y
+    relanza la excepción."""
+    nc_tipo = NC_TIPO_MAP.get(sale_doc.get("tipo_comprobante"))
+    try:
+        token_a, sign_a = await _afip_service.get_token_sign(cfg, db, SECRET_KEY)
+        cbte = _comprobante_nc(nc_doc, sale_doc, cfg, cuit_receptor)
         result = await _afip_service.solicitar_cae(
-            sale_doc, cfg, token, sign, tipo_cbte,
-            cuit_receptor=sale_doc.get("cuit_receptor")
+            cbte["sale"], cfg, token_a, sign_a, nc_tipo,
+            cuit_receptor=cbte["cuit_receptor"],
+            cbtes_asoc=cbte["cbtes_asoc"],
         )
-        await db.sales.update_one(
-            {"id": sale_id},
+    except Exception as e:
+        await _afip_circuito_resultado(cfg, e)
+        await db.credit_notes.update_one(
+            {"id": nc_doc["id"]},
             {"$set": {
-                "cae": result["cae"],
-                "cae_vencimiento": result["cae_vencimiento"],
-                "afip_estado": "autorizado",
-                "afip_error": None,
-                "nro_comprobante_afip": result["nro_comprobante"],
+                "afip_estado": "contingencia",
+                "afip_error": str(e),
+                "tipo_comprobante_nc": nc_tipo,
             }}
         )
-        return {"ok": True, "cae": result["cae"], "cae_vencimiento": result["cae_vencimiento"]}
+        raise
+    await _afip_circuito_resultado(cfg)
+    await db.credit_notes.update_one(
+        {"id": nc_doc["id"]},
+        {"$set": {
+            "cae": result["cae"],
+            "cae_vencimiento": result["cae_vencimiento"],
+            "afip_estado": "autorizado",
+            "tipo_comprobante_nc": nc_tipo,
+            "nro_comprobante_afip": result["nro_comprobante"],
+            "afip_error": None,
+        }}
+    )
+    return result
+
+async def _autorizar_nota_credito_fondo(empresa_id: str, credit_note_id: str) -> None:
+    """Camino en segundo plano de create_sale_return: la devolución ya respondió y la NC
+    quedó "pendiente". Sin AFIP configurado vuelve a no_aplica, como antes; si AFIP falla
+    queda en contingencia para reintentar-nc."""
+    try:
+        nc_doc = await db.credit_notes.find_one({"id": credit_note_id, "empresa_id": empresa_id})
+        sale_doc = await db.sales.find_one({"id": nc_doc["sale_id"], "empresa_id": empresa_id}) if nc_doc else None
+        cfg = await db.afip_config.find_one({"empresa_id": empresa_id, "activo": True})
+        if not nc_doc or not sale_doc:
+            return
+        if not cfg or not cfg.get("cert_pem") or not cfg.get("key_pem_encrypted"):
+            await db.credit_notes.update_one(
+                {"id": credit_note_id},
+                {"$set": {"afip_estado": "no_aplica", "tipo_comprobante_nc": None}},
+            )
+            return
+        await _autorizar_nota_credito(nc_doc, sale_doc, cfg)
     except Exception as e:
-        await db.sales.update_one(
-            {"id": sale_id},
-            {"$set": {"afip_estado": "error", "afip_error": str(e)}}
+        logger.warning(f"Error al obtener CAE para nota de crédito {credit_note_id}: {e}")
+
+# --- Reintentos AFIP en contingencia ---
+# Las ventas y NC que quedaron sin CAE las reintenta la tarea programada
+# contingencias_afip, sin que nadie tenga que apretar "reintentar" uno por uno:
+# - por empresa, un token y un FECAESolicitar por lote de hasta AFIP_LOTE comprobantes
+#   del mismo tipo y punto de venta, en vez de un pedido por comprobante;
+# - el comprobante que AFIP rechaza espera con backoff exponencial (afip_intentos,
+#   afip_proximo_intento); agotados los AFIP_MAX_INTENTOS queda en "error" para
+#   revisarlo a mano. "contingencia" es entonces "se sigue reintentando solo";
+# - si AFIP no responde se registra en el circuito de la empresa y se corta: con el
+#   circuito abierto la empresa se saltea hasta que pase el enfriamiento.
+# Entran las ventas en contingencia o error y las NC en contingencia, error o
+# "pendiente" vieja (el proceso de fondo de create_sale_return se perdió).
+AFIP_LOTE = 50
+AFIP_POR_CORRIDA = 500
+AFIP_MAX_INTENTOS = 8
+AFIP_BACKOFF_BASE = timedelta(minutes=5)
+AFIP_BACKOFF_MAX = timedelta(hours=6)
+AFIP_NC_PENDIENTE_VENCIDA = timedelta(minutes=10)
+AFIP_EMPRESAS_EN_PARALELO = 4
+AFIP_ESTADOS_PENDIENTES = {"sales": ["contingencia", "error"], "credit_notes": ["contingencia", "error", "pendiente"]}
+
+def _afip_pendientes_query(coll: str, now: datetime) -> dict:
+    """Comprobantes que ya esperaron su backoff y todavía tienen intentos."""
+    condiciones = [
+        {"afip_estado": {"$in": AFIP_ESTADOS_PENDIENTES[coll]}},
+        {"$or": [{"afip_proximo_intento": None}, {"afip_proximo_intento": {"$lte": now}}]},
+        {"afip_intentos": {"$not": {"$gte": AFIP_MAX_INTENTOS}}},
+    ]
+    if coll == "credit_notes":
+        condiciones.append({"$or": [
+            {"afip_estado": {"$ne": "pendiente"}},
+            {"fecha": {"$lt": now - AFIP_NC_PENDIENTE_VENCIDA}},
+        ]})
+    return {"$and": condiciones}
+
+def _afip_campos_rechazo(doc: dict, error: Exception, now: datetime) -> dict:
+    """Backoff de un comprobante rechazado o que no se pudo armar."""
+    intentos = (doc.get("afip_intentos") or 0) + 1
+    espera = min(AFIP_BACKOFF_BASE * 2 ** (intentos - 1), AFIP_BACKOFF_MAX)
+    return {
+        "afip_estado": "error" if intentos >= AFIP_MAX_INTENTOS else "contingencia",
+        "afip_error": str(error),
+        "afip_intentos": intentos,
+        "afip_proximo_intento": now + espera,
+    }
+
+async def _afip_lote(coll: str, cfg: dict, token: str, sign: str, tipo: int, docs: list, cbtes: list) -> dict:
+    """Pide el CAE de un lote y guarda el resultado de cada comprobante en un bulk_write."""
+    resultados = await _afip_service.solicitar_cae_lote(cbtes, cfg, token, sign, tipo)
+    now = datetime.now(timezone.utc)
+    ops, autorizadas, rechazadas = [], 0, 0
+    for doc, r in zip(docs, resultados):
+        if isinstance(r, Exception):
+            campos = _afip_campos_rechazo(doc, r, now)
+            rechazadas += 1
+        else:
+            campos = {
+                "cae": r["cae"],
+                "cae_vencimiento": r["cae_vencimiento"],
+                "afip_estado": "autorizado",
+                "afip_error": None,
+                "nro_comprobante_afip": r["nro_comprobante"],
+                "afip_intentos": 0,
+                "afip_proximo_intento": None,
+            }
+            autorizadas += 1
+        if coll == "credit_notes":
+            campos["tipo_comprobante_nc"] = tipo
+        ops.append(UpdateOne({"id": doc["id"]}, {"$set": campos}))
+    if ops:
+        await db[coll].bulk_write(ops, ordered=False)
+    return {"autorizadas": autorizadas, "rechazadas": rechazadas}
+
+async def _reintentar_afip_empresa(cfg: dict, now: datetime) -> dict:
+    """Reintenta lo pendiente de una empresa: primero las ventas, después las NC (que
+    necesitan la factura original ya autorizada)."""
+    metricas = {"lotes": 0, "autorizadas": 0, "rechazadas": 0, "circuito_abierto": False}
+    if await _afip_circuito_abierto(cfg):
+        metricas["circuito_abierto"] = True
+        return metricas
+    empresa_id = cfg["empresa_id"]
+    ventas, ncs = await asyncio.gather(
+        db.sales.find(
+            {"empresa_id": empresa_id, **_afip_pendientes_query("sales", now)},
+            {"_id": 0, "id": 1, "total": 1, "impuestos_extra_total": 1, "tipo_comprobante": 1,
+             "cuit_receptor": 1, "afip_intentos": 1},
+        ).sort("fecha", 1).limit(AFIP_POR_CORRIDA).to_list(AFIP_POR_CORRIDA),
+        db.credit_notes.find(
+            {"empresa_id": empresa_id, **_afip_pendientes_query("credit_notes", now)},
+            {"_id": 0, "id": 1, "sale_id": 1, "total": 1, "afip_intentos": 1},
+        ).sort("fecha", 1).limit(AFIP_POR_CORRIDA).to_list(AFIP_POR_CORRIDA),
+    )
+    if not ventas and not ncs:
+        return metricas
+
+    def por_tipo(pares) -> list:
+        grupos: dict = {}
+        for tipo, doc, cbte in pares:
+            grupos.setdefault(tipo, []).append((doc, cbte))
+        return [
+            (tipo, items[i:i + AFIP_LOTE])
+            for tipo, items in grupos.items()
+            for i in range(0, len(items), AFIP_LOTE)
+        ]
+
+    async def correr(coll: str, lotes: list) -> None:
+        for tipo, items in lotes:
+            r = await _afip_lote(coll, cfg, token, sign, tipo, [d for d, _ in items], [c for _, c in items])
+            metricas["lotes"] += 1
+            metricas["autorizadas"] += r["autorizadas"]
+            metricas["rechazadas"] += r["rechazadas"]
+
+    try:
+        token, sign = await _afip_service.get_token_sign(cfg, db, SECRET_KEY)
+        default = cfg.get("tipo_comprobante_default", 6)
+        await correr("sales", por_tipo(
+            (v.get("tipo_comprobante") or default, v, {"sale": v, "cuit_receptor": v.get("cuit_receptor")})
+            for v in ventas
+        ))
+        if ncs:
+            originales = await BatchLoader(empresa_id).load_many(
+                "sales", [nc["sale_id"] for nc in ncs],
+                projection={"_id": 0, "id": 1, "tipo_comprobante": 1, "nro_comprobante_afip": 1,
+                            "cuit_receptor": 1, "afip_estado": 1},
+            )
+            pares, mal_armadas = [], []
+            for nc in ncs:
+                original = originales.get(nc["sale_id"])
+                # La NC espera a que la factura original tenga CAE
+                if not original or original.get("afip_estado") != "autorizado":
+                    continue
+                if not NC_TIPO_MAP.get(original.get("tipo_comprobante")):
+                    continue
+                try:
+                    pares.append((NC_TIPO_MAP[original["tipo_comprobante"]], nc, _comprobante_nc(nc, original, cfg)))
+                except (KeyError, TypeError, ValueError) as e:
+                    mal_armadas.append(UpdateOne(
+                        {"id": nc["id"]},
+                        {"$set": _afip_campos_rechazo(nc, AfipRechazo(f"No se pudo armar la NC: {e!r}"), now)},
+                    ))
+            if mal_armadas:
+                await db.credit_notes.bulk_write(mal_armadas, ordered=False)
+                metricas["rechazadas"] += len(mal_armadas)
+            await correr("credit_notes", por_tipo(pares))
+    except Exception as e:
+        # AFIP no respondió (o falló algo de este lado): lo que quedó sin pedir espera a
+        # la próxima corrida. Solo AfipNoDisponible cuenta para el circuito.
+        await _afip_circuito_resultado(cfg, e)
+        metricas["error"] = str(e)
+        logger.warning(f"Reintentos AFIP de la empresa {empresa_id}: {e}")
+        return metricas
+    await _afip_circuito_resultado(cfg)
+    return metricas
+
+async def _reintentar_contingencias_afip() -> dict:
+    """Tarea programada: reintenta los comprobantes pendientes de todas las empresas."""
+    now = datetime.now(timezone.utc)
+    ventas_emp, ncs_emp = await asyncio.gather(
+        db.sales.distinct("empresa_id", {"afip_estado": {"$in": AFIP_ESTADOS_PENDIENTES["sales"]}}),
+        db.credit_notes.distinct("empresa_id", {"afip_estado": {"$in": AFIP_ESTADOS_PENDIENTES["credit_notes"]}}),
+    )
+    empresas = set(ventas_emp) | set(ncs_emp)
+    if not empresas:
+        return {"empresas": 0, "lotes": 0, "autorizadas": 0, "rechazadas": 0, "circuitos_abiertos": 0}
+    cfgs = await db.afip_config.find({
+        "empresa_id": {"$in": list(empresas)},
+        "activo": True,
+        "cert_pem": {"$ne": None},
+        "key_pem_encrypted": {"$ne": None},
+    }).to_list(None)
+    semaforo = asyncio.Semaphore(AFIP_EMPRESAS_EN_PARALELO)
+
+    async def una(cfg: dict) -> dict:
+        async with semaforo:
+            return await _reintentar_afip_empresa(cfg, now)
+
+    resultados = await asyncio.gather(*(una(cfg) for cfg in cfgs))
+    return {
+        "empresas": len(cfgs),
+        "lotes": sum(r["lotes"] for r in resultados),
+        "autorizadas": sum(r["autorizadas"] for r in resultados),
+        "rechazadas": sum(r["rechazadas"] for r in resultados),
+        "circuitos_abiertos": sum(1 for r in resultados if r["circuito_abierto"]),
+        "errores": sum(1 for r in resultados if r.get("error")),
+    }
+
+def _afip_backlog_vacio() -> dict:
+    vacio = {"cantidad": 0, "en_error": 0, "mas_antigua": None}
+    return {"ventas": dict(vacio), "notas_credito": dict(vacio)}
+
+async def _afip_backlog(match: dict) -> dict:
+    """Pendientes por empresa: {empresa_id: {"ventas": {...}, "notas_credito": {...}}}, con
+    cantidad, cuántos ya agotaron los reintentos (error) y la fecha del más viejo."""
+    def pipeline(coll: str) -> list:
+        return [
+            {"$match": {**match, "afip_estado": {"$in": AFIP_ESTADOS_PENDIENTES[coll]}}},
+            {"$group": {
+                "_id": "$empresa_id",
+                "cantidad": {"$sum": 1},
+                "en_error": {"$sum": {"$cond": [{"$eq": ["$afip_estado", "error"]}, 1, 0]}},
+                "mas_antigua": {"$min": "$fecha"},
+            }},
+        ]
+    ventas, ncs = await asyncio.gather(
+        db.sales.aggregate(pipeline("sales")).to_list(None),
+        db.credit_notes.aggregate(pipeline("credit_notes")).to_list(None),
+    )
+    backlog: dict = {}
+    for clave, grupos in (("ventas", ventas), ("notas_credito", ncs)):
+        for g in grupos:
+            backlog.setdefault(g.pop("_id"), _afip_backlog_vacio())[clave] = g
+    return backlog
+
+def _afip_backlog_antiguedad(pendientes: dict, now: datetime) -> Optional[int]:
+    fechas = [p["mas_antigua"] for p in pendientes.values() if p.get("mas_antigua")]
+    return int((now - min(fechas)).total_seconds() // 60) if fechas else None
+
+@afip_router.get("/backlog")
+async def get_afip_backlog(user: User = Depends(require_role([UserRole.ADMIN]))):
+    """Comprobantes sin CAE de la empresa, antigüedad del más viejo y estado del circuito."""
+    now = datetime.now(timezone.utc)
+    backlog, cfg = await asyncio.gather(
+        _afip_backlog({"empresa_id": user.empresa_id}),
+        db.afip_config.find_one({"empresa_id": user.empresa_id, "activo": True}, {"punto_venta": 1}),
+    )
+    pendientes = backlog.get(user.empresa_id) or _afip_backlog_vacio()
+    circuito = None
+    if cfg:
+        circuito = await db.afip_circuitos.find_one(
+            {"_id": _afip_circuito_id({"empresa_id": user.empresa_id, **cfg})}, {"_id": 0}
         )
-        raise HTTPException(status_code=503, detail=f"Error al obtener CAE: {e}")
+    return {
+        **pendientes,
+        "antiguedad_minutos": _afip_backlog_antiguedad(pendientes, now),
+        "circuito": {
+            "abierto": bool(circuito and circuito.get("abierto_hasta") and circuito["abierto_hasta"] > now),
+            "fallos": circuito.get("fallos", 0) if circuito else 0,
+            "abierto_hasta": circuito.get("abierto_hasta") if circuito else None,
+            "ultimo_error": circuito.get("ultimo_error") if circuito else None,
+        },
+    }
 
-@afip_router.get("/ventas-pendientes")
-async def get_ventas_pendientes(user: User = Depends(require_role([UserRole.ADMIN]))):
-    """Lista ventas con CAE pendiente (contingencia o error)."""
-    ventas = await db.sales.find({
-        "empresa_id": user.empresa_id,
-        "afip_estado": {"$in": ["contingencia", "error"]}
-    }).to_list(200)
-    return [Sale(**v) for v in ventas]
+@owner_router.get("/afip/backlog")
+async def owner_get_afip_backlog(_=Depends(verify_owner_token)):
+    """Comprobantes sin CAE por empresa, las más atrasadas primero."""
+    now = datetime.now(timezone.utc)
+    backlog, circuitos = await asyncio.gather(
+        _afip_backlog({}),
+        db.afip_circuitos.find({"abierto_hasta": {"$gt": now}}, {"_id": 0, "empresa_id": 1}).to_list(None),
+    )
+    abiertos = {c["empresa_id"] for c in circuitos}
+    empresas = await BatchLoader().load_many("empresas", list(backlog), projection={"_id": 0, "id": 1, "nombre": 1})
+    items = [
+        {
+            "empresa_id": empresa_id,
+            "empresa_nombre": (empresas.get(empresa_id) or {}).get("nombre", empresa_id),
+            **pendientes,
+            "antiguedad_minutos": _afip_backlog_antiguedad(pendientes, now),
+            "circuito_abierto": empresa_id in abiertos,
+        }
+        for empresa_id, pendientes in backlog.items()
+    ]
+    items.sort(key=lambda x: x["antiguedad_minutos"] or 0, reverse=True)
+    return items
 
 @afip_router.post("/reintentar-nc/{credit_note_id}")
 async def reintentar_cae_nc(
@@ -6864,6 +9344,15 @@ async def reintentar_cae_nc(
         raise HTTPException(status_code=404, detail="Nota de crédito no encontrada.")
     if nc_doc.get("afip_estado") == "autorizado":
         return {"ok": True, "mensaje": "La nota de crédito ya tiene CAE.", "cae": nc_doc.get("cae")}
+    # Una NC pendiente reciente todavía la está autorizando la devolución que la creó:
+    # pedirla de nuevo la numeraría dos veces (mismo criterio que el worker de reintentos)
+    fecha_nc = nc_doc.get("fecha")
+    if (
+        nc_doc.get("afip_estado") == "pendiente"
+        and isinstance(fecha_nc, datetime)
+        and fecha_nc >= datetime.now(timezone.utc) - AFIP_NC_PENDIENTE_VENCIDA
+    ):
+        raise HTTPException(status_code=409, detail="La nota de crédito se está autorizando. Reintente en unos minutos.")
 
     # Recuperar la venta original para obtener tipo_comprobante y nro_comprobante_afip
     sale_doc = await db.sales.find_one({"id": nc_doc["sale_id"], "empresa_id": user.empresa_id})
@@ -6872,9 +9361,7 @@ async def reintentar_cae_nc(
     if sale_doc.get("afip_estado") != "autorizado":
         raise HTTPException(status_code=400, detail="La venta original no tiene CAE autorizado.")
 
-    NC_TIPO_MAP = {1: 3, 6: 8, 11: 13}
-    nc_tipo = NC_TIPO_MAP.get(sale_doc.get("tipo_comprobante"))
-    if not nc_tipo:
+    if not NC_TIPO_MAP.get(sale_doc.get("tipo_comprobante")):
         raise HTTPException(status_code=400, detail="La venta original no es una factura electrónica.")
 
     cfg = await db.afip_config.find_one({"empresa_id": user.empresa_id, "activo": True})
@@ -6882,55 +9369,93 @@ async def reintentar_cae_nc(
         raise HTTPException(status_code=400, detail="AFIP no está configurado o falta el certificado.")
 
     try:
-        token_a, sign_a = await _afip_service.get_token_sign(cfg, db, SECRET_KEY)
-        total_return = nc_doc["total"]
-        tax_rate = cfg.get("tax_rate", 0.21) if nc_tipo != 13 else 0.0
-        if tax_rate > 0:
-            nc_subtotal = round(total_return / (1 + tax_rate), 2)
-            nc_impuestos = round(total_return - nc_subtotal, 2)
-        else:
-            nc_subtotal = round(total_return, 2)
-            nc_impuestos = 0.0
-        nc_sale_dict = {
-            "total": round(total_return, 2),
-            "subtotal": nc_subtotal,
-            "impuestos": nc_impuestos,
-            "impuestos_extra_total": 0.0,
-        }
-        cbtes_asoc = [{
-            "Tipo": sale_doc["tipo_comprobante"],
-            "PtoVta": cfg["punto_venta"],
-            "Nro": sale_doc["nro_comprobante_afip"],
-        }]
-        effective_cuit = body.cuit_receptor or sale_doc.get("cuit_receptor")
-        result = await _afip_service.solicitar_cae(
-            nc_sale_dict, cfg, token_a, sign_a, nc_tipo,
-            cuit_receptor=effective_cuit,
-            cbtes_asoc=cbtes_asoc,
-        )
-        await db.credit_notes.update_one(
-            {"id": credit_note_id},
-            {"$set": {
-                "cae": result["cae"],
-                "cae_vencimiento": result["cae_vencimiento"],
-                "afip_estado": "autorizado",
-                "tipo_comprobante_nc": nc_tipo,
-                "nro_comprobante_afip": result["nro_comprobante"],
-                "afip_error": None,
-            }}
-        )
+        result = await _autorizar_nota_credito(nc_doc, sale_doc, cfg, cuit_receptor=body.cuit_receptor)
         return {"ok": True, "cae": result["cae"], "cae_vencimiento": result["cae_vencimiento"]}
     except Exception as e:
-        await db.credit_notes.update_one(
-            {"id": credit_note_id},
-            {"$set": {
-                "afip_estado": "contingencia",
-                "afip_error": str(e),
-                "tipo_comprobante_nc": nc_tipo,
-            }}
-        )
         raise HTTPException(status_code=503, detail=f"Error al obtener CAE para NC: {e}")
 
+# --- Tareas programadas ---
+# Las tareas periódicas se registran en el scheduler (scheduler.py) en vez de tener cada
+# una su loop en startup_tasks: corren una vez por ocurrencia entre todos los workers,
+# en horario fijo (hora argentina), con reintentos y con su historial en tareas_corridas.
+# Cada función devuelve las métricas que quedan en la corrida.
+async def _tarea_reposicion() -> dict:
+    empresas = await _acumular_ventas_diarias()
+    hoy = _dia_local(datetime.now(timezone.utc))
+    # La primera corrida de cada día pondera para todas las empresas, haya o no ventas
+    # nuevas; si el doc ya tiene el día de hoy, el upsert choca con el _id
+    try:
+        await db.reposicion_estado.update_one(
+            {"_id": "ponderacion", "dia": {"$ne": hoy}}, {"$set": {"dia": hoy}}, upsert=True
+        )
+        empresas |= set(await db.reposicion.distinct("empresa_id"))
+    except DuplicateKeyError:
+        pass
+    for empresa_id in empresas:
+        await _recalcular_reposicion(empresa_id)
+    return {"empresas": len(empresas)}
+
+async def _tarea_cierres_z() -> dict:
+    # Pasada la medianoche cierra el día anterior de cada sucursal con movimiento
+    # reciente; las que ya tienen su Z al día no hacen nada
+    hoy = _inicio_dia_local(datetime.now(timezone.utc))
+    if datetime.now(timezone.utc) - hoy < _VENTAS_DIARIAS_DEMORA:
+        return {"sucursales": 0}
+    desde = (hoy - timedelta(days=Z_HISTORIA_DIAS)).strftime("%Y-%m-%d")
+    sucursales = 0
+    async for g in db.dashboard_counters.aggregate([
+        # "global" son las ventas sin sucursal, que no llevan Z (ver # --- Cierre Z ---)
+        {"$match": {"dia": {"$gte": desde}, "branch_id": {"$ne": "global"}}},
+        {"$group": {"_id": {"empresa_id": "$empresa_id", "branch_id": "$branch_id"}}},
+    ]):
+        await _cerrar_z_seguro(g["_id"]["empresa_id"], g["_id"]["branch_id"], hoy, "programado")
+        sucursales += 1
+    return {"sucursales": sucursales}
+
+async def _tarea_rollups() -> dict:
+    """Recalcula y reemplaza los acumulados que se mantienen por incremento, por si alguno
+    quedó corrido: los contadores del dashboard de ayer (el día en curso sigue con sus
+    $inc) y las métricas del panel owner."""
+    ayer = _dia_local(datetime.now(timezone.utc) - timedelta(days=1))
+    recalculados = await _recalcular_dashboard_counters(ayer)
+    metricas = await _reconstruir_metricas_owner()
+    return {"contadores_recalculados": recalculados, "mrr": metricas["mrr"]}
+
+_scheduler = scheduler.Scheduler(db, AR_TZ)
+_scheduler.registrar("alertas_vencimiento", generar_alertas_vencimiento, cron="0 9 * * *")
+_scheduler.registrar("reposicion", _tarea_reposicion, cada=timedelta(minutes=REORDER_REFRESH_MINUTES))
+_scheduler.registrar("cierres_z", _tarea_cierres_z, cron="10 * * * *")
+# Ya corre seguido y cada comprobante tiene su propio backoff: si falla, espera a la próxima
+_scheduler.registrar("contingencias_afip", _reintentar_contingencias_afip, cron="*/5 * * * *", reintentos=0)
+_scheduler.registrar("rollups", _tarea_rollups, cron="30 4 * * *")
+
+@owner_router.get("/jobs")
+async def owner_get_jobs(_=Depends(verify_owner_token)):
+    """Estado de las tareas programadas y qué proceso es el líder del scheduler."""
+    now = datetime.now(timezone.utc)
+    agendas = _scheduler.tareas()
+    docs, lider = await asyncio.gather(
+        db.jobs.find({"_id": {"$in": list(agendas)}}).sort("_id", 1).to_list(None),
+        db.leases.find_one({"_id": "scheduler"}),
+    )
+    jobs = []
+    for d in docs:
+        nombre = d.pop("_id")
+        jobs.append({"nombre": nombre, **d, "agenda": agendas[nombre]})
+    return {"lider": lider["duenio"] if lider and lider["hasta"] > now else None, "jobs": jobs}
+
+@owner_router.get("/jobs/{nombre}/corridas")
+async def owner_get_job_corridas(nombre: str, limit: int = Query(50, ge=1, le=500), _=Depends(verify_owner_token)):
+    """Últimas corridas de una tarea, programadas y manuales."""
+    return await db.tareas_corridas.find({"tarea": nombre}, {"_id": 0}).sort("inicio", -1).limit(limit).to_list(limit)
+
+@owner_router.post("/jobs/{nombre}/ejecutar")
+async def owner_ejecutar_job(nombre: str, _=Depends(verify_owner_token)):
+    """Adelanta la próxima corrida de la tarea: la toma el líder en su siguiente vuelta."""
+    if not await _scheduler.disparar(nombre):
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    return {"ok": True}
+
 # Include the router in the main app
 app.include_router(api_router)
 app.include_router(owner_router)
@@ -6958,15 +9483,63 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_tasks():
-    async def periodic_alerts():
-        while True:
-            try:
-                await generar_alertas_vencimiento()
-            except Exception as e:
-                logger.error(f"Error generando alertas: {e}")
-            await asyncio.sleep(24 * 60 * 60)  # cada 24 horas
-    asyncio.create_task(periodic_alerts())
+    # Antes de atender requests (ver _sembrar_dashboard_counters)
+    try:
+        await _sembrar_dashboard_counters()
+    except Exception as e:
+        logger.error(f"Error sembrando contadores del dashboard: {e}")
+
+    _scheduler.iniciar()
+
+    async def seed_metricas_owner():
+        try:
+            if not await db.owner_metricas.find_one({"_id": "global"}):
+                await _reconstruir_metricas_owner()
+        except Exception as e:
+            logger.error(f"Error armando métricas del panel owner: {e}")
+    asyncio.create_task(seed_metricas_owner())
+
+    async def backfill_bajo_stock():
+        try:
+            actualizados = await migrar_bajo_stock()
+            if actualizados:
+                logger.info(f"bajo_stock calculado para {actualizados} branch_products")
+        except Exception as e:
+            logger.error(f"Error calculando bajo_stock: {e}")
+    asyncio.create_task(backfill_bajo_stock())
+
+    async def backfill_documentos_clientes():
+        try:
+            actualizados = await migrar_documentos_clientes()
+            if actualizados:
+                logger.info(f"Documento normalizado para {actualizados} clientes")
+        except Exception as e:
+            logger.error(f"Error normalizando documentos de clientes: {e}")
+    asyncio.create_task(backfill_documentos_clientes())
+
+    async def reconciliar_indices() -> dict:
+        drift = await indexes.reconciliar(db, migrar_unicos=True)
+        for item in drift["errores"]:
+            logger.error(f"No se pudo crear el índice {item['coleccion']}.{item['nombre']}: {item['error']}")
+        for item in drift["distintos"]:
+            logger.warning(f"Índice {item['coleccion']}.{item['actual']['nombre']} con otras opciones que las declaradas (python indexes.py --aplicar --corregir)")
+        if drift["sobrantes"]:
+            nombres = ", ".join(f"{i['coleccion']}.{i['nombre']}" for i in drift["sobrantes"])
+            logger.warning(f"Índices no declarados en indexes.py: {nombres}")
+        return {k: len(v) for k, v in drift.items()}
+
+    async def asegurar_indices():
+        # Un solo worker reconcilia, bajo el lease "indices": correr_tarea lo renueva
+        # mientras dura, así construir un índice grande no deja que otro empiece a la par
+        try:
+            await scheduler.correr_tarea(db, "indices", reconciliar_indices, "arranque")
+        except Exception as e:
+            logger.error(f"Error revisando índices: {e}")
+    asyncio.create_task(asegurar_indices())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await _realtime_hub.close()
+    await _scheduler.detener()
+    file_pool.close()
     client.close()
@@ -0,0 +1,158 @@
+"""
+Lectura incremental de planillas (CSV / XLSX) para las importaciones.
+
+El archivo subido se copia por bloques a un temporal en disco y después se recorre
+fila por fila: los XLSX se vuelcan a CSV con openpyxl en modo read_only (iter_rows)
+y el CSV se lee con pandas en chunks. Nunca están en memoria el archivo entero, el
+DOM de openpyxl ni un DataFrame con todas las filas, así que el pico de memoria no
+depende del tamaño del archivo (el contenedor tiene 512 MB).
+
+xlsx_a_csv y escribir_xlsx son el trabajo de CPU pesado (openpyxl es Python puro):
+están pensadas para correr en un proceso aparte (workers.FilePool), por eso reciben
+y devuelven solo rutas y datos planos. También sirven los exports: escribir_xlsx
+lee las filas de un temporal, así que tampoco junta el dataset en memoria.
+"""
+
+import csv
+import os
+import pickle
+import tempfile
+from typing import Iterator, List, Tuple
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+
+# Límite del archivo subido y tamaño de los bloques de copia / lectura
+MAX_BYTES = 50 * 1024 * 1024
+_BLOQUE_COPIA = 1024 * 1024
+_CSV_CHUNK = 2000
+_COL_LINEA = "__linea"
+
+
+class PlanillaError(ValueError):
+    """El archivo no se puede leer como planilla (formato o contenido)."""
+
+
+class ArchivoMuyGrande(PlanillaError):
+    """El archivo supera MAX_BYTES."""
+
+
+async def guardar_temporal(upload, max_bytes: int = MAX_BYTES) -> str:
+    """Copia el UploadFile a un temporal en disco por bloques y devuelve su ruta.
+
+    El que llama es responsable de borrarlo (Planilla.cerrar lo hace)."""
+    nombre = (upload.filename or "").lower()
+    # openpyxl decide por extensión; un ".xls" que en realidad es XLSX se abre igual
+    sufijo = ".csv" if nombre.endswith(".csv") else ".xlsx"
+    fd, path = tempfile.mkstemp(prefix="import_", suffix=sufijo)
+    total = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                bloque = await upload.read(_BLOQUE_COPIA)
+                if not bloque:
+                    break
+                total += len(bloque)
+                if total > max_bytes:
+                    raise ArchivoMuyGrande(f"El archivo supera el máximo de {max_bytes // (1024 * 1024)} MB")
+                out.write(bloque)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+def _columna(valor) -> str:
+    return str(valor).strip().lower() if valor is not None else ""
+
+
+class Planilla:
+    """Planilla abierta sobre un CSV temporal (el subido o el que dejó xlsx_a_csv):
+    columnas normalizadas (strip + lower), cantidad de filas y un generador de (número
+    de fila en la hoja, dict de valores).
+
+    Las celdas vacías llegan como None."""
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            self._leidas = [_columna(c) for c in pd.read_csv(path, nrows=0, encoding="utf-8-sig").columns]
+        except Exception as e:
+            raise PlanillaError(f"No se pudo leer el CSV: {e}")
+        # Un CSV que viene de xlsx_a_csv trae el número de fila de la hoja original
+        self._con_linea = bool(self._leidas) and self._leidas[0] == _COL_LINEA
+        self.columnas = self._leidas[1:] if self._con_linea else self._leidas
+        with open(path, "rb") as f:
+            self.total = max(0, sum(1 for linea in f if linea.strip()) - 1)
+
+    def filas(self) -> Iterator[Tuple[int, dict]]:
+        lector = pd.read_csv(self.path, chunksize=_CSV_CHUNK, encoding="utf-8-sig")
+        for chunk in lector:
+            chunk.columns = self._leidas
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for idx, valores in zip(chunk.index, chunk.itertuples(index=False, name=None)):
+                if self._con_linea:
+                    linea, valores = int(valores[0]), valores[1:]
+                else:
+                    linea = idx + 2
+                yield linea, {c: v for c, v in zip(self.columnas, valores) if c}
+
+    def cerrar(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def abrir_planilla(path: str) -> Planilla:
+    """Abre un CSV (el subido o el que dejó xlsx_a_csv).
+
+    Si no se puede leer, borra el temporal y levanta PlanillaError."""
+    try:
+        return Planilla(path)
+    except PlanillaError:
+        os.unlink(path)
+        raise
+
+
+# --- Trabajos para workers.FilePool ---
+
+def xlsx_a_csv(path: str, destino: str) -> int:
+    """Vuelca la hoja activa del XLSX a un CSV en `destino`, con el número de fila
+    original como primera columna. Devuelve la cantidad de filas con datos."""
+    try:
+        wb = load_workbook(path, read_only=True, data_only=True)
+    except Exception as e:
+        raise PlanillaError(f"No se pudo abrir el XLSX: {e}")
+    filas = 0
+    try:
+        with open(destino, "w", newline="", encoding="utf-8") as out:
+            writer = csv.writer(out)
+            for linea, valores in enumerate(wb.active.iter_rows(values_only=True), start=1):
+                if linea == 1:
+                    writer.writerow([_COL_LINEA] + ["" if v is None else v for v in valores])
+                    continue
+                if all(v is None or (isinstance(v, str) and not v.strip()) for v in valores):
+                    continue
+                writer.writerow([linea] + ["" if v is None else v for v in valores])
+                filas += 1
+    finally:
+        wb.close()
+    return filas
+
+
+def escribir_xlsx(columnas: List[str], lotes_path: str, sheet_name: str, destino: str) -> None:
+    """Genera un XLSX (write_only, sin DOM en memoria) en `destino` con `columnas` y las
+    filas de `lotes_path`: listas de filas volcadas con pickle una tras otra."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(columnas)
+    with open(lotes_path, "rb") as f:
+        while True:
+            try:
+                filas = pickle.load(f)
+            except EOFError:
+                break
+            for fila in filas:
+                ws.append(fila)
+    wb.save(destino)
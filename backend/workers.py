@@ -0,0 +1,119 @@
+"""
+Procesos aparte para el trabajo de CPU con archivos (leer y generar XLSX).
+
+openpyxl es Python puro: parsear o armar una planilla de 30k filas en el hilo del
+event loop frena todos los demás requests del worker mientras dura. FilePool corre
+cada trabajo en un proceso propio:
+
+- cantidad de procesos simultáneos acotada (los trabajos extra esperan turno),
+- límite de memoria por trabajo (RLIMIT_AS del proceso hijo),
+- tiempo máximo por trabajo,
+- cancelación real: si el request se cancela (el cliente cortó) se mata el proceso.
+
+Los trabajos tienen que ser funciones de módulos livianos (spreadsheets.py), porque
+el hijo arranca con "spawn" y las importa de nuevo; server.py no sirve para eso.
+"""
+
+import asyncio
+import multiprocessing
+import os
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows: sin límite de memoria
+    resource = None
+
+
+class TrabajoError(RuntimeError):
+    """El trabajo terminó con error (excepción, memoria o tiempo agotados)."""
+
+
+class LimiteExcedido(TrabajoError):
+    """El trabajo superó su límite de memoria o de tiempo."""
+
+
+def _memoria_virtual() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _correr(conn, memoria_mb: int, fn, args) -> None:
+    # El límite se cuenta desde lo que el hijo ya tiene mapeado tras importar el módulo
+    # del trabajo (pandas/openpyxl), así memoria_mb es el presupuesto propio del trabajo.
+    if resource is not None and memoria_mb:
+        limite = _memoria_virtual() + memoria_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    try:
+        conn.send(("ok", fn(*args)))
+    except MemoryError:
+        conn.send(("memoria", None))
+    except BaseException as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def _esperar(conn):
+    try:
+        return conn.recv()
+    except (EOFError, OSError):
+        # El hijo murió sin responder (kill por OOM, terminate, crash)
+        return ("murio", None)
+
+
+class FilePool:
+    def __init__(self, max_workers: int = 2, memoria_mb: int = 256, timeout: float = 300):
+        self.max_workers = max_workers
+        self.memoria_mb = memoria_mb
+        self.timeout = timeout
+        self._ctx = multiprocessing.get_context("spawn")
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._procesos = set()
+
+    def activos(self) -> int:
+        return len(self._procesos)
+
+    async def run(self, fn, *args, timeout: Optional[float] = None, memoria_mb: Optional[int] = None):
+        """Corre fn(*args) en un proceso hijo y devuelve su resultado (tiene que ser picklable)."""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_workers)
+        async with self._sem:
+            recv, send = self._ctx.Pipe(duplex=False)
+            proc = self._ctx.Process(
+                target=_correr,
+                args=(send, memoria_mb or self.memoria_mb, fn, args),
+                daemon=True,
+            )
+            proc.start()
+            send.close()
+            self._procesos.add(proc)
+            try:
+                estado, valor = await asyncio.wait_for(
+                    asyncio.to_thread(_esperar, recv), timeout or self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise LimiteExcedido(f"{fn.__name__}: superó el tiempo máximo ({timeout or self.timeout:.0f}s)")
+            finally:
+                # Cancelado, vencido o terminado: el hijo no debe quedar vivo
+                if proc.is_alive():
+                    proc.terminate()
+                await asyncio.to_thread(proc.join, 5)
+                recv.close()
+                self._procesos.discard(proc)
+        if estado == "ok":
+            return valor
+        if estado == "memoria":
+            raise LimiteExcedido(f"{fn.__name__}: superó el límite de memoria ({memoria_mb or self.memoria_mb} MB)")
+        if estado == "murio":
+            raise TrabajoError(f"{fn.__name__}: el proceso terminó inesperadamente (código {proc.exitcode})")
+        raise TrabajoError(f"{fn.__name__}: {valor}")
+
+    def close(self) -> None:
+        for proc in list(self._procesos):
+            if proc.is_alive():
+                proc.terminate()
+        self._procesos.clear()
@@ -34,7 +34,17 @@ const CashReport = () => {
   const fetchReport = async () => {
     try {
       const response = await axios.get(`${API}/cash-sessions/${sessionId}/report`);
-      setReport(response.data);
+      // El reporte trae la primera página de movimientos; el resto se pide por cursor
+      const movements = [...(response.data.movements || [])];
+      let cursor = response.data.movements_next_cursor;
+      while (cursor) {
+        const page = await axios.get(`${API}/cash-sessions/${sessionId}/movements`, {
+          params: { cursor, per_page: 500 },
+        });
+        movements.push(...page.data.items);
+        cursor = page.data.next_cursor;
+      }
+      setReport({ ...response.data, movements });
     } catch (error) {
       toast.error('Error al cargar el reporte');
     } finally {
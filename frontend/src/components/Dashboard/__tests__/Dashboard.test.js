@@ -356,4 +356,56 @@ describe('Dashboard', () => {
       expect(screen.queryByText('Productos con Stock Bajo')).not.toBeInTheDocument();
     });
   });
+
+  // ─── Tiempo real ───────────────────────────────────────────────────────────
+  describe('stream del dashboard', () => {
+    class FakeEventSource {
+      static instancias = [];
+
+      constructor(url) {
+        this.url = url;
+        this.listeners = {};
+        this.closed = false;
+        FakeEventSource.instancias.push(this);
+      }
+
+      addEventListener(tipo, fn) {
+        this.listeners[tipo] = fn;
+      }
+
+      emitir(tipo) {
+        this.listeners[tipo]({ data: '{}' });
+      }
+
+      close() {
+        this.closed = true;
+      }
+    }
+
+    beforeEach(() => {
+      FakeEventSource.instancias = [];
+      global.EventSource = FakeEventSource;
+    });
+
+    afterEach(() => {
+      delete global.EventSource;
+    });
+
+    it('abre el stream con el ticket y refresca stats ante una venta', async () => {
+      setupAdminMocks();
+      mock.onPost(/\/dashboard\/stream\/ticket/).reply(200, { ticket: 'tk-1', expira_en: 60 });
+
+      renderWithProviders(<Dashboard />, { user: mockUser });
+
+      await waitFor(() => expect(FakeEventSource.instancias).toHaveLength(1));
+      expect(FakeEventSource.instancias[0].url).toMatch(/\/dashboard\/stream\?ticket=tk-1$/);
+
+      const antes = mock.history.get.filter(r => /\/dashboard\/stats/.test(r.url)).length;
+      FakeEventSource.instancias[0].emitir('venta');
+      await waitFor(
+        () => expect(mock.history.get.filter(r => /\/dashboard\/stats/.test(r.url)).length).toBe(antes + 1),
+        { timeout: 4000 },
+      );
+    });
+  });
 });
@@ -5,6 +5,12 @@ import { formatAmount } from '../../lib/utils';
 import { toast } from 'sonner';
 import DashboardView from './DashboardView';
 
+// Tiempo real: una ráfaga de eventos del stream se junta en un solo refresco de stats
+const STREAM_REFRESCO_MS = 2000;
+const STREAM_REINTENTO_MS = 5000;
+// Sin change streams en el servidor (Mongo standalone) se refresca cada tanto
+const POLLING_MS = 5 * 60 * 1000;
+
 const Dashboard = () => {
   const [stats, setStats] = useState(null);
   const [loading, setLoading] = useState(true);
@@ -59,6 +65,52 @@ const Dashboard = () => {
     }
   }, [user]);
 
+  // Stream SSE del dashboard: cada venta, devolución, caja o alerta de stock vuelve a
+  // pedir /dashboard/stats. EventSource no manda el header Authorization, así que antes
+  // de cada conexión se pide un ticket corto que viaja en la URL.
+  useEffect(() => {
+    if (!user || typeof EventSource === 'undefined') return undefined;
+    let source = null;
+    let cerrado = false;
+    let refresco = null;
+    let reconexion = null;
+    let polling = null;
+
+    const refrescar = () => {
+      clearTimeout(refresco);
+      refresco = setTimeout(fetchDashboardStats, STREAM_REFRESCO_MS);
+    };
+
+    const conectar = async () => {
+      try {
+        const res = await axios.post(`${API}/dashboard/stream/ticket`);
+        if (cerrado) return;
+        source = new EventSource(`${API}/dashboard/stream?ticket=${encodeURIComponent(res.data.ticket)}`);
+        ['venta', 'devolucion', 'caja', 'alerta_stock'].forEach(tipo => source.addEventListener(tipo, refrescar));
+        source.addEventListener('no_disponible', () => {
+          source.close();
+          polling = setInterval(fetchDashboardStats, POLLING_MS);
+        });
+        source.onerror = () => {
+          // El ticket ya no sirve para reconectar: se cierra y se pide otro
+          source.close();
+          if (!cerrado) reconexion = setTimeout(conectar, STREAM_REINTENTO_MS);
+        };
+      } catch {
+        if (!cerrado) reconexion = setTimeout(conectar, STREAM_REINTENTO_MS);
+      }
+    };
+
+    conectar();
+    return () => {
+      cerrado = true;
+      if (source) source.close();
+      clearTimeout(refresco);
+      clearTimeout(reconexion);
+      clearInterval(polling);
+    };
+  }, [user]);
+
   const fetchDashboardStats = async () => {
     try {
       const response = await axios.get(`${API}/dashboard/stats`);
@@ -17,6 +17,7 @@ sys.path.insert(0, str(backend_path))
 from motor.motor_asyncio import AsyncIOMotorClient
 import bcrypt as _bcrypt
 from dotenv import load_dotenv
+from indexes import reconciliar
 import uuid
 from datetime import datetime, timezone, timedelta
 
@@ -98,42 +99,12 @@ def make_proveedor(nombre, ruc_cuit, email, telefono, direccion, empresa_id):
 # ---------------------------------------------------------------------------
 
 async def create_indexes(db):
-    """Crea índices para mejorar el rendimiento de las consultas."""
+    """Crea los índices declarados en backend/indexes.py."""
     print("Creating indexes...")
 
-    await db.empresas.create_index("nombre")
-    await db.users.create_index("email", unique=True)
-    await db.users.create_index([("empresa_id", 1), ("rol", 1)])
-    await db.users.create_index([("empresa_id", 1), ("branch_id", 1)])
-    await db.products.create_index(
-        [("empresa_id", 1), ("codigo_barras", 1)], unique=True, sparse=True
-    )
-    await db.products.create_index([("empresa_id", 1), ("categoria_id", 1)])
-    await db.products.create_index([("empresa_id", 1), ("activo", 1)])
-    await db.categories.create_index([("empresa_id", 1), ("nombre", 1)], unique=True)
-    await db.branches.create_index([("empresa_id", 1), ("activo", 1)])
-    await db.branch_products.create_index(
-        [("empresa_id", 1), ("product_id", 1), ("branch_id", 1)], unique=True
-    )
-    await db.branch_products.create_index([("empresa_id", 1), ("branch_id", 1)])
-    await db.sales.create_index([("empresa_id", 1), ("branch_id", 1), ("fecha", -1)])
-    await db.sales.create_index([("empresa_id", 1), ("cajero_id", 1)])
-    await db.sales.create_index([("empresa_id", 1), ("session_id", 1)])
-    await db.sale_returns.create_index([("empresa_id", 1), ("sale_id", 1)])
-    await db.sale_returns.create_index([("empresa_id", 1), ("fecha", -1)])
-    await db.cash_sessions.create_index([("empresa_id", 1), ("user_id", 1), ("status", 1)])
-    await db.cash_sessions.create_index([("empresa_id", 1), ("branch_id", 1), ("status", 1)])
-    await db.cash_movements.create_index([("empresa_id", 1), ("session_id", 1)])
-    await db.configuration.create_index("empresa_id", unique=True)
-    await db.suscripciones.create_index("empresa_id", unique=True)
-    await db.pagos_suscripcion.create_index([("empresa_id", 1), ("fecha", -1)])
-    await db.pagos_suscripcion.create_index("mp_payment_id", sparse=True)
-    await db.proveedores.create_index([("empresa_id", 1), ("activo", 1)])
-    await db.proveedores.create_index([("empresa_id", 1), ("nombre", 1)])
-    await db.compras.create_index([("empresa_id", 1), ("fecha", -1)])
-    await db.compras.create_index([("empresa_id", 1), ("proveedor_id", 1)])
-    await db.afip_config.create_index("empresa_id", unique=True)
-    await db.system_config.create_index("key", unique=True)
+    drift = await reconciliar(db)
+    for item in drift["errores"]:
+        print(f"  ✗  {item['coleccion']}.{item['nombre']}  ERROR: {item['error']}")
 
     print("✅ Indexes created successfully")
 
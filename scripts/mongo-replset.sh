@@ -0,0 +1,28 @@
+#!/bin/bash
+# Levanta un MongoDB local de un solo nodo como replica set (rs0).
+# Los change streams (/api/dashboard/stream) no funcionan contra un mongod standalone.
+#
+# Uso: ./scripts/mongo-replset.sh            -> arranca en :27017
+#      MONGO_URL=mongodb://localhost:27017/?replicaSet=rs0&directConnection=true
+
+CONTAINER=${CONTAINER:-puls-mongo-rs}
+PORT=${PORT:-27017}
+
+if ! docker ps -a --format '{{.Names}}' | grep -q "^${CONTAINER}$"; then
+  echo "==> Creando contenedor ${CONTAINER} (mongo:7, replSet rs0)..."
+  docker run -d --name "$CONTAINER" -p "${PORT}:27017" mongo:7 --replSet rs0 --bind_ip_all >/dev/null
+else
+  docker start "$CONTAINER" >/dev/null
+fi
+
+echo "==> Esperando a mongod..."
+until docker exec "$CONTAINER" mongosh --quiet --eval "db.adminCommand('ping').ok" >/dev/null 2>&1; do
+  sleep 1
+done
+
+docker exec "$CONTAINER" mongosh --quiet --eval "
+try { rs.status().ok } catch (e) {
+  rs.initiate({_id: 'rs0', members: [{_id: 0, host: 'localhost:27017'}]}).ok
+}" >/dev/null
+
+echo "Listo: MONGO_URL=mongodb://localhost:${PORT}/?replicaSet=rs0&directConnection=true"
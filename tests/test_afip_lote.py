@@ -0,0 +1,117 @@
+"""
+Pedido de CAE por lote (backend/afip.py, AfipService.solicitar_cae_lote) contra un
+cliente zeep falso: numeración correlativa desde un solo FECompUltimoAutorizado,
+rechazos parciales dentro del lote y errores de credenciales de WSFE.
+"""
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import zeep
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from afip import AfipNoDisponible, AfipRechazo, AfipService  # noqa: E402
+
+CFG = {"ambiente": "homologacion", "cuit": "20-12345678-9", "punto_venta": 3, "tax_rate": 0.21}
+FACTURA_B = 6
+# El WSFE falso rechaza los comprobantes con este total
+TOTAL_RECHAZADO = 13.0
+
+
+def _errores(codigo, msg):
+    return SimpleNamespace(Err=[SimpleNamespace(Code=codigo, Msg=msg)])
+
+
+class _WsfeFalso:
+    def __init__(self, ultimo=41, errores_ultimo=None):
+        self.ultimo = ultimo
+        self.errores_ultimo = errores_ultimo
+        self.llamadas = []
+
+    def FECompUltimoAutorizado(self, Auth, PtoVta, CbteTipo):
+        self.llamadas.append("FECompUltimoAutorizado")
+        return SimpleNamespace(Errors=self.errores_ultimo, CbteNro=self.ultimo)
+
+    def FECAESolicitar(self, Auth, FeCAEReq):
+        self.llamadas.append("FECAESolicitar")
+        self.pedido = FeCAEReq
+        respuestas = []
+        for det in FeCAEReq["FeDetReq"]["FECAEDetRequest"]:
+            rechazado = det["ImpTotal"] == TOTAL_RECHAZADO
+            respuestas.append(SimpleNamespace(
+                Resultado="R" if rechazado else "A",
+                CAE=None if rechazado else f"CAE{det['CbteDesde']}",
+                CAEFchVto="20261031",
+                CbteDesde=det["CbteDesde"],
+                Observaciones=SimpleNamespace(Obs=[SimpleNamespace(Code=10048, Msg="importe inválido")]) if rechazado else None,
+            ))
+        return SimpleNamespace(Errors=None, FeDetResp=SimpleNamespace(FECAEDetResponse=respuestas))
+
+
+@pytest.fixture
+def wsfe(monkeypatch):
+    falso = _WsfeFalso()
+    monkeypatch.setattr(zeep, "Client", lambda url: SimpleNamespace(service=falso))
+    return falso
+
+
+def _lote(*totales, **extra):
+    return [{"sale": {"total": t}, **extra} for t in totales]
+
+
+def _solicitar(comprobantes, tipo=FACTURA_B):
+    return asyncio.run(AfipService().solicitar_cae_lote(comprobantes, CFG, "token", "sign", tipo))
+
+
+def test_numera_el_lote_correlativo_desde_un_solo_ultimo_autorizado(wsfe):
+    resultados = _solicitar(_lote(100.0, 250.0, 80.0))
+    assert wsfe.llamadas == ["FECompUltimoAutorizado", "FECAESolicitar"]
+    assert wsfe.pedido["FeCabReq"]["CantReg"] == 3
+    assert [r["nro_comprobante"] for r in resultados] == [42, 43, 44]
+    assert [r["cae"] for r in resultados] == ["CAE42", "CAE43", "CAE44"]
+
+
+def test_rechazo_parcial_dentro_del_lote(wsfe):
+    resultados = _solicitar(_lote(100.0, TOTAL_RECHAZADO, 80.0))
+    assert resultados[0]["nro_comprobante"] == 42
+    assert isinstance(resultados[1], AfipRechazo)
+    assert "10048" in str(resultados[1])
+    assert resultados[2]["nro_comprobante"] == 44
+
+
+def test_comprobante_que_no_se_puede_armar_no_consume_numero(wsfe):
+    # Factura A sin CUIT del receptor: se rechaza antes de pedir, el resto sigue
+    comprobantes = [
+        {"sale": {"total": 100.0}, "cuit_receptor": "30-11111111-1"},
+        {"sale": {"total": 50.0}},
+        {"sale": {"total": 80.0}, "cuit_receptor": "30-11111111-1"},
+    ]
+    resultados = _solicitar(comprobantes, tipo=1)
+    assert isinstance(resultados[1], AfipRechazo)
+    assert [resultados[0]["nro_comprobante"], resultados[2]["nro_comprobante"]] == [42, 43]
+
+
+@pytest.mark.parametrize("codigo", [600, 601, 602])
+def test_errores_de_credenciales_son_no_disponible(wsfe, codigo):
+    wsfe.errores_ultimo = _errores(codigo, "token o firma inválidos")
+    with pytest.raises(AfipNoDisponible):
+        _solicitar(_lote(100.0))
+    assert "FECAESolicitar" not in wsfe.llamadas
+
+
+def test_error_del_pedido_rechaza_todo_el_lote(wsfe):
+    wsfe.errores_ultimo = _errores(10015, "punto de venta inválido")
+    resultados = _solicitar(_lote(100.0, 80.0))
+    assert all(isinstance(r, AfipRechazo) for r in resultados)
+    assert "FECAESolicitar" not in wsfe.llamadas
+
+
+def test_falla_de_conexion_es_no_disponible(monkeypatch):
+    def sin_conexion(url):
+        raise ConnectionError("timeout")
+    monkeypatch.setattr(zeep, "Client", sin_conexion)
+    with pytest.raises(AfipNoDisponible):
+        _solicitar(_lote(100.0))
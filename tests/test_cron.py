@@ -0,0 +1,81 @@
+"""
+Agendas cron del scheduler (backend/scheduler.py): parseo de campos y cálculo de la
+próxima corrida en hora argentina.
+"""
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from scheduler import Cron, CronError  # noqa: E402
+
+AR = timezone(timedelta(hours=-3))
+
+
+def _t(*args):
+    return datetime(*args, tzinfo=AR)
+
+
+def test_rangos_pasos_y_listas():
+    assert Cron._parsear("*/15", 0, 59) == {0, 15, 30, 45}
+    assert Cron._parsear("1-10/3", 0, 59) == {1, 4, 7, 10}
+    assert Cron._parsear("8-20/4", 0, 23) == {8, 12, 16, 20}
+    assert Cron._parsear("1,15,20-22", 1, 31) == {1, 15, 20, 21, 22}
+    assert Cron._parsear("*", 1, 12) == set(range(1, 13))
+
+
+@pytest.mark.parametrize("expresion", [
+    "0 9 * *",        # faltan campos
+    "60 * * * *",     # minuto fuera de rango
+    "0 5-1 * * *",    # rango al revés
+    "*/0 * * * *",    # paso cero
+    "0 9 x * *",      # no numérico
+    "0 9 0 * *",      # el día del mes arranca en 1
+])
+def test_expresiones_invalidas(expresion):
+    with pytest.raises(CronError):
+        Cron(expresion)
+
+
+def test_siguiente_es_estrictamente_posterior():
+    cron = Cron("30 4 * * *")
+    assert cron.siguiente(_t(2026, 10, 19, 4, 29, 59)) == _t(2026, 10, 19, 4, 30)
+    assert cron.siguiente(_t(2026, 10, 19, 4, 30)) == _t(2026, 10, 20, 4, 30)
+
+
+def test_pasos_de_minutos_y_horas():
+    cron = Cron("*/5 8-20/4 * * *")
+    assert cron.siguiente(_t(2026, 10, 19, 8, 57)) == _t(2026, 10, 19, 12, 0)
+    assert cron.siguiente(_t(2026, 10, 19, 12, 0)) == _t(2026, 10, 19, 12, 5)
+    assert cron.siguiente(_t(2026, 10, 19, 20, 55)) == _t(2026, 10, 20, 8, 0)
+
+
+def test_dia_del_mes_o_dia_de_semana():
+    # Con los dos restringidos alcanza con uno: el 25 o los viernes
+    cron = Cron("0 9 25 * 5")
+    assert cron.siguiente(_t(2026, 10, 19, 12, 0)) == _t(2026, 10, 23, 9, 0)   # viernes
+    assert cron.siguiente(_t(2026, 10, 23, 10, 0)) == _t(2026, 10, 25, 9, 0)   # domingo 25
+    assert cron.siguiente(_t(2026, 10, 25, 10, 0)) == _t(2026, 10, 30, 9, 0)   # viernes
+
+
+def test_dia_de_semana_solo_si_el_dia_del_mes_es_libre():
+    cron = Cron("0 9 * * 1")
+    assert cron.siguiente(_t(2026, 10, 19, 10, 0)) == _t(2026, 10, 26, 9, 0)
+    # 7 también es domingo
+    assert Cron("0 0 * * 7").siguiente(_t(2026, 10, 19)) == _t(2026, 10, 25)
+
+
+def test_cambio_de_mes_y_de_anio():
+    assert Cron("30 4 1 * *").siguiente(_t(2026, 12, 15)) == _t(2027, 1, 1, 4, 30)
+    # Los meses sin día 31 se saltean
+    assert Cron("0 0 31 * *").siguiente(_t(2026, 4, 1)) == _t(2026, 5, 31)
+    assert Cron("0 0 1 2 *").siguiente(_t(2026, 3, 1)) == _t(2027, 2, 1)
+    assert Cron("0 12 29 2 *").siguiente(_t(2026, 3, 1)) == _t(2028, 2, 29, 12, 0)
+
+
+def test_conserva_la_zona_horaria():
+    siguiente = Cron("0 9 * * *").siguiente(_t(2026, 10, 19, 10, 0))
+    assert siguiente.tzinfo == AR
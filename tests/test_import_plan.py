@@ -0,0 +1,110 @@
+"""
+Plan de importación de productos (backend/import_plan.py): clasificación de cada fila
+contra el catálogo, duplicados dentro de un lote y entre lotes, y qué filas puede
+saltear import_products. Solo pandas, sin base.
+"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import import_plan  # noqa: E402
+
+CATEGORIAS = {"lacteos": "c1"}
+
+CATALOGO = pd.DataFrame([{
+    "id": "p1", "codigo_barras": "111", "nombre": "Leche", "tipo": "codigo_barras", "kind": "normal",
+    "precio": 100.0, "categoria_id": "c1", "stock": 5, "stock_minimo": 10,
+}])
+
+SUCURSALES = pd.DataFrame([{
+    "product_id": "p1", "n_bp": 1, "precio_min": 100.0, "precio_max": 100.0,
+    "costo_min": 50.0, "costo_max": 50.0, "sin_costo": 0,
+    "margen_min": 100.0, "margen_max": 100.0, "sin_margen": 0,
+}])
+
+
+def _fila(linea, **campos):
+    # Por defecto, la fila coincide con el producto del catálogo
+    return {
+        "linea": linea, "codigo_barras": "111", "nombre": "Leche", "tipo": "codigo_barras",
+        "precio": 100, "categoria": "Lacteos", "stock": 5, "stock_minimo": 10, "precio_costo": 50,
+        **campos,
+    }
+
+
+def _planificar(*filas, redondeo=0):
+    return import_plan.planificar(pd.DataFrame(filas), CATALOGO, SUCURSALES, CATEGORIAS, redondeo)
+
+
+def _estados(plan):
+    return dict(zip(plan["linea"], plan["estado"]))
+
+
+def test_clasifica_cada_fila_contra_el_catalogo():
+    plan = _planificar(
+        _fila(2),
+        _fila(3, codigo_barras="222", nombre="Yogur"),
+        _fila(4, codigo_barras="333", precio="abc"),
+    )
+    assert _estados(plan) == {2: import_plan.SIN_CAMBIOS, 3: import_plan.NUEVO, 4: import_plan.INVALIDO}
+    assert plan.loc[plan["linea"] == 4, "error"].item() == "precio inválido"
+
+
+def test_cambio_de_precio_y_de_costo():
+    precio = _planificar(_fila(2, precio=120))
+    assert _estados(precio) == {2: import_plan.CAMBIO_PRECIO}
+    assert precio["precio_actual"].item() == 100.0
+    costo = _planificar(_fila(2, precio_costo=60))
+    assert _estados(costo) == {2: import_plan.CAMBIO_COSTO}
+    assert costo["margen"].item() == 66.67
+
+
+def test_codigo_numerico_de_xlsx_y_redondeo_de_precio():
+    # openpyxl devuelve los códigos numéricos como float: 111.0 es el mismo producto
+    plan = _planificar(_fila(2, codigo_barras=111.0, precio=101), redondeo=100)
+    assert plan["codigo_barras"].item() == "111"
+    assert plan["precio"].item() == 200
+    assert _estados(plan) == {2: import_plan.CAMBIO_PRECIO}
+
+
+def test_duplicado_en_el_lote_manda_la_ultima():
+    plan = _planificar(_fila(2, precio=120), _fila(3), _fila(4, codigo_barras="111", precio="x"))
+    # La inválida no cuenta como la última: la válida de más abajo manda
+    assert _estados(plan) == {2: import_plan.DUPLICADO, 3: import_plan.SIN_CAMBIOS, 4: import_plan.INVALIDO}
+
+
+def test_duplicado_entre_lotes_pasa_la_cuenta_de_la_fila_anterior():
+    acumulado = import_plan.Acumulado(limite=10)
+    acumulado.agregar(_planificar(_fila(2, precio=120), _fila(3, codigo_barras="222", nombre="Yogur")))
+    acumulado.agregar(_planificar(_fila(4)))
+
+    assert acumulado.total == 3
+    assert acumulado.resumen[import_plan.CAMBIO_PRECIO] == 0
+    assert acumulado.resumen[import_plan.DUPLICADO] == 1
+    assert acumulado.resumen[import_plan.SIN_CAMBIOS] == 1
+    assert acumulado.resumen[import_plan.NUEVO] == 1
+    # La fila ya mostrada del primer lote queda marcada; la sin cambios no se muestra
+    assert [(f["linea"], f["estado"]) for f in acumulado.filas] == [
+        (2, import_plan.DUPLICADO), (3, import_plan.NUEVO),
+    ]
+
+
+def test_limite_de_filas_mostradas():
+    acumulado = import_plan.Acumulado(limite=1)
+    acumulado.agregar(_planificar(_fila(2, codigo_barras="222"), _fila(3, codigo_barras="333")))
+    assert len(acumulado.filas) == 1
+    assert acumulado.resumen[import_plan.NUEVO] == 2
+
+
+def test_omitible_salvo_codigos_ya_escritos_en_la_importacion():
+    sin_cambios = {"estado": import_plan.SIN_CAMBIOS, "codigo_barras": "111"}
+    duplicada = {"estado": import_plan.DUPLICADO, "codigo_barras": "111"}
+    cambio = {"estado": import_plan.CAMBIO_PRECIO, "codigo_barras": "111"}
+    assert import_plan.omitible(sin_cambios, set())
+    assert import_plan.omitible(duplicada, set())
+    assert not import_plan.omitible(cambio, set())
+    # Un lote anterior ya escribió 111: el catálogo del plan quedó viejo para ese código
+    assert not import_plan.omitible(sin_cambios, {"111"})
@@ -0,0 +1,116 @@
+"""
+Exclusión de los leases de tareas de fondo (backend/leases.py, backend/scheduler.py).
+
+Corre contra una colección en memoria que imita lo que usa leases.tomar de Mongo: _id
+único (upsert que choca => DuplicateKeyError), $or, $lte y borrado filtrado.
+"""
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from pymongo.errors import DuplicateKeyError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import leases  # noqa: E402
+import scheduler  # noqa: E402
+
+TTL = timedelta(minutes=10)
+
+
+def _cumple(doc: dict, filtro: dict) -> bool:
+    for campo, valor in filtro.items():
+        if campo == "$or":
+            if not any(_cumple(doc, f) for f in valor):
+                return False
+        elif isinstance(valor, dict) and "$lte" in valor:
+            if campo not in doc or not doc[campo] <= valor["$lte"]:
+                return False
+        elif doc.get(campo) != valor:
+            return False
+    return True
+
+
+class _Coleccion:
+    def __init__(self):
+        self.docs = {}
+
+    async def update_one(self, filtro, update, upsert=False):
+        for doc in self.docs.values():
+            if _cumple(doc, filtro):
+                doc.update(update["$set"])
+                return
+        if upsert:
+            if filtro["_id"] in self.docs:
+                raise DuplicateKeyError("E11000 duplicate key error")
+            self.docs[filtro["_id"]] = {"_id": filtro["_id"], **update["$set"]}
+
+    async def delete_one(self, filtro):
+        for _id, doc in list(self.docs.items()):
+            if _cumple(doc, filtro):
+                del self.docs[_id]
+                return
+
+    async def insert_one(self, doc):
+        self.docs[len(self.docs)] = doc
+
+
+class _DB:
+    def __init__(self):
+        self.leases = _Coleccion()
+        self.tareas_corridas = _Coleccion()
+
+
+def test_segundo_tomar_falla_mientras_el_primero_tiene_el_lease():
+    async def caso():
+        db = _DB()
+        primero, segundo = leases.nuevo_duenio(), leases.nuevo_duenio()
+        assert await leases.tomar(db, "alertas_vencimiento", TTL, primero)
+        # Otro dueño del mismo proceso no lo obtiene
+        assert not await leases.tomar(db, "alertas_vencimiento", TTL, segundo)
+        # El dueño lo renueva
+        assert await leases.tomar(db, "alertas_vencimiento", TTL, primero)
+        # soltar de otro dueño no lo libera
+        await leases.soltar(db, "alertas_vencimiento", segundo)
+        assert not await leases.tomar(db, "alertas_vencimiento", TTL, segundo)
+        await leases.soltar(db, "alertas_vencimiento", primero)
+        assert await leases.tomar(db, "alertas_vencimiento", TTL, segundo)
+
+    asyncio.run(caso())
+
+
+def test_lease_vencido_lo_toma_otro():
+    async def caso():
+        db = _DB()
+        primero, segundo = leases.nuevo_duenio(), leases.nuevo_duenio()
+        assert await leases.tomar(db, "scheduler", TTL, primero)
+        db.leases.docs["scheduler"]["hasta"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+        assert await leases.tomar(db, "scheduler", TTL, segundo)
+        assert db.leases.docs["scheduler"]["duenio"] == segundo
+
+    asyncio.run(caso())
+
+
+def test_corrida_manual_no_se_superpone_con_otra_del_mismo_proceso():
+    async def caso():
+        db = _DB()
+        adentro = asyncio.Event()
+        seguir = asyncio.Event()
+
+        async def tarea():
+            adentro.set()
+            await seguir.wait()
+            return {"generadas": 1}
+
+        primera = asyncio.create_task(scheduler.correr_tarea(db, "alertas_vencimiento", tarea, "periodica"))
+        await adentro.wait()
+        # Con la primera corrida en curso, la segunda no corre (el endpoint responde 409)
+        assert await scheduler.correr_tarea(db, "alertas_vencimiento", tarea, "manual") is None
+        seguir.set()
+        corrida = await primera
+        assert corrida["estado"] == "ok" and corrida["metricas"] == {"generadas": 1}
+        # Terminada la primera, el lease quedó libre
+        assert "alertas_vencimiento" not in db.leases.docs
+
+    asyncio.run(caso())
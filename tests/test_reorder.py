@@ -0,0 +1,97 @@
+"""
+Sugerencias de reposición (backend/reorder.py): combos repartidos entre componentes,
+demanda diaria ponderada y cantidad sugerida según los días de entrega y cobertura.
+Solo pandas, sin base.
+"""
+import sys
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import reorder  # noqa: E402
+
+HOY = date(2026, 3, 10)
+
+
+def _stock(*filas):
+    return pd.DataFrame(
+        [{"id": f"bp{i}", "branch_id": "b1", "costo": 1.0, **f} for i, f in enumerate(filas)]
+    )
+
+
+def _demanda(**por_producto):
+    return pd.DataFrame([
+        {"branch_id": "b1", "product_id": pid, "demanda_diaria": d, "vendidos": d * 7}
+        for pid, d in por_producto.items()
+    ])
+
+
+def test_combos_suman_a_sus_componentes():
+    ventas = pd.DataFrame([
+        {"branch_id": "b1", "product_id": "combo", "dia": "2026-03-09", "cantidad": 2},
+        {"branch_id": "b1", "product_id": "pan", "dia": "2026-03-09", "cantidad": 1},
+    ])
+    combos = pd.DataFrame([
+        {"combo_id": "combo", "product_id": "pan", "cantidad": 3},
+        {"combo_id": "combo", "product_id": "queso", "cantidad": 1},
+    ])
+    expandidas = reorder.expandir_combos(ventas, combos)
+    por_producto = expandidas.groupby("product_id")["cantidad"].sum().to_dict()
+    # El combo conserva su venta; cada componente suma cantidad del combo x la receta
+    assert por_producto == {"combo": 2, "pan": 1 + 6, "queso": 2}
+
+
+def test_sin_combos_las_ventas_quedan_igual():
+    ventas = pd.DataFrame([{"branch_id": "b1", "product_id": "pan", "dia": "2026-03-09", "cantidad": 1}])
+    assert reorder.expandir_combos(ventas, pd.DataFrame()).equals(ventas)
+
+
+def test_demanda_pondera_solo_la_ventana_de_dias_completos():
+    ventas = pd.DataFrame([
+        {"branch_id": "b1", "product_id": "pan", "dia": "2026-03-09", "cantidad": 10},  # ayer
+        {"branch_id": "b1", "product_id": "pan", "dia": "2026-03-10", "cantidad": 99},  # hoy: incompleto
+        {"branch_id": "b1", "product_id": "pan", "dia": "2025-12-01", "cantidad": 99},  # fuera de la historia
+    ])
+    demanda = reorder.demanda_diaria(ventas, HOY)
+    alfa = 1 - 0.5 ** (1 / reorder.VIDA_MEDIA_DIAS)
+    pesos = sum((1 - alfa) ** k for k in range(reorder.DIAS_HISTORIA))
+    fila = demanda.iloc[0]
+    assert fila["vendidos"] == 10
+    assert fila["demanda_diaria"] == pytest.approx(10 / pesos)
+
+
+def test_producto_sin_demanda_queda_al_final_del_orden():
+    plan = reorder.sugerir(
+        _stock({"product_id": "pan", "stock": 3, "stock_minimo": 10}), _demanda(otro=1.0)
+    )
+    fila = plan.iloc[0]
+    # dias_cobertura es la clave del orden por cursor: nunca None/NaN, el máximo
+    assert fila["dias_cobertura"] == reorder.COBERTURA_MAX
+    assert not fila["urgente"]
+    # Sin demanda solo se repone hasta el stock mínimo
+    assert fila["sugerido"] == 7
+    assert fila["punto_pedido"] == 10
+
+
+def test_sugerido_con_dias_por_defecto():
+    plan = reorder.sugerir(_stock({"product_id": "pan", "stock": 5, "stock_minimo": 2}), _demanda(pan=1.0))
+    fila = plan.iloc[0]
+    # 1 por día x (7 de entrega + 14 de cobertura) = 21; hay 5
+    assert fila["sugerido"] == 21 - 5
+    assert fila["dias_cobertura"] == 5.0
+    assert fila["urgente"]  # se termina antes de que llegue el pedido
+
+
+def test_sugerido_con_dias_configurados_por_la_empresa():
+    stock = _stock({"product_id": "pan", "stock": 5, "stock_minimo": 2})
+    plan = reorder.sugerir(stock, _demanda(pan=1.0), dias_entrega=2, dias_cobertura=10)
+    fila = plan.iloc[0]
+    assert fila["sugerido"] == 12 - 5
+    assert not fila["urgente"]
+    # 0 es un valor configurado, no "usar el default"
+    plan = reorder.sugerir(stock, _demanda(pan=1.0), dias_entrega=0, dias_cobertura=0)
+    assert plan.iloc[0]["sugerido"] == 0